@@ -0,0 +1,202 @@
+import numpy as np
+from typing import Union, List, Dict, Tuple
+from option_symbols import parse_occ_symbol
+from tradier_api import AccountBalances, Position
+
+
+OPTION_SIDES = ('buy_to_open', 'buy_to_close', 'sell_to_open', 'sell_to_close')
+
+
+class HypotheticalOrder:
+
+    def __init__(self, option_symbol: str, side: str, quantity: float, price: Union[float, None] = None,
+                 order_type: str = 'market'):
+        # price - expected fill per share (limit price, or the current bid / ask for a market order)
+        self.option_symbol = option_symbol
+        self.side = side
+        self.quantity = quantity
+        self.price = price
+        self.order_type = order_type
+
+    def __repr__(self):
+        return f'HypotheticalOrder({self.side} {self.quantity} {self.option_symbol} @ {self.price})'
+
+
+class SimulationResult:
+
+    def __init__(self, balances: Dict[str, float], holdings: Dict[str, float], accepted: List[HypotheticalOrder],
+                 rejected: List[Tuple[HypotheticalOrder, str]]):
+        self.balances = balances
+        self.holdings = holdings
+        self.accepted = accepted
+        self.rejected = rejected
+
+    @property
+    def ok(self) -> bool:
+        return not self.rejected
+
+    def __repr__(self):
+        return f'SimulationResult(accepted={len(self.accepted)}, rejected={self.rejected}, balances={self.balances})'
+
+
+class AccountSimulator:
+
+    def __init__(self, balances: Union[AccountBalances, None], positions: Union[List[Position], None],
+                 commission_per_contract: float = 0.35, short_option_margin_pct: float = 0.20):
+        # local what-if for option orders - answers instantly, the api preview is then only a final check
+        # balances - AccountBalances (None when only close orders are checked, buying power is then zero)
+        self.account_type = None if balances is None else balances.account_type
+        self.commission_per_contract = commission_per_contract
+        self.short_option_margin_pct = short_option_margin_pct
+        self.balances = self._seed_balances(balances)
+        self.holdings = {}
+        for p in positions or []:
+            self.holdings[p.symbol] = self.holdings.get(p.symbol, 0.0) + p.quantity
+
+    def _seed_balances(self, balances: Union[AccountBalances, None]) -> Dict[str, float]:
+        if balances is None:
+            return {'option_buying_power': 0.0, 'total_cash': 0.0, 'unsettled_funds': 0.0,
+                    'option_requirement': 0.0, 'option_long_value': 0.0, 'option_short_value': 0.0}
+        # buying power lives in a different block depending on the account type
+        if self.account_type == 'cash':
+            buying_power = balances.cash.cash_available
+        elif self.account_type == 'pdt':
+            buying_power = balances.pdt.option_buying_power
+        else:
+            buying_power = balances.margin.option_buying_power
+        return {'option_buying_power': float(buying_power or 0.0),
+                'total_cash': float(balances.total_cash or 0.0),
+                'unsettled_funds': float(balances.cash.unsettled_funds or 0.0),
+                'option_requirement': float(balances.option_requirement or 0.0),
+                'option_long_value': float(balances.option_long_value or 0.0),
+                'option_short_value': float(balances.option_short_value or 0.0)}
+
+    def _reject_reason(self, order: HypotheticalOrder, balances: Dict[str, float],
+                       holdings: Dict[str, float]) -> Union[str, None]:
+        if order.side not in OPTION_SIDES:
+            return f'Unknown option order side {order.side}'
+        if order.quantity is None or order.quantity <= 0 or order.quantity != int(order.quantity):
+            return f'Quantity must be a positive whole number of contracts'
+        occ = parse_occ_symbol(order.option_symbol)
+        if occ is None:
+            return f'{order.option_symbol} is not an option symbol'
+        held = holdings.get(order.option_symbol, 0.0)
+        if order.side == 'sell_to_close' and held < order.quantity:
+            # same check the api does (see notes.py)
+            return 'Sell order cannot be placed unless you are closing a long position'
+        if order.side == 'buy_to_close' and -held < order.quantity:
+            return 'Buy to close order cannot be placed unless you are closing a short position'
+        if order.side in ('buy_to_open', 'sell_to_open', 'buy_to_close') and (order.price is None or order.price <= 0):
+            return f'A price estimate is needed to check buying power for {order.side}'
+        if order.side == 'sell_to_open' and self.account_type == 'cash':
+            return 'Short options are not allowed in a cash account'
+        if order.side == 'sell_to_close':
+            # closing a long position never needs buying power - the commission comes out of the proceeds, and an
+            # option bid at zero (expiring worthless) must still be sellable
+            return None
+        cost = self._buying_power_effect(order=order, strike=occ.strike)
+        if cost > balances['option_buying_power']:
+            return (f'Insufficient option buying power: needs {round(cost, 2)}, '
+                    f'available {round(balances["option_buying_power"], 2)}')
+        return None
+
+    def _buying_power_effect(self, order: HypotheticalOrder, strike: float) -> float:
+        # buying power used by the order (negative when it frees buying power)
+        commission = self.commission_per_contract * order.quantity
+        notional = 100 * order.quantity * (order.price or 0.0)
+        if order.side in ('buy_to_open', 'buy_to_close'):
+            return notional + commission
+        if order.side == 'sell_to_open':
+            # approximate naked requirement (premium plus a share of the strike) - the api preview has the exact one
+            return 100 * order.quantity * self.short_option_margin_pct * strike + commission
+        # sell_to_close - proceeds in a cash account settle the next day, they don't add buying power today
+        return commission if self.account_type == 'cash' else commission - notional
+
+    def _apply_one(self, order: HypotheticalOrder, balances: Dict[str, float], holdings: Dict[str, float]) -> None:
+        occ = parse_occ_symbol(order.option_symbol)
+        balances['option_buying_power'] -= self._buying_power_effect(order=order, strike=occ.strike)
+        notional = 100 * order.quantity * (order.price or 0.0)
+        commission = self.commission_per_contract * order.quantity
+        if order.side in ('buy_to_open', 'buy_to_close'):
+            balances['total_cash'] -= notional + commission
+        else:
+            balances['total_cash'] += notional - commission
+            if self.account_type == 'cash':
+                balances['unsettled_funds'] += notional - commission
+        signed = order.quantity if order.side.startswith('buy') else -order.quantity
+        held = holdings.get(order.option_symbol, 0.0) + signed
+        if held == 0:
+            holdings.pop(order.option_symbol, None)
+        else:
+            holdings[order.option_symbol] = held
+        if order.side == 'buy_to_open':
+            balances['option_long_value'] += notional
+        elif order.side == 'sell_to_close':
+            balances['option_long_value'] = max(0.0, balances['option_long_value'] - notional)
+        elif order.side == 'sell_to_open':
+            balances['option_short_value'] -= notional
+            balances['option_requirement'] += self.short_option_margin_pct * 100 * order.quantity * occ.strike
+        elif order.side == 'buy_to_close':
+            balances['option_short_value'] = min(0.0, balances['option_short_value'] + notional)
+
+    def check(self, order: HypotheticalOrder) -> Union[str, None]:
+        # rejection reason for a single order against the current state, None if it would go through
+        return self._reject_reason(order=order, balances=self.balances, holdings=self.holdings)
+
+    def simulate(self, orders: List[HypotheticalOrder], all_or_none: bool = False) -> SimulationResult:
+        # orders are applied in sequence so each one sees the buying power and holdings the earlier ones left
+        # all_or_none - one rejection rejects the whole batch (the state is left as it was)
+        balances = dict(self.balances)
+        holdings = dict(self.holdings)
+        accepted = []
+        rejected = []
+        for order in orders:
+            reason = self._reject_reason(order=order, balances=balances, holdings=holdings)
+            if reason is None:
+                self._apply_one(order=order, balances=balances, holdings=holdings)
+                accepted.append(order)
+            else:
+                rejected.append((order, reason))
+        if all_or_none and rejected:
+            return SimulationResult(balances=dict(self.balances), holdings=dict(self.holdings), accepted=[],
+                                    rejected=rejected + [(o, 'Batch rejected') for o in accepted])
+        return SimulationResult(balances=balances, holdings=holdings, accepted=accepted, rejected=rejected)
+
+    def commit(self, result: SimulationResult) -> None:
+        # take over a simulated state, e.g. after the orders were actually sent
+        self.balances = dict(result.balances)
+        self.holdings = dict(result.holdings)
+
+    def max_quantity(self, price: float, side: str = 'buy_to_open', strike: float = 0.0) -> int:
+        order = HypotheticalOrder(option_symbol='', side=side, quantity=1, price=price)
+        per_contract = self._buying_power_effect(order=order, strike=strike)
+        if per_contract <= 0:
+            return 0
+        return int(self.balances['option_buying_power'] // per_contract)
+
+    def sweep(self, prices, quantities, side: str = 'buy_to_open', strike: float = 0.0,
+              option_symbol: Union[str, None] = None) -> Dict[str, np.ndarray]:
+        # what-if over a grid of fill prices x order sizes in one shot, e.g. sweep(np.linspace(1, 2, 11), np.arange(1, 21))
+        # every output has shape (len(prices), len(quantities))
+        # option_symbol - for close orders, sizes above the held quantity are not accepted (as in check())
+        prices = np.asarray(prices, dtype=float).reshape(-1, 1)
+        quantities = np.asarray(quantities, dtype=float).reshape(1, -1)
+        commission = self.commission_per_contract * quantities
+        notional = 100 * quantities * prices
+        if side in ('buy_to_open', 'buy_to_close'):
+            effect = notional + commission
+        elif side == 'sell_to_open':
+            effect = np.broadcast_to(100 * quantities * self.short_option_margin_pct * strike + commission, notional.shape)
+        else:
+            effect = commission - (0.0 if self.account_type == 'cash' else notional)
+        effect = np.broadcast_to(effect, notional.shape)
+        remaining = self.balances['option_buying_power'] - effect
+        # same rules as _reject_reason - closing a long position never needs buying power, only the contracts
+        accepted = np.ones(notional.shape, dtype=bool) if side == 'sell_to_close' else remaining >= 0
+        if option_symbol is not None and side in ('sell_to_close', 'buy_to_close'):
+            held = self.holdings.get(option_symbol, 0.0)
+            accepted = accepted & (quantities <= (held if side == 'sell_to_close' else -held))
+        return {'cost': effect,
+                'remaining_buying_power': remaining,
+                'cash_after': self.balances['total_cash'] + np.where(side.startswith('buy'), -1.0, 1.0) * notional - commission,
+                'accepted': accepted}
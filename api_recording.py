@@ -0,0 +1,185 @@
+import gzip
+import json
+import logging
+import threading
+from bisect import bisect_right
+from datetime import datetime
+from typing import Union, List, Dict, Tuple
+from clock import SimulatedClock, get_clock
+
+
+recording_logger = logging.getLogger('api_recording')
+
+
+def _quote_request(url: str, params: Union[Dict, None] = None,
+                   data: Union[Dict, None] = None) -> Union[Tuple[List[str], str], None]:
+    # (symbols, greeks) of a quotes request, GET or POST - None for any other endpoint
+    if not url.endswith('/markets/quotes'):
+        return None
+    payload = data or params or {}
+    symbols = [s for s in str(payload.get('symbols', '')).split(',') if s]
+    return symbols, str(payload.get('greeks', 'false'))
+
+
+def _quotes_in(results: Union[Dict, None]) -> List[Dict]:
+    quotes = results.get('quotes') if isinstance(results, dict) else None
+    quotes = quotes.get('quote') if isinstance(quotes, dict) else None
+    if isinstance(quotes, dict):
+        quotes = [quotes]
+    return [q for q in quotes or [] if isinstance(q, dict) and q.get('symbol')]
+
+
+def request_key(method: str, url: str, params: Union[Dict, None] = None, data: Union[Dict, None] = None) -> str:
+    # requests are matched on method, url and payload (order of params does not matter)
+    return json.dumps([method.upper(), url, params or {}, data or {}], sort_keys=True, separators=(',', ':'),
+                      default=str)
+
+
+class ApiRecorder:
+
+    def __init__(self, path: str, flush_every: int = 50):
+        # gzipped json lines, one new file per recorder - a gzip stream is only finalized by close(), appending a
+        # restarted app's traffic behind a stream cut off by a crash would leave the new member unreadable
+        # flushes are sync flushes, everything up to the last one can be read back even without close()
+        self.path = path
+        self.flush_every = flush_every
+        self.record_count = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._file = gzip.open(path, mode='xt', encoding='utf-8')
+
+    def record(self, method: str, url: str, status_code: Union[int, None], results: Union[Dict, None],
+               elapsed: float, params: Union[Dict, None] = None, data: Union[Dict, None] = None, **kwargs) -> None:
+        entry = {'ts': get_clock().timestamp(),
+                 'method': method.upper(),
+                 'url': url,
+                 'params': params or {},
+                 'data': data or {},
+                 'status': status_code,
+                 'elapsed': round(elapsed, 6),
+                 'results': results}
+        line = json.dumps(entry, separators=(',', ':'), default=str)
+        with self._lock:
+            self._file.write(line + '\n')
+            self.record_count += 1
+            self._pending += 1
+            if self._pending >= self.flush_every:
+                self._file.flush()
+                self._pending = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+class ApiReplayer:
+
+    def __init__(self, path: Union[str, List[str]]):
+        # path - one recording or several (e.g. every recorder start of a day), replayed as one session
+        # key -> parallel lists of timestamps and results, kept in recorded order
+        # quotes are also indexed per (symbol, greeks) - the symbols of a quote request depend on what was held and
+        # due at the time (and on chunking), a replay asking for a different set is served quote by quote
+        self._timestamps = {}
+        self._results = {}
+        self._quote_timestamps = {}
+        self._quotes = {}
+        self.start_ts = None
+        self.end_ts = None
+        self._count_lock = threading.Lock()
+        self.request_count = 0
+        self.miss_count = 0
+        for file_path in [path] if isinstance(path, str) else path:
+            for entry in self._read_entries(path=file_path):
+                key = request_key(method=entry['method'], url=entry['url'], params=entry['params'],
+                                  data=entry['data'])
+                self._timestamps.setdefault(key, []).append(entry['ts'])
+                self._results.setdefault(key, []).append(entry['results'])
+                quote_request = _quote_request(url=entry['url'], params=entry['params'], data=entry['data'])
+                if quote_request is not None:
+                    for quote in _quotes_in(entry['results']):
+                        quote_key = (quote['symbol'], quote_request[1])
+                        self._quote_timestamps.setdefault(quote_key, []).append(entry['ts'])
+                        self._quotes.setdefault(quote_key, []).append(quote)
+                self.start_ts = entry['ts'] if self.start_ts is None else min(self.start_ts, entry['ts'])
+                self.end_ts = entry['ts'] if self.end_ts is None else max(self.end_ts, entry['ts'])
+        for key, ts_list in self._timestamps.items():
+            order = sorted(range(len(ts_list)), key=lambda i: ts_list[i])
+            self._timestamps[key] = [ts_list[i] for i in order]
+            self._results[key] = [self._results[key][i] for i in order]
+        for key, ts_list in self._quote_timestamps.items():
+            order = sorted(range(len(ts_list)), key=lambda i: ts_list[i])
+            self._quote_timestamps[key] = [ts_list[i] for i in order]
+            self._quotes[key] = [self._quotes[key][i] for i in order]
+        # virtual clock - starts at the first recorded request and only moves when told to (or slept on)
+        self.clock = SimulatedClock(start=datetime.fromtimestamp(self.start_ts if self.start_ts is not None else 0))
+
+    @staticmethod
+    def _read_entries(path: str) -> List[Dict]:
+        # a recording cut off by a crash has no end of stream marker - everything read up to there is kept
+        # (a torn last line included in that is dropped)
+        entries = []
+        with gzip.open(path, mode='rt', encoding='utf-8') as f:
+            try:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    if not line.endswith('\n'):
+                        recording_logger.warning(f"Dropping incomplete last record of {path}")
+                        break
+                    entries.append(json.loads(line))
+            except (EOFError, gzip.BadGzipFile) as e:
+                recording_logger.warning(f"{path} is truncated ({e}), replaying the {len(entries)} records before it")
+        return entries
+
+    @property
+    def current_ts(self) -> float:
+        return self.clock.timestamp()
+
+    @property
+    def finished(self) -> bool:
+        return self.end_ts is None or self.current_ts > self.end_ts
+
+    def now(self) -> datetime:
+        return self.clock.now()
+
+    def advance(self, seconds: float) -> None:
+        self.clock.advance(seconds)
+
+    def set_time(self, dts: Union[datetime, float]) -> None:
+        self.clock.set_time(dts if isinstance(dts, datetime) else datetime.fromtimestamp(dts))
+
+    def request(self, method: str, url: str, params: Union[Dict, None] = None, data: Union[Dict, None] = None,
+                **kwargs) -> Union[Dict, None]:
+        # serve the latest response recorded at or before the virtual time (never look ahead)
+        quote_request = _quote_request(url=url, params=params, data=data)
+        if quote_request is not None:
+            return self._replay_quotes(symbols=quote_request[0], greeks=quote_request[1])
+        key = request_key(method=method, url=url, params=params, data=data)
+        ts_list = self._timestamps.get(key)
+        idx = -1 if not ts_list else bisect_right(ts_list, self.current_ts) - 1
+        with self._count_lock:
+            self.request_count += 1
+            if idx < 0:
+                self.miss_count += 1
+        if idx < 0:
+            return None
+        return self._results[key][idx]
+
+    def _replay_quotes(self, symbols: List[str], greeks: str) -> Union[Dict, None]:
+        # latest recorded quote of each symbol, a miss if any of them was never quoted by then
+        quotes = []
+        for symbol in symbols:
+            ts_list = self._quote_timestamps.get((symbol, greeks))
+            idx = -1 if not ts_list else bisect_right(ts_list, self.current_ts) - 1
+            if idx >= 0:
+                quotes.append(self._quotes[(symbol, greeks)][idx])
+        with self._count_lock:
+            self.request_count += 1
+            if len(quotes) < len(symbols):
+                self.miss_count += 1
+        if not quotes:
+            return None
+        return {'quotes': {'quote': quotes}}
+
+    def recorded_keys(self) -> List[str]:
+        return list(self._timestamps.keys())
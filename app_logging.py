@@ -2,6 +2,20 @@ import logging
 from logging.handlers import SysLogHandler
 
 
+class LazySysLogHandler(SysLogHandler):
+    # the socket (and the dns lookup of the remote host) is set up by the first record sent, not at startup
+    # (SysLogHandler.emit creates the socket itself when there is none)
+
+    def __init__(self, *args, **kwargs):
+        self._lazy = True
+        super().__init__(*args, **kwargs)
+        self._lazy = False
+
+    def createSocket(self):
+        if not self._lazy:
+            super().createSocket()
+
+
 def initiate_basic_logging():
     logging.basicConfig(level=logging.DEBUG,
                         format="%(asctime)s %(levelname)s %(message)s",
@@ -14,7 +28,7 @@ def get_online_logger(name: str = 'default_logger', level=None):
         level = logging.DEBUG
     papertrail_host = "logs6.papertrailapp.com"
     papertrail_port = 24237
-    papertrail_handler = SysLogHandler(address=(papertrail_host, papertrail_port))
+    papertrail_handler = LazySysLogHandler(address=(papertrail_host, papertrail_port))
     logging.basicConfig(level=level,
                         format="%(asctime)s %(name)s %(levelname)s %(message)s",
                         datefmt="%Y-%m-%d %H:%M:%S",
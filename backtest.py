@@ -0,0 +1,245 @@
+import argparse
+import itertools
+import logging
+import os
+import tempfile
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+from typing import Union, List, Dict, Tuple
+from option_symbols import parse_occ_symbol
+from rule_engine import RuleEngine, Rule
+from tick_store import TickStore
+from tradier_api import MarketCalendar
+
+
+backtest_logger = logging.getLogger('backtest')
+
+# exit rules as in main.py, thresholds are parameters (any name in an expression that isn't a field is taken from
+# the parameter grid)
+DEFAULT_EXIT_RULES = (('profit_target', 'profit_pct >= profit_target'),
+                      ('stop_loss', 'profit_pct <= -stop_loss'),
+                      ('expiry_cutoff', 'hours_to_expiry <= expiry_cutoff_hours'))
+DEFAULT_GRID = {'profit_target': [0.05, 0.10, 0.15, 0.20, 0.25, 0.30, 0.35, 0.40, 0.45, 0.50],
+                'stop_loss': [0.10, 0.20, 0.30, 0.40, 0.50, 0.60, 0.70, 0.80, 0.90, 1.00],
+                'expiry_cutoff_hours': [0.0, 1.0, 2.0, 4.0, 8.0],
+                'poll_interval_sec': [1.0, 5.0]}
+# packed session data, one row per recorded quote
+_PACKED_DTYPE = np.dtype([('ts', '<f8'), ('bid', '<f8'), ('ask', '<f8'), ('last', '<f8'),
+                          ('seconds_to_expiry', '<f8')])
+
+
+def parameter_grid(grid: Dict[str, List]) -> List[Dict[str, float]]:
+    keys = list(grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))]
+
+
+def pack_sessions(tick_store: TickStore, market_calendar: MarketCalendar, path: str,
+                  symbols: Union[List[str], None] = None, start: Union[date, None] = None,
+                  end: Union[date, None] = None) -> List[Dict]:
+    # every recorded option symbol-day becomes one session (a trade entered at the day's first ask), written to one
+    # flat file the worker processes memory map - the market data is read from disk once and shared by all of them
+    sessions = []
+    parts = []
+    offset = 0
+    for day in tick_store.days():
+        if (start is not None and day < start.isoformat()) or (end is not None and day > end.isoformat()):
+            continue
+        for file_name in sorted(os.listdir(os.path.join(tick_store.directory, day))):
+            symbol = file_name.rsplit('.', 1)[0]
+            occ = parse_occ_symbol(symbol)
+            if occ is None or (symbols is not None and symbol not in symbols):
+                continue
+            records = tick_store.read_day(symbol=symbol, day=day)
+            valid = np.flatnonzero(np.isfinite(records['ask']) & (records['ask'] > 0))
+            if not len(valid):
+                continue
+            records = records[valid[0]:]
+            ts = records['ts']
+            # ticks are only recorded while the market is open, so tradeable time left shrinks with wall time
+            seconds_to_expiry = market_calendar.tradeable_seconds_to_expiry(
+                expiration=occ.expiration, eval_dts=datetime.fromtimestamp(ts[0]))
+            part = np.empty(len(records), dtype=_PACKED_DTYPE)
+            part['ts'] = ts
+            part['bid'] = records['bid']
+            part['ask'] = records['ask']
+            part['last'] = records['last']
+            part['seconds_to_expiry'] = np.maximum(0.0, seconds_to_expiry - (ts - ts[0]))
+            parts.append(part)
+            sessions.append({'symbol': symbol, 'day': day, 'offset': offset, 'length': len(part),
+                             'entry': float(records['ask'][0])})
+            offset += len(part)
+    packed = np.concatenate(parts) if parts else np.zeros(0, dtype=_PACKED_DTYPE)
+    np.save(path, packed)
+    return sessions
+
+
+# per worker process state, set up once by _init_worker
+_worker = {}
+
+
+def _init_worker(packed_path: str, sessions: List[Dict], exit_rules: Tuple[Tuple[str, str], ...]) -> None:
+    _worker['packed'] = np.load(packed_path, mmap_mode='r')
+    _worker['sessions'] = sessions
+    _worker['entry'] = np.array([s['entry'] for s in sessions])
+    _worker['start_ts'] = _worker['packed']['ts'][[s['offset'] for s in sessions]]
+    _worker['engine'] = RuleEngine([Rule(name=name, expression=expression) for name, expression in exit_rules])
+    _worker['samples'] = {}
+
+
+def _sampled_fields(poll_interval_sec: float) -> Tuple[Dict[str, np.ndarray], np.ndarray, np.ndarray]:
+    # rule fields at each poll of every session (the latest quote as the bot would have seen it polling every
+    # poll_interval_sec), the session number of each row and each session's last row - cached per interval
+    # polls that land on the same quote again are left out, they can't trigger anything the first one didn't
+    cached = _worker['samples'].get(poll_interval_sec)
+    if cached is None:
+        packed = _worker['packed']
+        rows = []
+        session_ids = []
+        for i, s in enumerate(_worker['sessions']):
+            session_ts = packed['ts'][s['offset']:s['offset'] + s['length']]
+            polls = np.arange(session_ts[0], session_ts[-1] + 1e-9, poll_interval_sec)
+            idx = np.unique(np.searchsorted(session_ts, polls, side='right') - 1)
+            rows.append(s['offset'] + idx)
+            session_ids.append(np.full(len(idx), i))
+        rows = np.concatenate(rows)
+        session_ids = np.concatenate(session_ids)
+        data = packed[rows]
+        entry = _worker['entry'][session_ids]
+        fields = {'last': data['last'], 'bid': data['bid'], 'ask': data['ask'], 'mid': (data['bid'] + data['ask']) / 2,
+                  'unit_cost': entry,
+                  'profit_pct': (data['bid'] - entry) / entry,
+                  'seconds_to_expiry': data['seconds_to_expiry'],
+                  'hours_to_expiry': data['seconds_to_expiry'] / 3600,
+                  'minutes_held': (data['ts'] - _worker['start_ts'][session_ids]) / 60,
+                  'ts': data['ts'],
+                  'is_option': np.ones(len(rows), dtype=bool)}
+        # only what the rules and the results need is kept, the cache is per interval and per worker
+        needed = {'bid', 'last', 'ts', 'unit_cost', 'minutes_held'}.union(*(r.fields for r in _worker['engine'].rules))
+        fields = {k: v for k, v in fields.items() if k in needed}
+        last_rows = np.r_[np.flatnonzero(np.diff(session_ids)), len(session_ids) - 1]
+        cached = (fields, session_ids, last_rows)
+        _worker['samples'][poll_interval_sec] = cached
+    return cached
+
+
+def _run_one(params: Dict[str, float]) -> Dict:
+    sessions = _worker['sessions']
+    engine = _worker['engine']
+    sampled, session_ids, last_rows = _sampled_fields(poll_interval_sec=params.get('poll_interval_sec', 5.0))
+    # every session's polls in one array, so each parameter set is a single rule engine pass
+    fields = dict(sampled)
+    fields.update({k: v for k, v in params.items() if k != 'poll_interval_sec'})
+    masks = engine.evaluate(fields=fields)
+    any_triggered = np.zeros(len(session_ids), dtype=bool)
+    for mask in masks.values():
+        any_triggered |= mask
+    hit = np.flatnonzero(any_triggered)
+    # first trigger per session (the first matching rule names it), sessions without one are closed at their last poll
+    exit_rows = last_rows.copy()
+    reasons = np.full(len(sessions), 'session_end', dtype=object)
+    if len(hit):
+        first = hit[np.r_[True, np.diff(session_ids[hit]) != 0]]
+        hit_sessions = session_ids[first]
+        exit_rows[hit_sessions] = first
+        for rule in reversed(engine.rules):
+            reasons[hit_sessions[masks[rule.name][first]]] = rule.name
+    entries = fields['unit_cost'][exit_rows]
+    exit_bid = fields['bid'][exit_rows]
+    exit_price = np.where(np.isfinite(exit_bid), exit_bid, fields['last'][exit_rows])
+    pnl = (exit_price - entries) * 100
+    returns = (exit_price - entries) / entries
+    order = np.argsort(fields['ts'][exit_rows], kind='stable')
+    equity = np.cumsum(pnl[order])
+    drawdown = float(np.max(np.maximum.accumulate(np.r_[0.0, equity]) - np.r_[0.0, equity])) if len(equity) else 0.0
+    result = dict(params)
+    result.update({'trades': len(sessions),
+                   'total_pnl': float(pnl.sum()),
+                   'mean_return': float(returns.mean()) if len(returns) else 0.0,
+                   'win_rate': float((pnl > 0).mean()) if len(pnl) else 0.0,
+                   'sharpe': float(returns.mean() / returns.std()) if len(returns) > 1 and returns.std() > 0 else 0.0,
+                   'max_drawdown': drawdown,
+                   'mean_minutes_held': float(fields['minutes_held'][exit_rows].mean()) if len(exit_rows) else 0.0,
+                   'exits': {str(k): int(v) for k, v in zip(*np.unique(reasons.astype(str), return_counts=True))}})
+    return result
+
+
+def _run_chunk(chunk: List[Dict[str, float]]) -> List[Dict]:
+    return [_run_one(params) for params in chunk]
+
+
+def run_backtest(tick_store: TickStore, market_calendar: MarketCalendar, grid: Union[Dict[str, List], None] = None,
+                 exit_rules: Tuple[Tuple[str, str], ...] = DEFAULT_EXIT_RULES, symbols: Union[List[str], None] = None,
+                 start: Union[date, None] = None, end: Union[date, None] = None, max_workers: Union[int, None] = None,
+                 chunk_size: int = 25, rank_by: str = 'total_pnl') -> List[Dict]:
+    # every parameter combination over every recorded session, best rank_by first
+    combinations = parameter_grid(DEFAULT_GRID if grid is None else grid)
+    with tempfile.TemporaryDirectory(prefix='backtest_') as tmp_dir:
+        packed_path = os.path.join(tmp_dir, 'sessions.npy')
+        load_start = time.perf_counter()
+        sessions = pack_sessions(tick_store=tick_store, market_calendar=market_calendar, path=packed_path,
+                                 symbols=symbols, start=start, end=end)
+        backtest_logger.info(f"{len(sessions)} sessions packed in {round(time.perf_counter() - load_start, 2)} s, "
+                             f"running {len(combinations)} parameter sets")
+        if not sessions:
+            return []
+        chunks = [combinations[i:i + chunk_size] for i in range(0, len(combinations), chunk_size)]
+        results = []
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                 initargs=(packed_path, sessions, tuple(exit_rules))) as executor:
+            for chunk_results in executor.map(_run_chunk, chunks):
+                results += chunk_results
+    return sorted(results, key=lambda r: r[rank_by], reverse=True)
+
+
+def format_results(results: List[Dict], top: int = 20) -> str:
+    if not results:
+        return 'no results'
+    param_keys = [k for k in results[0] if k not in ('trades', 'total_pnl', 'mean_return', 'win_rate', 'sharpe',
+                                                      'max_drawdown', 'mean_minutes_held', 'exits')]
+    header = ''.join(f'{k[:18]:>19}' for k in param_keys)
+    lines = [f"{'rank':>5}{header}{'trades':>8}{'total_pnl':>12}{'mean %':>9}{'win %':>8}{'sharpe':>8}"
+             f"{'max dd':>10}{'held min':>10}  exits"]
+    for i, r in enumerate(results[:top]):
+        params = ''.join(f'{r[k]:>19g}' for k in param_keys)
+        lines.append(f"{i + 1:>5}{params}{r['trades']:>8}{r['total_pnl']:>12.2f}{r['mean_return'] * 100:>9.2f}"
+                     f"{r['win_rate'] * 100:>8.1f}{r['sharpe']:>8.3f}{r['max_drawdown']:>10.2f}"
+                     f"{r['mean_minutes_held']:>10.1f}  {r['exits']}")
+    return '\n'.join(lines)
+
+
+def _floats(value: str) -> List[float]:
+    return [float(v) for v in value.split(',')]
+
+
+if __name__ == '__main__':
+    # python backtest.py --start 2023-01-03 --end 2023-01-31 --profit-target 0.1,0.2,0.3 --poll-interval 1,5
+    parser = argparse.ArgumentParser(description='Parameter sweep of the exit rules over recorded ticks')
+    parser.add_argument('--ticks', default='ticks', help='tick store directory')
+    parser.add_argument('--calendar', default='market_calendar.pkl', help='market calendar snapshot')
+    parser.add_argument('--start', type=date.fromisoformat)
+    parser.add_argument('--end', type=date.fromisoformat)
+    parser.add_argument('--profit-target', type=_floats, default=DEFAULT_GRID['profit_target'])
+    parser.add_argument('--stop-loss', type=_floats, default=DEFAULT_GRID['stop_loss'])
+    parser.add_argument('--expiry-cutoff-hours', type=_floats, default=DEFAULT_GRID['expiry_cutoff_hours'])
+    parser.add_argument('--poll-interval', type=_floats, default=DEFAULT_GRID['poll_interval_sec'])
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--rank-by', default='total_pnl')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    store = TickStore(directory=args.ticks)
+    first_day = args.start or date.fromisoformat(store.days()[0])
+    calendar = MarketCalendar.load_snapshot(path=args.calendar, base_date=first_day, days_ahead=0)
+    if calendar is None:
+        raise SystemExit(f"{args.calendar} has no usable calendar covering {first_day}")
+    sweep_start = time.perf_counter()
+    ranked = run_backtest(tick_store=store, market_calendar=calendar,
+                          grid={'profit_target': args.profit_target, 'stop_loss': args.stop_loss,
+                                'expiry_cutoff_hours': args.expiry_cutoff_hours,
+                                'poll_interval_sec': args.poll_interval},
+                          start=args.start, end=args.end, max_workers=args.workers, rank_by=args.rank_by)
+    print(format_results(ranked, top=args.top))
+    print(f"{len(ranked)} parameter sets in {round(time.perf_counter() - sweep_start, 1)} s")
+    store.close()
@@ -0,0 +1,218 @@
+import logging
+import threading
+import numpy as np
+from typing import Union, List, Dict, Tuple, Callable
+from clock import get_clock
+from tradier_api import TradierApi, Quote
+
+
+chain_logger = logging.getLogger('chain_snapshots')
+
+# tracked per contract, greeks come from the chain's greeks block
+CHAIN_COLUMNS = ('bid', 'ask', 'last', 'bidsize', 'asksize', 'volume', 'open_interest',
+                 'delta', 'gamma', 'theta', 'vega', 'mid_iv')
+_GREEK_COLUMNS = ('delta', 'gamma', 'theta', 'vega', 'mid_iv')
+# a change at or below the tolerance is not a change (prices and sizes: any change counts)
+DEFAULT_TOLERANCES = {'delta': 0.005, 'gamma': 0.0005, 'theta': 0.005, 'vega': 0.005, 'mid_iv': 0.002}
+
+
+def chain_to_columns(contracts: List[Quote]) -> Tuple[np.ndarray, np.ndarray]:
+    # contract symbols (sorted) and a (contracts x CHAIN_COLUMNS) value matrix in the same order
+    rows = []
+    for q in contracts:
+        greeks = q.greeks or {}
+        rows.append([getattr(q, c) if c not in _GREEK_COLUMNS else greeks.get(c) for c in CHAIN_COLUMNS])
+    symbols = np.array([q.symbol for q in contracts], dtype='U32')
+    values = np.array([[np.nan if v is None else v for v in row] for row in rows], dtype=float).reshape(-1, len(CHAIN_COLUMNS))
+    order = np.argsort(symbols, kind='stable')
+    return symbols[order], values[order]
+
+
+class ChainDelta:
+
+    def __init__(self, symbol: str, expiration: str, ts: float, contracts: np.ndarray, values: np.ndarray,
+                 previous: np.ndarray, changed: np.ndarray, full: bool = False):
+        # the contracts that changed in one fetch - values / previous / changed are (contracts x CHAIN_COLUMNS)
+        # full - first fetch or the contract list itself changed, every contract is included
+        self.symbol = symbol
+        self.expiration = expiration
+        self.ts = ts
+        self.contracts = contracts
+        self.values = values
+        self.previous = previous
+        self.changed = changed
+        self.full = full
+
+    def column(self, name: str) -> np.ndarray:
+        return self.values[:, CHAIN_COLUMNS.index(name)]
+
+    def __len__(self):
+        return len(self.contracts)
+
+    def __repr__(self):
+        return (f'ChainDelta({self.symbol} {self.expiration} contracts={len(self.contracts)} '
+                f'cells={int(self.changed.sum())} full={self.full})')
+
+
+class _ChainSeries:
+
+    def __init__(self):
+        # segments of one base snapshot plus cell deltas (ts, rows, cols, values) - a new segment starts when the
+        # contract list changes or the delta count reaches rebase_every
+        self.segments = []
+        self.current = None
+
+    @property
+    def symbols(self) -> Union[np.ndarray, None]:
+        return None if not self.segments else self.segments[-1]['symbols']
+
+    def rebase(self, ts: float, symbols: np.ndarray, values: np.ndarray) -> None:
+        self.segments.append({'ts': ts, 'symbols': symbols, 'values': values.copy(), 'deltas': []})
+        self.current = values.copy()
+
+    def add_delta(self, ts: float, rows: np.ndarray, cols: np.ndarray, values: np.ndarray) -> None:
+        self.segments[-1]['deltas'].append((ts, rows.astype(np.int32), cols.astype(np.uint8), values))
+        self.current[rows, cols] = values
+
+    def as_of(self, ts: float) -> Union[Tuple[np.ndarray, np.ndarray], None]:
+        segment = None
+        for s in self.segments:
+            if s['ts'] > ts:
+                break
+            segment = s
+        if segment is None:
+            return None
+        values = segment['values'].copy()
+        for delta_ts, rows, cols, cells in segment['deltas']:
+            if delta_ts > ts:
+                break
+            values[rows, cols] = cells
+        return segment['symbols'], values
+
+    def nbytes(self) -> Dict[str, int]:
+        base = sum(s['values'].nbytes + s['symbols'].nbytes for s in self.segments)
+        deltas = sum(rows.nbytes + cols.nbytes + cells.nbytes
+                     for s in self.segments for _, rows, cols, cells in s['deltas'])
+        # what keeping every fetch as a full snapshot would have taken
+        snapshots = sum((1 + len(s['deltas'])) * (s['values'].nbytes + s['symbols'].nbytes) for s in self.segments)
+        return {'base': base, 'deltas': deltas, 'full_snapshots': snapshots}
+
+
+class ChainSnapshotManager:
+
+    def __init__(self, api: Union[TradierApi, None] = None, tolerances: Union[Dict[str, float], None] = None,
+                 rebase_every: int = 500):
+        # last option chain per (symbol, expiration) in columnar form - every new fetch is diffed against it and only
+        # the contracts that changed by more than their column's tolerance are stored and sent to subscribers
+        self.api = api
+        tolerances = dict(DEFAULT_TOLERANCES, **(tolerances or {}))
+        self.tolerances = np.array([tolerances.get(c, 0.0) for c in CHAIN_COLUMNS], dtype=float)
+        self.rebase_every = rebase_every
+        self._series = {}
+        self._subscribers = {}
+        self._next_token = 0
+        self._lock = threading.Lock()
+        self.fetches = 0
+        self.published_rows = 0
+
+    def subscribe(self, callback: Callable[[ChainDelta], None], symbol: Union[str, None] = None,
+                  expiration: Union[str, None] = None) -> int:
+        # callback(delta) for every change of the matching chains (None matches any), returns a token for unsubscribe
+        with self._lock:
+            self._next_token += 1
+            self._subscribers[self._next_token] = (callback, symbol, expiration)
+            return self._next_token
+
+    def unsubscribe(self, token: int) -> None:
+        with self._lock:
+            self._subscribers.pop(token, None)
+
+    def _publish(self, delta: ChainDelta) -> None:
+        for callback, symbol, expiration in list(self._subscribers.values()):
+            if (symbol is None or symbol == delta.symbol) and (expiration is None or expiration == delta.expiration):
+                try:
+                    callback(delta)
+                except Exception as e:
+                    chain_logger.error(f"Chain subscriber failed on {delta}: {e}")
+
+    def update(self, symbol: str, expiration: str, contracts: Union[List[Quote], None] = None,
+               ts: Union[float, None] = None) -> Union[ChainDelta, None]:
+        # fetches the chain (unless contracts are given), returns the published delta or None if nothing changed
+        if contracts is None:
+            contracts = self.api.get_option_chains(symbol=symbol, expiration=expiration, greeks='true')
+            if contracts is None:
+                return None
+        ts = get_clock().timestamp() if ts is None else ts
+        symbols, values = chain_to_columns(contracts=contracts)
+        with self._lock:
+            self.fetches += 1
+            series = self._series.setdefault((symbol, expiration), _ChainSeries())
+            if series.symbols is None or not np.array_equal(series.symbols, symbols) or \
+                    len(series.segments[-1]['deltas']) >= self.rebase_every:
+                previous = np.full(values.shape, np.nan)
+                if series.symbols is not None:
+                    # carry over what is known of contracts that are still listed
+                    idx = np.searchsorted(series.symbols, symbols).clip(0, max(0, len(series.symbols) - 1))
+                    known = series.symbols[idx] == symbols if len(series.symbols) else np.zeros(len(symbols), bool)
+                    previous[known] = series.current[idx[known]]
+                series.rebase(ts=ts, symbols=symbols, values=values)
+                changed = ~((previous == values) | (np.isnan(previous) & np.isnan(values)))
+                delta = ChainDelta(symbol=symbol, expiration=expiration, ts=ts, contracts=symbols, values=values,
+                                   previous=previous, changed=changed, full=True)
+            else:
+                current = series.current
+                with np.errstate(invalid='ignore'):
+                    changed = (np.abs(values - current) > self.tolerances) | (np.isnan(values) != np.isnan(current))
+                rows, cols = np.nonzero(changed)
+                if not len(rows):
+                    return None
+                changed_rows = np.unique(rows)
+                previous = current[changed_rows].copy()
+                series.add_delta(ts=ts, rows=rows, cols=cols, values=values[rows, cols])
+                delta = ChainDelta(symbol=symbol, expiration=expiration, ts=ts, contracts=symbols[changed_rows],
+                                   values=series.current[changed_rows].copy(), previous=previous,
+                                   changed=changed[changed_rows])
+            self.published_rows += len(delta)
+        self._publish(delta)
+        return delta
+
+    def latest(self, symbol: str, expiration: str) -> Union[Dict[str, np.ndarray], None]:
+        # the current chain as columns (values within tolerance of the last fetch)
+        series = self._series.get((symbol, expiration))
+        if series is None or series.current is None:
+            return None
+        output = {'symbol': series.symbols.copy()}
+        output.update({c: series.current[:, i].copy() for i, c in enumerate(CHAIN_COLUMNS)})
+        return output
+
+    def as_of(self, symbol: str, expiration: str, ts: float) -> Union[Dict[str, np.ndarray], None]:
+        # the chain as it was known at ts, rebuilt from the base snapshot and the deltas up to ts
+        series = self._series.get((symbol, expiration))
+        rebuilt = None if series is None else series.as_of(ts=ts)
+        if rebuilt is None:
+            return None
+        symbols, values = rebuilt
+        output = {'symbol': symbols.copy()}
+        output.update({c: values[:, i] for i, c in enumerate(CHAIN_COLUMNS)})
+        return output
+
+    @property
+    def chains(self) -> List[Tuple[str, str]]:
+        return list(self._series.keys())
+
+    def memory_usage(self) -> Dict[str, int]:
+        totals = {'base': 0, 'deltas': 0, 'full_snapshots': 0}
+        for series in self._series.values():
+            for k, v in series.nbytes().items():
+                totals[k] += v
+        return totals
+
+    def stats(self) -> Dict:
+        memory = self.memory_usage()
+        stored = memory['base'] + memory['deltas']
+        return {'chains': len(self._series),
+                'fetches': self.fetches,
+                'published_rows': self.published_rows,
+                'stored_bytes': stored,
+                'full_snapshot_bytes': memory['full_snapshots'],
+                'compression': round(memory['full_snapshots'] / stored, 2) if stored else None}
@@ -0,0 +1,74 @@
+import time
+from datetime import datetime, timedelta
+from typing import Union
+
+
+class Clock:
+
+    def now(self) -> datetime:
+        raise NotImplementedError
+
+    def timestamp(self) -> float:
+        return self.now().timestamp()
+
+    def sleep(self, seconds: float) -> None:
+        raise NotImplementedError
+
+    def sleep_until(self, dts: datetime) -> None:
+        self.sleep((dts - self.now()).total_seconds())
+
+
+class WallClock(Clock):
+
+    def now(self) -> datetime:
+        return datetime.now()
+
+    def timestamp(self) -> float:
+        return time.time()
+
+    def sleep(self, seconds: float) -> None:
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+class SimulatedClock(Clock):
+
+    def __init__(self, start: Union[datetime, None] = None):
+        self._now = datetime.now() if start is None else start
+        self.sleep_count = 0
+        self.slept_seconds = 0.0
+
+    def now(self) -> datetime:
+        return self._now
+
+    def sleep(self, seconds: float) -> None:
+        # no real waiting, time jumps straight to the wake up point
+        self.sleep_count += 1
+        if seconds > 0:
+            self.slept_seconds += seconds
+            self.advance(seconds)
+
+    def advance(self, seconds: float) -> None:
+        self._now += timedelta(seconds=seconds)
+
+    def set_time(self, dts: datetime) -> None:
+        self._now = dts
+
+
+# process wide clock - everything that needs the current time or needs to wait should go through get_clock()
+_clock = WallClock()
+
+
+def get_clock() -> Clock:
+    return _clock
+
+
+def set_clock(clock: Clock) -> Clock:
+    global _clock
+    previous = _clock
+    _clock = clock
+    return previous
+
+
+def now() -> datetime:
+    return _clock.now()
@@ -0,0 +1,67 @@
+import contextvars
+import time
+from contextlib import contextmanager
+from typing import Union
+
+
+class Deadline:
+
+    def __init__(self, budget_sec: float):
+        # monotonic wall time - network calls take real time even when the app clock is simulated
+        self.budget_sec = budget_sec
+        self.expires_at = time.monotonic() + budget_sec
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def __repr__(self):
+        return f'Deadline(budget_sec={self.budget_sec}, remaining={round(self.remaining(), 3)})'
+
+
+# context variable so the deadline follows the code path (use copy_context().run when handing work to threads)
+_current_deadline = contextvars.ContextVar('current_deadline', default=None)
+
+
+def current_deadline() -> Union[Deadline, None]:
+    return _current_deadline.get()
+
+
+def remaining_time() -> Union[float, None]:
+    deadline = _current_deadline.get()
+    return None if deadline is None else deadline.remaining()
+
+
+def set_time_budget(budget_sec: float) -> contextvars.Token:
+    # a nested budget can only shrink the time left, never extend the enclosing one
+    deadline = Deadline(budget_sec)
+    parent = _current_deadline.get()
+    if parent is not None and parent.expires_at < deadline.expires_at:
+        deadline = parent
+    return _current_deadline.set(deadline)
+
+
+def reset_time_budget(token: contextvars.Token) -> None:
+    _current_deadline.reset(token)
+
+
+@contextmanager
+def time_budget(budget_sec: float):
+    token = set_time_budget(budget_sec)
+    try:
+        yield _current_deadline.get()
+    finally:
+        reset_time_budget(token)
+
+
+@contextmanager
+def independent_time_budget(budget_sec: float):
+    # replaces the enclosing budget instead of nesting in it - for work with its own timeout that must not inherit
+    # whatever is left of a caller's budget (e.g. a liquidation started from inside a loop tick)
+    token = _current_deadline.set(Deadline(budget_sec))
+    try:
+        yield _current_deadline.get()
+    finally:
+        reset_time_budget(token)
@@ -1,32 +1,33 @@
 from datetime import datetime, date, time, timedelta
 from dateutil.relativedelta import relativedelta
 from tradier_api import TradierApi
+from clock import get_clock
 from time import sleep
 from typing import Union
 
 
 def should_continue(start_time: datetime, time_limit_sec: int = 30) -> bool:
     # function to determine if app should continue running
-    if (datetime.now() - start_time).total_seconds() >= time_limit_sec:
+    if (get_clock().now() - start_time).total_seconds() >= time_limit_sec:
         return False
     else:
         return True
 
 
-def get_market_calendar(start_time: datetime, n_months: int = 3):
+def get_market_calendar(api: TradierApi, start_time: datetime, n_months: int = 3):
     mkt_cal = []
     # number of months
     n = n_months
     for i in range(0, n + 1, 1):
         temp_date = start_time + relativedelta(months=i)
-        api_response = TradierApi.get_market_calendar(month=temp_date.month, year=temp_date.year)
+        api_response = api.get_market_calendar(month=temp_date.month, year=temp_date.year)
         mkt_cal_temp = api_response.flattened_data()
         mkt_cal += mkt_cal_temp
     return mkt_cal
 
 
 def market_open(mkt_cal) -> bool:
-    current_dts = datetime.now()
+    current_dts = get_clock().now()
     mkt_cal_day = [day for day in mkt_cal if date.fromisoformat(day['date']) == current_dts.date()][0]
     if mkt_cal_day['status'] == 'open':
         if time.fromisoformat(mkt_cal_day['open']['start']) <= current_dts.time() <= time.fromisoformat(mkt_cal_day['open']['end']):
@@ -40,7 +41,7 @@ def market_open(mkt_cal) -> bool:
 
 def time_to_market_close(mkt_cal):
     output = None
-    current_dts = datetime.now()
+    current_dts = get_clock().now()
     mkt_cal_day = [day for day in mkt_cal if date.fromisoformat(day['date']) == current_dts.date()][0]
     if mkt_cal_day['status'] == 'open':
         close_dts = datetime.combine(date=current_dts.date(), time=time.fromisoformat(mkt_cal_day['open']['end']))
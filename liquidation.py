@@ -0,0 +1,337 @@
+import argparse
+import contextvars
+import logging
+import math
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from typing import Union, List, Dict
+from account_simulator import AccountSimulator, HypotheticalOrder
+from clock import get_clock
+from deadline import independent_time_budget
+from option_symbols import parse_occ_symbol
+from primary_functions import wait
+from state_journal import StateJournal, order_tag
+from tracing import span
+from tradier_api import TradierApi, Position, Quote, NOT_SENT_OUTCOMES, REQUEST_OK
+
+
+liquidation_logger = logging.getLogger('liquidation')
+
+# time left for the requests of the last round once timeout_sec is reached
+_FINAL_ROUND_SEC = 30.0
+# order states after which the order will not fill any further
+FINAL_ORDER_STATUSES = ('filled', 'expired', 'canceled', 'rejected', 'error')
+
+
+def round_to_tick(price: float, side: str) -> float:
+    # penny increments below $3, nickels above - rounded towards the marketable side
+    tick = 0.01 if price < 3 else 0.05
+    steps = price / tick
+    steps = math.floor(steps + 1e-9) if side.startswith('sell') else math.ceil(steps - 1e-9)
+    return round(max(tick, steps * tick), 2)
+
+
+class LiquidationLeg:
+
+    def __init__(self, position: Position, priority: int):
+        # one position to close, possibly over several orders (partial fills, reprices)
+        self.symbol = position.symbol
+        self.occ = parse_occ_symbol(position.symbol)
+        # from the quote once there is one - the option root only stands in for it (roots can differ from the
+        # underlying, e.g. after corporate actions)
+        self.underlying = None
+        self.side = 'sell_to_close' if position.quantity > 0 else 'buy_to_close'
+        self.quantity = abs(position.quantity)
+        self.priority = priority
+        # pending (needs an order) -> working -> canceling -> pending ... -> filled | failed | skipped
+        self.status = 'pending'
+        self.reason = None
+        self.attempts = 0
+        self.order_id = None
+        self.tag = None
+        self.price = None
+        self.submitted_at = None
+        self.cancel_sent_at = None
+        self.filled_at = None
+        # fills of earlier (canceled) orders plus the fills of the current one
+        self._closed_filled = 0.0
+        self._closed_value = 0.0
+        self._order_filled = 0.0
+        self._order_value = 0.0
+
+    @property
+    def filled(self) -> float:
+        return self._closed_filled + self._order_filled
+
+    @property
+    def remaining(self) -> float:
+        return self.quantity - self.filled
+
+    @property
+    def avg_fill_price(self) -> Union[float, None]:
+        filled = self.filled
+        return None if not filled else (self._closed_value + self._order_value) / filled
+
+    @property
+    def done(self) -> bool:
+        return self.status in ('filled', 'failed', 'skipped')
+
+    def order_update(self, order: Dict) -> None:
+        self._order_filled = float(order.get('exec_quantity') or 0.0)
+        self._order_value = self._order_filled * float(order.get('avg_fill_price') or 0.0)
+
+    def order_closed(self) -> None:
+        self._closed_filled += self._order_filled
+        self._closed_value += self._order_value
+        self._order_filled = 0.0
+        self._order_value = 0.0
+        self.order_id = None
+
+    def __repr__(self):
+        return (f'LiquidationLeg({self.side} {self.quantity} {self.symbol} status={self.status} '
+                f'filled={self.filled} attempts={self.attempts})')
+
+
+class LiquidationReport:
+
+    def __init__(self, legs: List[LiquidationLeg], elapsed_sec: float, time_to_flat_sec: Union[float, None],
+                 requests: int):
+        self.legs = legs
+        self.elapsed_sec = elapsed_sec
+        # None when not every leg was closed
+        self.time_to_flat_sec = time_to_flat_sec
+        self.requests = requests
+
+    @property
+    def flat(self) -> bool:
+        return self.time_to_flat_sec is not None
+
+    def summary(self) -> Dict:
+        statuses = {}
+        for leg in self.legs:
+            statuses[leg.status] = statuses.get(leg.status, 0) + 1
+        return {'legs': len(self.legs),
+                'statuses': statuses,
+                'contracts_filled': sum(leg.filled for leg in self.legs),
+                'contracts_remaining': sum(leg.remaining for leg in self.legs if leg.status != 'skipped'),
+                'orders_sent': sum(leg.attempts for leg in self.legs),
+                'requests': self.requests,
+                'elapsed_sec': round(self.elapsed_sec, 3),
+                'time_to_flat_sec': None if self.time_to_flat_sec is None else round(self.time_to_flat_sec, 3)}
+
+    def __repr__(self):
+        return f'LiquidationReport({self.summary()})'
+
+
+class Liquidator:
+
+    def __init__(self, api: TradierApi, journal: Union[StateJournal, None] = None, max_workers: int = 4,
+                 poll_interval_sec: float = 1.0, reprice_after_sec: float = 5.0, max_attempts: int = 5,
+                 timeout_sec: float = 300.0):
+        # closes many option positions at once - orders go out concurrently (the api client's rate limiter still
+        # applies), most urgent first, and unfilled orders are repriced towards the far side of the market
+        # attempt k of max_attempts is a limit order k / (max_attempts - 1) of the way from the mid to the bid (ask
+        # for buys), the last attempt is a market order
+        # no preview round trip per order - every leg is checked locally with AccountSimulator instead
+        self.api = api
+        self.journal = journal
+        self.max_workers = max_workers
+        self.poll_interval_sec = poll_interval_sec
+        self.reprice_after_sec = reprice_after_sec
+        self.max_attempts = max_attempts
+        self.timeout_sec = timeout_sec
+
+    def plan(self, positions: List[Position], quotes: Union[Dict[str, Quote], None] = None) -> List[LiquidationLeg]:
+        # nearest expiration first, then the biggest position (by cost basis)
+        # quotes - symbol -> Quote, used to estimate what the buy to close legs cost
+        ordered = sorted(positions, key=lambda p: (date.max if p.occ_symbol() is None else p.occ_symbol().expiration,
+                                                   -abs(p.cost_basis or 0.0)))
+        legs = [LiquidationLeg(position=p, priority=i) for i, p in enumerate(ordered)]
+        # buy to close legs need buying power, that is only known from the balances
+        balances = self.api.get_account_balances() if any(leg.side == 'buy_to_close' for leg in legs) else None
+        simulator = AccountSimulator(balances=balances, positions=positions)
+        # sells first, so the buys see the buying power the sells free up - a buy without a quote can't be
+        # estimated and is left to the broker
+        quotes = quotes or {}
+        checked = sorted([leg for leg in legs if leg.occ is not None and
+                          (leg.side == 'sell_to_close' or self._far_price(leg=leg, quote=quotes.get(leg.symbol)))],
+                         key=lambda leg: leg.side != 'sell_to_close')
+        result = simulator.simulate(orders=[HypotheticalOrder(option_symbol=leg.symbol, side=leg.side,
+                                                              quantity=leg.quantity, price=self._far_price(
+                                                                  leg=leg, quote=quotes.get(leg.symbol)))
+                                            for leg in checked])
+        reasons = {order.option_symbol: reason for order, reason in result.rejected}
+        for leg in legs:
+            if leg.occ is None:
+                leg.status, leg.reason = 'skipped', 'not an option position'
+            elif leg.symbol in reasons:
+                leg.status, leg.reason = 'skipped', reasons[leg.symbol]
+            elif self.journal is not None:
+                # an exit order that is already working is taken over instead of sending a second one
+                # (one that never got an answer is looked up by its tag)
+                open_order = self.journal.open_order(symbol=leg.symbol)
+                if open_order is not None:
+                    leg.status, leg.order_id, leg.tag = 'working', open_order.get('id'), open_order['tag']
+                    leg.submitted_at = get_clock().timestamp()
+        return legs
+
+    @staticmethod
+    def _far_price(leg: LiquidationLeg, quote: Union[Quote, None]) -> Union[float, None]:
+        if quote is None:
+            return None
+        return quote.bid if leg.side == 'sell_to_close' else quote.ask
+
+    def _price(self, leg: LiquidationLeg, quote: Union[Quote, None]) -> Union[float, None]:
+        # None means market order
+        if leg.attempts >= self.max_attempts - 1 or quote is None or not quote.bid or not quote.ask:
+            return None
+        mid = (quote.bid + quote.ask) / 2
+        far = self._far_price(leg=leg, quote=quote)
+        return round_to_tick(price=mid + (far - mid) * leg.attempts / max(1, self.max_attempts - 1), side=leg.side)
+
+    def _submit(self, leg: LiquidationLeg, quotes: Dict[str, Union[Quote, None]]) -> None:
+        quote = quotes.get(leg.symbol)
+        if quote is not None and quote.underlying:
+            leg.underlying = quote.underlying
+        price = self._price(leg=leg, quote=quote)
+        quantity = int(round(leg.remaining))
+        tag = order_tag(symbol=leg.symbol)
+        leg.attempts += 1
+        if self.journal is not None:
+            self.journal.record_order_intent(tag=tag, symbol=leg.symbol, side=leg.side, quantity=quantity,
+                                             rule='liquidation')
+        response = self.api.post_option_order(underlying_symbol=leg.underlying or leg.occ.root, option_symbol=leg.symbol,
+                                              side=leg.side, quantity=quantity,
+                                              order_type='market' if price is None else 'limit', duration='day',
+                                              price=price, tag=tag, preview=False)
+        outcome = self.api.last_request_outcome
+        if self.journal is not None:
+            self.journal.record_order_result(tag=tag, response=response, outcome=outcome)
+        if (response is None or response.get('id') is None) and outcome in NOT_SENT_OUTCOMES:
+            leg.reason = f'order not accepted: {response}'
+            if leg.attempts >= self.max_attempts:
+                leg.status = 'failed'
+            return
+        # no answer at all - the order may be working anyway, _track() looks for it by tag before anything is resent
+        order_id = None if response is None else response.get('id')
+        leg.status, leg.order_id, leg.tag, leg.price = 'working', order_id, tag, price
+        leg.submitted_at = get_clock().timestamp()
+        leg.reason = None
+
+    def _cancel(self, leg: LiquidationLeg, *args) -> None:
+        leg.cancel_sent_at = get_clock().timestamp()
+        self.api.cancel_order(order_id=leg.order_id)
+        if self.api.last_request_outcome != REQUEST_OK:
+            # the cancel may never have reached the broker - working again, so the next stale check resends it
+            leg.status = 'working'
+
+    def _run_concurrently(self, fn, legs: List[LiquidationLeg], *args) -> None:
+        if not legs:
+            return
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(legs)))) as executor:
+            # submitted in priority order, so the most urgent legs get the rate limit tokens first
+            futures = [executor.submit(contextvars.copy_context().run, fn, leg, *args) for leg in legs]
+            for leg, future in zip(legs, futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    liquidation_logger.error(f"Liquidation request for {leg.symbol} failed: {e}")
+
+    def _track(self, legs: List[LiquidationLeg]) -> None:
+        # one orders request covers every working leg
+        working = [leg for leg in legs if leg.status in ('working', 'canceling')]
+        if not working:
+            return
+        orders = self.api.get_account_orders(include_tags='true')
+        if orders is None and self.api.last_request_outcome != REQUEST_OK:
+            return
+        by_id = {o.get('id'): o for o in orders or []}
+        by_tag = {o.get('tag'): o for o in orders or [] if o.get('tag')}
+        now = get_clock().timestamp()
+        for leg in working:
+            order = by_id.get(leg.order_id) if leg.order_id is not None else by_tag.get(leg.tag)
+            if order is None:
+                if leg.order_id is None and now - leg.submitted_at >= self.reprice_after_sec:
+                    # an unanswered order the broker still doesn't list was never placed
+                    if self.journal is not None:
+                        self.journal.record_order_closed(tag=leg.tag)
+                    leg.reason = 'order not placed'
+                    leg.status = 'failed' if leg.attempts >= self.max_attempts else 'pending'
+                continue
+            leg.order_id = order.get('id')
+            leg.order_update(order=order)
+            status = order.get('status')
+            if status == 'filled' or leg.remaining <= 0:
+                leg.order_closed()
+                leg.status, leg.filled_at = 'filled', now
+            elif status in FINAL_ORDER_STATUSES:
+                leg.order_closed()
+                leg.reason = f'order {status}'
+                leg.status = 'failed' if leg.attempts >= self.max_attempts else 'pending'
+            elif leg.status == 'canceling' and now - leg.cancel_sent_at >= self.reprice_after_sec:
+                # still open long after the cancel went out - working again, so the cancel is sent once more
+                leg.status = 'working'
+            if self.journal is not None and status in FINAL_ORDER_STATUSES:
+                self.journal.record_order_closed(tag=leg.tag)
+
+    def liquidate(self, positions: List[Position]) -> LiquidationReport:
+        clock = get_clock()
+        start = clock.timestamp()
+        requests_before = self.api.request_count
+        # a budget of its own - inside a loop tick the tick's few seconds would be gone after the first round and
+        # every quote, order and cancel request after that would be skipped
+        with span('liquidate'), independent_time_budget(self.timeout_sec + _FINAL_ROUND_SEC):
+            quotes = self.api.get_quotes_batched(symbols=[p.symbol for p in positions if p.is_option()])
+            legs = self.plan(positions=positions, quotes=quotes)
+            liquidation_logger.info(f"Liquidating {sum(not leg.done for leg in legs)} positions")
+            while not all(leg.done for leg in legs) and clock.timestamp() - start < self.timeout_sec:
+                pending = [leg for leg in legs if leg.status == 'pending']
+                if pending:
+                    # the first round reuses the quotes the plan was checked with
+                    if any(leg.attempts for leg in pending):
+                        quotes = self.api.get_quotes_batched(symbols=[leg.symbol for leg in pending])
+                    self._run_concurrently(self._submit, pending, quotes)
+                wait(sleep_time_sec=self.poll_interval_sec)
+                self._track(legs=legs)
+                # unfilled for too long - cancel, the remainder is resubmitted at the next price once the cancel shows
+                # (market orders are left to work, an order taken over from the journal is repriced like a limit order)
+                now = clock.timestamp()
+                stale = [leg for leg in legs if leg.status == 'working' and leg.order_id is not None
+                         and (leg.price is not None or not leg.attempts)
+                         and now - leg.submitted_at >= self.reprice_after_sec]
+                for leg in stale:
+                    leg.status = 'canceling'
+                self._run_concurrently(self._cancel, stale)
+        filled_at = [leg.filled_at for leg in legs if leg.status == 'filled']
+        flat = all(leg.status in ('filled', 'skipped') for leg in legs)
+        report = LiquidationReport(legs=legs, elapsed_sec=clock.timestamp() - start,
+                                   time_to_flat_sec=(max(filled_at, default=start) - start) if flat else None,
+                                   requests=self.api.request_count - requests_before)
+        liquidation_logger.info(f"Liquidation finished: {report.summary()}")
+        for leg in legs:
+            if leg.status in ('failed', 'skipped') or leg.remaining > 0:
+                liquidation_logger.warning(f"Not closed: {leg} {leg.reason}")
+        return report
+
+
+if __name__ == '__main__':
+    # emergency flatten: python liquidation.py [--symbols SYM ...] [--dry-run]
+    parser = argparse.ArgumentParser(description='Close option positions concurrently')
+    parser.add_argument('--symbols', nargs='*', help='only these position symbols (default: all option positions)')
+    parser.add_argument('--dry-run', action='store_true', help='only print the plan')
+    parser.add_argument('--timeout', type=float, default=300.0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    liquidation_api = TradierApi.brokerage()
+    liquidation_journal = StateJournal(directory='state')
+    liquidation_journal.load()
+    held = liquidation_api.get_account_positions() or []
+    if args.symbols:
+        held = [p for p in held if p.symbol in args.symbols]
+    liquidator = Liquidator(api=liquidation_api, journal=liquidation_journal, timeout_sec=args.timeout)
+    if args.dry_run:
+        for planned in liquidator.plan(positions=held):
+            print(planned, planned.reason or '')
+    else:
+        print(liquidator.liquidate(positions=held).summary())
+    liquidation_journal.close()
@@ -0,0 +1,316 @@
+import argparse
+import calendar
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, date, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Union, List, Dict
+from urllib.parse import urlparse, parse_qs
+from clock import SimulatedClock, set_clock
+from main import run_main_loop
+from option_symbols import build_occ_symbol
+from quote_history import QuoteHistory
+from replay_benchmark import run_replay_benchmark
+from rule_engine import RuleEngine, Rule
+from tracing import get_tracer
+from tradier_api import TradierApi, MarketCalendar, RateLimiter, MarketDataCache
+
+
+class StubMarket:
+
+    def __init__(self, n_positions: int = 200, quote_churn: float = 0.5, exit_fraction: float = 0.01,
+                 seed: int = 0):
+        # fake account and market behind the stub server
+        # quote_churn - share of quotes that move on every quote request
+        # exit_fraction - share of positions whose price is pushed past the profit target on each move,
+        #                 a live sell replaces the position with a new one so the position count stays fixed
+        self.quote_churn = quote_churn
+        self.exit_fraction = exit_fraction
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._next_strike = 100
+        self.positions = {}
+        self.prices = {}
+        self.orders = []
+        for _ in range(n_positions):
+            self._open_position()
+
+    def _open_position(self) -> None:
+        self._next_strike += 1
+        symbol = build_occ_symbol(root='SPY', expiration='2030-01-18', option_type='call', strike=self._next_strike)
+        self.positions[symbol] = {'cost_basis': 300.0, 'date_acquired': '2020-01-02T14:00:00.000Z',
+                                  'id': len(self.positions) + len(self.orders), 'quantity': 1.0, 'symbol': symbol}
+        self.prices[symbol] = 3.0
+
+    def positions_response(self) -> Dict:
+        with self._lock:
+            return {'positions': {'position': list(self.positions.values())}}
+
+    def quotes_response(self, symbols: List[str]) -> Dict:
+        output = []
+        with self._lock:
+            for symbol in symbols:
+                price = self.prices.get(symbol, 1.0)
+                if self._random.random() < self.quote_churn:
+                    if self._random.random() < self.exit_fraction:
+                        price = 3.0 * 1.5
+                    else:
+                        price = max(0.05, min(3.3, price + self._random.uniform(-0.05, 0.05)))
+                    self.prices[symbol] = price
+                output.append({'symbol': symbol, 'type': 'option', 'last': round(price, 2),
+                               'bid': round(price - 0.05, 2), 'ask': round(price + 0.05, 2), 'volume': 100,
+                               'underlying': 'SPY', 'description': symbol})
+        return {'quotes': {'quote': output}}
+
+    def order_response(self, form: Dict) -> Dict:
+        if form.get('preview') == 'true':
+            return {'order': {'status': 'ok', 'commission': 0.35, 'result': True}}
+        with self._lock:
+            self.orders.append(form)
+            order_id = len(self.orders)
+            if form.get('side') == 'sell_to_close' and self.positions.pop(form.get('option_symbol'), None):
+                self._open_position()
+        return {'order': {'id': order_id, 'status': 'ok'}}
+
+    def orders_response(self) -> Dict:
+        with self._lock:
+            return {'orders': {'order': [{'id': i + 1, 'status': 'filled', 'tag': o.get('tag')}
+                                         for i, o in enumerate(self.orders)]}}
+
+    @staticmethod
+    def calendar_response(month: int, year: int) -> Dict:
+        days = []
+        for day in range(1, calendar.monthrange(year, month)[1] + 1):
+            d = date(year, month, day)
+            if d.weekday() < 5:
+                days.append({'date': d.isoformat(), 'status': 'open', 'description': 'Market is open',
+                             'premarket': {'start': '07:00', 'end': '09:24'},
+                             'open': {'start': '09:30', 'end': '16:00'},
+                             'postmarket': {'start': '16:00', 'end': '19:55'}})
+            else:
+                days.append({'date': d.isoformat(), 'status': 'closed', 'description': 'Market is closed'})
+        return {'calendar': {'month': month, 'year': year, 'days': {'day': days}}}
+
+
+class StubServer:
+
+    def __init__(self, market: StubMarket, latency_ms: float = 50.0, jitter_ms: float = 10.0, error_rate: float = 0.0,
+                 stall_rate: float = 0.0, stall_ms: float = 5000.0, seed: int = 0):
+        # local http stand in for the api endpoints the loop uses, with injected latency and faults
+        # error_rate - share of requests answered with a 500, stall_rate - share that hang for stall_ms
+        self.market = market
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.stall_rate = stall_rate
+        self.stall_ms = stall_ms
+        self.requests = Counter()
+        self.errors = 0
+        self.stalls = 0
+        self._random = random.Random(seed)
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self._httpd.daemon_threads = True
+        self._httpd.handle_error = lambda request, client_address: None
+        self._thread = None
+
+    @property
+    def endpoint(self) -> str:
+        return f'http://127.0.0.1:{self._httpd.server_address[1]}/v1/'
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, like the real api, so the client's connection pool gets used
+            protocol_version = 'HTTP/1.1'
+            # headers and body go out in one write, otherwise nagle + delayed acks add ~40 ms to every response
+            wbufsize = 1 << 16
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, code: int, body: Union[Dict, None]):
+                payload = json.dumps(body).encode() if body is not None else b''
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                try:
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client gave up (deadline / timeout) - expected with injected stalls
+                    self.close_connection = True
+
+            def _handle(self):
+                parsed = urlparse(self.path)
+                params = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    params.update({k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()})
+                route = parsed.path.rstrip('/').split('/')[-1]
+                server.requests[f'{self.command} {route}'] += 1
+                roll = server._random.random()
+                delay = max(0.0, server.latency_ms + server._random.uniform(-server.jitter_ms, server.jitter_ms))
+                if roll < server.stall_rate:
+                    server.stalls += 1
+                    delay = server.stall_ms
+                time.sleep(delay / 1000)
+                if server.stall_rate <= roll < server.stall_rate + server.error_rate:
+                    server.errors += 1
+                    self._send(500, {'fault': 'injected'})
+                    return
+                market = server.market
+                if route == 'positions':
+                    self._send(200, market.positions_response())
+                elif route == 'quotes':
+                    self._send(200, market.quotes_response(symbols=params.get('symbols', '').split(',')))
+                elif route == 'orders' and self.command == 'POST':
+                    self._send(200, market.order_response(form=params))
+                elif route == 'orders':
+                    self._send(200, market.orders_response())
+                elif route == 'calendar':
+                    self._send(200, market.calendar_response(month=int(params['month']), year=int(params['year'])))
+                else:
+                    self._send(404, None)
+
+            do_GET = _handle
+            do_POST = _handle
+            do_DELETE = _handle
+
+        return Handler
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='stub_server', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+def _next_session_start(dts: datetime) -> datetime:
+    # 09:35 on the next weekday - the harness only measures ticks while the market is open
+    day = dts.date() + timedelta(days=1)
+    while day.weekday() >= 5:
+        day += timedelta(days=1)
+    return datetime.combine(day, datetime.min.time()) + timedelta(hours=9, minutes=35)
+
+
+def run_load_test(n_positions: int = 200, duration_sec: float = 60.0, latency_ms: float = 50.0,
+                  jitter_ms: float = 10.0, error_rate: float = 0.0, stall_rate: float = 0.0, stall_ms: float = 5000.0,
+                  quote_churn: float = 0.5, exit_fraction: float = 0.01, tick_budget_sec: float = 4.0,
+                  chunk_loops: int = 20, trace_memory: bool = True, seed: int = 0, replay_check: bool = False) -> Dict:
+    # drives run_main_loop against the stub for duration_sec of wall time, on a simulated clock so the
+    # waits between ticks are skipped - every tick is real work against a (slow, flaky) local api
+    # replay_check - record the run and replay it through the replay benchmark afterwards (replay_* in the report)
+    market = StubMarket(n_positions=n_positions, quote_churn=quote_churn, exit_fraction=exit_fraction, seed=seed)
+    server = StubServer(market=market, latency_ms=latency_ms, jitter_ms=jitter_ms, error_rate=error_rate,
+                        stall_rate=stall_rate, stall_ms=stall_ms, seed=seed)
+    server.start()
+    clock = SimulatedClock(_next_session_start(datetime(2024, 1, 1)))
+    previous_clock = set_clock(clock)
+    tracer = get_tracer()
+    tracer.reset()
+    api = TradierApi(api_key='load-test', account_id='LOADTEST', request_endpoint=server.endpoint,
+                     streaming_endpoint=None, rate_limiter=RateLimiter(max_requests=10 ** 9, period_sec=60),
+                     market_data_cache=MarketDataCache())
+    recording_dir = tempfile.TemporaryDirectory() if replay_check else None
+    recording_path = os.path.join(recording_dir.name, 'load_test.jsonl.gz') if replay_check else None
+    if replay_check:
+        api.start_recording(path=recording_path)
+    market_calendar = MarketCalendar(api=api, base_date=clock.now().date(), mo_hist=0, mo_fut=1)
+    quote_history = QuoteHistory()
+    exit_rules = RuleEngine([Rule(name='profit_target', expression='is_option and profit_pct >= 0.20')])
+    memory_samples = []
+    n_ticks = 0
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        while time.perf_counter() - start < duration_sec:
+            if not market_calendar.covers(first=clock.now().date(), last=clock.now().date() + timedelta(days=7)):
+                market_calendar = MarketCalendar(api=api, base_date=clock.now().date(), mo_hist=0, mo_fut=1)
+            n_ticks += run_main_loop(api=api, market_calendar=market_calendar, app_loop_limit=chunk_loops,
+                                     tick_budget_sec=tick_budget_sec, quote_history=quote_history,
+                                     exit_rules=exit_rules, trace_dump_interval_sec=float('inf'))
+            if clock.now().hour >= 15:
+                clock.set_time(_next_session_start(clock.now()))
+            if trace_memory:
+                memory_samples.append(tracemalloc.get_traced_memory()[0])
+        elapsed = time.perf_counter() - start
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+        set_clock(previous_clock)
+        api.stop_recording()
+        server.stop()
+    spans = {row['span']: row for row in tracer.summary()}
+    tick = spans.get('tick', {})
+    replay = {}
+    if replay_check:
+        # the replay never touches the (stopped) server, a fresh client (no warm quote cache) for the same account
+        # and endpoint matches the recorded urls
+        replay_api = TradierApi(api_key='load-test', account_id='LOADTEST', request_endpoint=server.endpoint,
+                                streaming_endpoint=None)
+        try:
+            replay = run_replay_benchmark(path=recording_path, api=replay_api)
+        finally:
+            recording_dir.cleanup()
+    # the first chunk warms up caches and the quote history, growth is measured from there
+    warm = memory_samples[0] if memory_samples else 0
+    return {'positions': n_positions,
+            'ticks': n_ticks,
+            'elapsed_seconds': elapsed,
+            'ticks_per_second': n_ticks / elapsed if elapsed else 0.0,
+            'tick_p50_ms': tick.get('p50_ms', 0.0),
+            'tick_p95_ms': tick.get('p95_ms', 0.0),
+            'tick_p99_ms': tick.get('p99_ms', 0.0),
+            'tick_max_ms': tick.get('max_ms', 0.0),
+            'quotes_p99_ms': spans.get('tick/quotes', {}).get('p99_ms', 0.0),
+            'evaluate_p99_ms': spans.get('tick/evaluate', {}).get('p99_ms', 0.0),
+            'client_requests': api.request_count,
+            'skipped_requests': api.skipped_request_count,
+            'server_requests': dict(server.requests),
+            'injected_errors': server.errors,
+            'injected_stalls': server.stalls,
+            'orders_sent': len(market.orders),
+            'traced_memory_mb': memory_samples[-1] / 2 ** 20 if memory_samples else None,
+            'memory_growth_mb': (memory_samples[-1] - warm) / 2 ** 20 if memory_samples else None,
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            **{f'replay_{k}': v for k, v in replay.items()}}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Drive the main loop against a local api stub')
+    parser.add_argument('--positions', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=60.0, help='wall clock seconds')
+    parser.add_argument('--latency-ms', type=float, default=50.0)
+    parser.add_argument('--jitter-ms', type=float, default=10.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--stall-rate', type=float, default=0.0)
+    parser.add_argument('--stall-ms', type=float, default=5000.0)
+    parser.add_argument('--quote-churn', type=float, default=0.5)
+    parser.add_argument('--exit-fraction', type=float, default=0.01)
+    parser.add_argument('--no-tracemalloc', action='store_true')
+    parser.add_argument('--replay-check', action='store_true',
+                        help='record the run and replay it through the replay benchmark, fails on any replay miss')
+    args = parser.parse_args()
+    # the loop and the client log every injected fault, keep that out of the terminal
+    logging.basicConfig(level=logging.WARNING, filename='load_test.log')
+    report = run_load_test(n_positions=args.positions, duration_sec=args.duration, latency_ms=args.latency_ms,
+                           jitter_ms=args.jitter_ms, error_rate=args.error_rate, stall_rate=args.stall_rate,
+                           stall_ms=args.stall_ms, quote_churn=args.quote_churn, exit_fraction=args.exit_fraction,
+                           trace_memory=not args.no_tracemalloc, replay_check=args.replay_check)
+    for k, v in report.items():
+        print(f"{k}: {round(v, 3) if isinstance(v, float) else v}")
+    if args.replay_check and report['replay_requests_missed'] > 0:
+        sys.exit(1)
@@ -1,182 +1,370 @@
+from tracing import StartupTimer
+# created before the other imports so the startup report covers them (imports are only timed when run as a script)
+startup_timer = StartupTimer(record_imports=__name__ == '__main__')
 from timezone_correction import adjust_timezone
 from app_logging import get_online_logger
-from datetime import datetime
 from tradier_api import TradierApi, MarketCalendar
 from primary_functions import wait
+from clock import get_clock, set_clock
+from deadline import time_budget
+from quote_history import QuoteHistory
+from rule_engine import RuleEngine, Rule, position_fields
+from tracing import get_tracer, span, trace_log_handlers, ProfileTrigger
+from state_journal import StateJournal, order_tag
+from account_simulator import AccountSimulator, HypotheticalOrder
+from tick_store import TickStore
+from time_service import TimeService, ServerSyncedClock
+from polling_planner import PollingPlanner
+from liquidation import Liquidator
+from typing import Union
+import logging
+import os
 
 
-# correct for timezone discrepancies
-adjust_timezone()
-# initialize logger - currently only a single logger at debug level
-app_logger = get_online_logger(name='primary_logger')
+app_logger = logging.getLogger('primary_logger')
+
 
 def conditional_info_log(message: str, condition: bool = True):
     if condition:
         app_logger.info(message)
 
 
-# initialize global variables
-app_start_time = datetime.now()
-current_dts = datetime.now()
-main_loop_counter = 0
-app_time_limit_in_seconds = 24 * 60 * 60
-app_loop_limit = 20000
-app_logger.info(f"global variables initialized")
-
-# initialize market calendar (shouldn't need refreshed unless app running for weeks)
-market_calendar = MarketCalendar(base_date=current_dts.date(), mo_hist=3, mo_fut=3)
-current_market_state = market_calendar.get_market_state(eval_dts=current_dts, n_future=0)
-next_market_state = market_calendar.get_market_state(eval_dts=current_dts, n_future=1)
-next_market_state_at = next_market_state.start_dts
-next_tradeable_market_state = market_calendar.get_tradeable_market_state(eval_dts=current_dts, n_future=1)
-next_tradeable_market_state_at = next_tradeable_market_state.start_dts
-app_logger.info(f"Current Market State: {current_market_state.name} is tradeable: {current_market_state.tradeable}")
-# current_positions = TradierApi.get_account_positions()
-# current_orders = TradierApi.get_account_orders()
-# current_balances = TradierApi.get_account_balances()
-
-
-
-cur_state = {'loop_started': None, 'date_state': None, 'day_type': None, 'market_state': None, 'position_state': None}
-prev_state = cur_state.copy()
-
-while True:
-    main_loop_counter += 1
-    # current_dts = datetime.now()
-    # refresh market state if necessary (this is to limit the need to look up the market state every loop)
-    # info_update = False
-    # if current_dts >= next_market_state_at:
-    #     current_market_state = market_calendar.get_market_state(eval_dts=current_dts, n_future=0)
-    #     next_market_state = market_calendar.get_market_state(eval_dts=current_dts, n_future=1)
-    #     next_market_state_at = next_market_state.start_dts
-    #     next_tradeable_market_state = market_calendar.get_market_state(eval_dts=current_dts, n_future=1)
-    #     next_tradeable_market_state_at = next_tradeable_market_state.start_dts
-    #     app_logger.info(f"Current Market State: {current_market_state.name} Tradeable: {current_market_state.tradeable}")
-    # if current_market_state.tradeable:
-    #
-    # else:
-    #     time_until_next_tradeable_state = (next_tradeable_market_state.start_dts - current_dts).total_seconds()
-    #     app_logger.info(f"Next Tradeable Market State: {next_tradeable_market_state.name}")
-    #     app_logger.info(f"Time Until Next Tradeable Market State: {time_until_next_tradeable_state}")
-    cur_state.update({'loop_started': True})  # logging
-    conditional_info_log(message=f"Main loop initialized", condition=cur_state != prev_state)  # logging
-    current_dts = datetime.now()
-    today = market_calendar.get_day(day=current_dts)
-    if today.is_market_day():
-        cur_state.update({'date_state': f'open on {current_dts.date().isoformat()}'})  # logging
-        conditional_info_log(message=f"Market open today", condition=cur_state != prev_state)  # logging
-        if today.market_open <= current_dts <= today.market_close:
-            cur_state.update({'market_state': 'open'})  # logging
-            conditional_info_log(message=f"Market currently open", condition=cur_state != prev_state)  # logging
-            positions = TradierApi.get_account_positions()
-            if positions:
-                cur_state.update({'position_state': 'open'})  # logging
-                conditional_info_log(message=f"Positions currently open", condition=cur_state != prev_state)  # logging
-                quotes = TradierApi.get_quotes(symbols=[p.symbol for p in positions])
-                for quo, pos in zip(quotes, positions):
-                    if quo.symbol == pos.symbol:
-                        if quo.type == 'option':
-                            conditional_info_log(message=f"Option position open for: {quo.description}",
-                                                 condition=main_loop_counter % 20 == 0)  # logging
-                            option_purchase_price = pos.unit_cost() / 100
-                            option_current_price = quo.last
-                            option_profit_pct = (option_current_price - option_purchase_price) / option_purchase_price
-                            conditional_info_log(message=f'Option current profit: {option_profit_pct}',
-                                                 condition=main_loop_counter % 20 == 0)  # logging
-                            # also need to check for open orders
-                            if option_profit_pct >= 0.20:
-                                app_logger.info(f"Option position profitible enough to sell")  # logging
-                                # sell option - first preview, then execute (required order of operations by API)
-                                response_sell_preview = TradierApi.post_option_order(underlying_symbol=quo.underlying,
-                                                                                     option_symbol=quo.symbol,
-                                                                                     side='sell_to_close',
-                                                                                     quantity=pos.quantity,
-                                                                                     order_type='market',
-                                                                                     duration='day')
-                                app_logger.info(f"Option sell order preview {response_sell_preview}")  # logging
-                                response_sell = TradierApi.post_option_order(underlying_symbol=quo.underlying,
-                                                                             option_symbol=quo.symbol,
-                                                                             side='sell_to_close',
-                                                                             quantity=pos.quantity,
-                                                                             order_type='market',
-                                                                             duration='day',
-                                                                             preview=False)
-                                app_logger.info(f"Option sell order created: {response_sell}")  # logging
+def traced_wait(sleep_time_sec: float, wake_at=None) -> None:
+    # waits get their own span so the work done in a tick is the tick time minus the wait time
+    with span('wait'):
+        wait(sleep_time_sec=sleep_time_sec, wake_at=wake_at)
+
+
+def default_exit_rules(option_profit_target: float = 0.20) -> RuleEngine:
+    return RuleEngine([Rule(name='profit_target', expression=f'is_option and profit_pct >= {option_profit_target}')])
+
+
+def run_main_loop(api: TradierApi, market_calendar: MarketCalendar, app_time_limit_in_seconds: int = 24 * 60 * 60,
+                  app_loop_limit: int = 20000, option_profit_target: float = 0.20, tick_budget_sec: float = 4.0,
+                  quote_history: Union[QuoteHistory, None] = None, exit_rules: Union[RuleEngine, None] = None,
+                  trace_dump_interval_sec: float = 300.0, profile_trigger: Union[ProfileTrigger, None] = None,
+                  journal: Union[StateJournal, None] = None, reconcile_interval_sec: float = 60.0,
+                  tick_store: Union[TickStore, None] = None, polling_planner: Union[PollingPlanner, None] = None,
+                  positions_refresh_sec: float = 15.0, liquidator: Union[Liquidator, None] = None,
+                  flatten_expiring_before_close_sec: float = 900.0) -> int:
+    # all time reads and waits go through the process clock so the loop can run on simulated time
+    clock = get_clock()
+    # every polled quote is kept per symbol so strategies can use recent history without refetching
+    if quote_history is None:
+        quote_history = QuoteHistory()
+    # exit conditions are evaluated for all positions at once, the first matching rule wins
+    if exit_rules is None:
+        exit_rules = default_exit_rules(option_profit_target=option_profit_target)
+    # each phase of a tick is timed in a span, percentiles are logged every trace_dump_interval_sec
+    tracer = get_tracer()
+    app_start_time = clock.now()
+    last_reconcile = app_start_time
+    main_loop_counter = 0
+    # with a polling planner each position is quoted on its own schedule and positions are only
+    # refetched every positions_refresh_sec (or right after an exit order), latest_quotes keeps the last quote of each
+    positions = None
+    positions_at = None
+    latest_quotes = {}
+    next_market_state_at = market_calendar.get_next_market_state_change(eval_dts=app_start_time)
+
+    cur_state = {'loop_started': None, 'date_state': None, 'day_type': None, 'market_state': None, 'position_state': None}
+    prev_state = cur_state.copy()
+
+    while True:
+        main_loop_counter += 1
+        current_dts = clock.now()
+        # every api call in this tick shares one time budget so a stalled connection can't hold up the loop
+        # (the tick span is closed even when the tick raises)
+        with tracer.span('tick'), time_budget(tick_budget_sec):
+            with span('calendar'):
+                # refresh market state if necessary (this is to limit the need to look up the market state every loop)
+                if next_market_state_at is not None and current_dts >= next_market_state_at:
+                    next_market_state_at = market_calendar.get_next_market_state_change(eval_dts=current_dts)
+                    app_logger.debug(f"Market state changed, next change at {next_market_state_at}")  # logging
+                today = market_calendar.get_day(day=current_dts)
+            cur_state.update({'loop_started': True})  # logging
+            conditional_info_log(message=f"Main loop initialized", condition=cur_state != prev_state)  # logging
+            if today.is_market_day():
+                cur_state.update({'date_state': f'open on {current_dts.date().isoformat()}'})  # logging
+                conditional_info_log(message=f"Market open today", condition=cur_state != prev_state)  # logging
+                if today.market_open <= current_dts <= today.market_close:
+                    cur_state.update({'market_state': 'open'})  # logging
+                    conditional_info_log(message=f"Market currently open", condition=cur_state != prev_state)  # logging
+                    if polling_planner is None or positions_at is None or \
+                            (current_dts - positions_at).total_seconds() >= positions_refresh_sec:
+                        with span('positions'):
+                            positions = api.get_account_positions()
+                        positions_at = current_dts
+                        if polling_planner is not None:
+                            polling_planner.sync(symbols=[p.symbol for p in positions or []], now=current_dts.timestamp())
+                        if journal is not None and positions:
+                            # positions and submitted exit orders survive a restart, so nothing is sold twice
+                            journal.record_positions(positions=positions)
+                        # also with no positions left - the last exit orders filling is exactly when that happens
+                        if journal is not None and journal.tracked_orders and \
+                                (current_dts - last_reconcile).total_seconds() >= reconcile_interval_sec:
+                            journal.reconcile(api=api)
+                            last_reconcile = current_dts
+                    if liquidator is not None and positions and \
+                            (today.market_close - current_dts).total_seconds() <= flatten_expiring_before_close_sec:
+                        # options expiring today are closed all at once before the bell instead of one exit at a time
+                        expiring = [p for p in positions if p.is_option() and p.occ_symbol().expiration == current_dts.date()]
+                        if expiring:
+                            report = liquidator.liquidate(positions=expiring)
+                            app_logger.info(f"Expiring positions liquidated: {report.summary()}")  # logging
+                            positions = [p for p in positions if p not in expiring]
+                            positions_at = None
+                    if positions:
+                        cur_state.update({'position_state': 'open'})  # logging
+                        conditional_info_log(message=f"Positions currently open", condition=cur_state != prev_state)  # logging
+                        with span('quotes'):
+                            if polling_planner is None:
+                                polled = positions
+                            else:
+                                polled = polling_planner.due(now=current_dts.timestamp())
+                            quotes = api.get_quotes_batched(symbols=polled) if polled else {}
+                            quote_history.update(quotes=quotes, ts=current_dts.timestamp())
+                            if tick_store is not None:
+                                # queued only, written to disk by the store's own thread
+                                tick_store.append(quotes=quotes, ts=current_dts.timestamp())
+                            if polling_planner is not None:
+                                # a failed chunk keeps the previous quote, the symbol is retried at the shortest interval
+                                failed = [symbol for symbol, quote in quotes.items() if quote is None]
+                                latest_quotes.update({symbol: quote for symbol, quote in quotes.items() if quote is not None})
+                                quotes = latest_quotes
+                            # history of closed positions is dead weight, without this memory grows with every trade
+                            if len(quote_history.symbols) > len(positions) or len(latest_quotes) > len(positions):
+                                held = {p.symbol for p in positions}
+                                for symbol in quote_history.symbols:
+                                    if symbol not in held:
+                                        quote_history.drop(symbol)
+                                for symbol in [s for s in latest_quotes if s not in held]:
+                                    del latest_quotes[symbol]
+                        with span('evaluate'):
+                            fields = position_fields(positions=positions, quotes=quotes, market_calendar=market_calendar,
+                                                     eval_dts=current_dts, quote_history=quote_history)
+                            exit_signals = exit_rules.first_triggered(fields=fields)
+                            if polling_planner is not None:
+                                polling_planner.update(symbols=[p.symbol for p in positions],
+                                                       intervals=polling_planner.intervals(fields=fields),
+                                                       now=current_dts.timestamp(), failed=failed)
+                        # orders are checked locally first, a doomed order never costs a preview round trip
+                        simulator = AccountSimulator(balances=None, positions=positions)
+                        for i, pos in enumerate(positions):
+                            quo = quotes.get(pos.symbol)
+                            if quo is not None:
+                                if quo.type == 'option':
+                                    conditional_info_log(message=f"Option position open for: {quo.description}",
+                                                         condition=main_loop_counter % 20 == 0)  # logging
+                                    conditional_info_log(message=f"Option current profit: {fields['profit_pct'][i]}",
+                                                         condition=main_loop_counter % 20 == 0)  # logging
+                                    # also need to check for open orders
+                                    open_order = None if journal is None else journal.open_order(symbol=pos.symbol)
+                                    # short positions are bought back - that needs buying power, which only the
+                                    # preview knows here (the simulator has no balances), so only sells are checked
+                                    close_side = 'sell_to_close' if pos.quantity > 0 else 'buy_to_close'
+                                    close_quantity = abs(pos.quantity)
+                                    reject_reason = None if exit_signals[i] is None or close_side != 'sell_to_close' else \
+                                        simulator.check(HypotheticalOrder(option_symbol=pos.symbol, side=close_side,
+                                                                          quantity=close_quantity, price=quo.bid))
+                                    if exit_signals[i] is not None and open_order is not None:
+                                        conditional_info_log(message=f"Exit order already open: {open_order['tag']}",
+                                                             condition=main_loop_counter % 20 == 0)  # logging
+                                    elif reject_reason is not None:
+                                        app_logger.warning(f"Exit order for {pos.symbol} rejected locally: {reject_reason}")  # logging
+                                    elif exit_signals[i] is not None:
+                                        app_logger.info(f"Option position exit rule triggered: {exit_signals[i]}")  # logging
+                                        tag = order_tag(symbol=pos.symbol)
+                                        if journal is not None:
+                                            journal.record_decision(symbol=pos.symbol, rule=exit_signals[i])
+                                        with span('order'):
+                                            # sell option - first preview, then execute (required order of operations by API)
+                                            response_sell_preview = api.post_option_order(underlying_symbol=quo.underlying,
+                                                                                          option_symbol=quo.symbol,
+                                                                                          side=close_side,
+                                                                                          quantity=close_quantity,
+                                                                                          order_type='market',
+                                                                                          duration='day',
+                                                                                          tag=tag)
+                                            app_logger.info(f"Option sell order preview {response_sell_preview}")  # logging
+                                            if journal is not None:
+                                                journal.record_order_intent(tag=tag, symbol=pos.symbol, side=close_side,
+                                                                            quantity=close_quantity, rule=exit_signals[i])
+                                            response_sell = api.post_option_order(underlying_symbol=quo.underlying,
+                                                                                  option_symbol=quo.symbol,
+                                                                                  side=close_side,
+                                                                                  quantity=close_quantity,
+                                                                                  order_type='market',
+                                                                                  duration='day',
+                                                                                  tag=tag,
+                                                                                  preview=False)
+                                            if journal is not None:
+                                                journal.record_order_result(tag=tag, response=response_sell,
+                                                                            outcome=api.last_request_outcome)
+                                        # the cached positions are stale once an order went out
+                                        positions_at = None
+                                        app_logger.info(f"Option sell order created: {response_sell}")  # logging
+                                    else:
+                                        conditional_info_log(message=f"Option position exit rules not triggered",
+                                                             condition=main_loop_counter % 20 == 0)  # logging
+                                        # move on for now
+                                        pass
+                                else:
+                                    conditional_info_log(message=f"Position is not an option position",
+                                                         condition=main_loop_counter % 20 == 0)  # logging
+                                    # not an option, check the next position
+                                    pass
                             else:
-                                conditional_info_log(message=f"Option position not profitable enough to sell",
-                                                     condition=main_loop_counter % 20 == 0)  # logging
-                                # move on for now
-                                pass
+                                app_logger.debug(f"No quote returned for position symbol: {pos.symbol}")  # logging
+                        # after checking all positions, need to wait again
+                        # open positions so don't wait long
+                        conditional_info_log(message=f"All positions evaluated", condition=main_loop_counter % 20 == 0)  # logging
+                        if polling_planner is None:
+                            traced_wait(sleep_time_sec=5, wake_at=next_market_state_at)
                         else:
-                            conditional_info_log(message=f"Position is not an option position",
-                                                 condition=main_loop_counter % 20 == 0)  # logging
-                            # not an option, check the next position
-                            pass
+                            # sleep until the next symbol is due (or positions need refetching)
+                            sleep_time_sec = min(polling_planner.seconds_until_next(now=current_dts.timestamp()),
+                                                 positions_refresh_sec - (current_dts - positions_at).total_seconds()
+                                                 if positions_at is not None else 0.0)
+                            traced_wait(sleep_time_sec=sleep_time_sec, wake_at=next_market_state_at)
                     else:
-                        app_logger.debug(f"Mismatch in position and quote list order")  # logging
-                        app_logger.debug(f"Position symbol: {pos.symbol} Quote symbol: {quo.symbol}")  # logging
-                # after checking all positions, need to wait again
-                # open positions so don't wait long
-                conditional_info_log(message=f"All positions evaluated", condition=main_loop_counter % 20 == 0)  # logging
-                wait(sleep_time_sec=5)
-            else:
-                cur_state.update({'position_state': 'none open'})  # logging
-                conditional_info_log(message=f"No open positions", condition=cur_state != prev_state)  # logging
-                wait(sleep_time_sec=15)
-        elif current_dts <= today.market_open:
-            cur_state.update({'market_state': 'before_open'})  # logging
-            conditional_info_log(message=f"Market not yet open today", condition=cur_state != prev_state)  # logging
-            time_until_market_open = (today.market_open - current_dts).total_seconds()
-            app_logger.info(f"Time til market open {round(time_until_market_open)} seconds")  # logging
-            if time_until_market_open >= 2 * 3600:
-                # more than 2 hours, wait 1 hour
-                wait(sleep_time_sec=3600)
-            elif time_until_market_open >= 3600:
-                # more than 1 hour, wait 30 minutes
-                wait(sleep_time_sec=1800)
-            elif time_until_market_open >= 1800:
-                # more than 30 minutes, wait 15 minutes
-                wait(sleep_time_sec=900)
-            elif time_until_market_open >= 900:
-                # more than 15 minutes, wait 5 minute
-                wait(sleep_time_sec=300)
-            elif time_until_market_open >= 300:
-                # more than 5 minutes, wait 1 minute
-                wait(sleep_time_sec=60)
-            elif time_until_market_open >= 60:
-                # more than 1 minute, wait 30 seconds
-                wait(sleep_time_sec=30)
+                        cur_state.update({'position_state': 'none open'})  # logging
+                        conditional_info_log(message=f"No open positions", condition=cur_state != prev_state)  # logging
+                        traced_wait(sleep_time_sec=15, wake_at=next_market_state_at)
+                elif current_dts <= today.market_open:
+                    cur_state.update({'market_state': 'before_open'})  # logging
+                    conditional_info_log(message=f"Market not yet open today", condition=cur_state != prev_state)  # logging
+                    time_until_market_open = (today.market_open - current_dts).total_seconds()
+                    app_logger.info(f"Time til market open {round(time_until_market_open)} seconds")  # logging
+                    if time_until_market_open >= 2 * 3600:
+                        # more than 2 hours, wait 1 hour
+                        traced_wait(sleep_time_sec=3600, wake_at=next_market_state_at)
+                    elif time_until_market_open >= 3600:
+                        # more than 1 hour, wait 30 minutes
+                        traced_wait(sleep_time_sec=1800, wake_at=next_market_state_at)
+                    elif time_until_market_open >= 1800:
+                        # more than 30 minutes, wait 15 minutes
+                        traced_wait(sleep_time_sec=900, wake_at=next_market_state_at)
+                    elif time_until_market_open >= 900:
+                        # more than 15 minutes, wait 5 minute
+                        traced_wait(sleep_time_sec=300, wake_at=next_market_state_at)
+                    elif time_until_market_open >= 300:
+                        # more than 5 minutes, wait 1 minute
+                        traced_wait(sleep_time_sec=60, wake_at=next_market_state_at)
+                    elif time_until_market_open >= 60:
+                        # more than 1 minute, wait 30 seconds
+                        traced_wait(sleep_time_sec=30, wake_at=next_market_state_at)
+                    else:
+                        traced_wait(sleep_time_sec=5, wake_at=next_market_state_at)
+                elif current_dts >= today.market_close:
+                    cur_state.update({'market_state': 'after_close'})  # logging
+                    conditional_info_log(message=f"Market already closed for the day", condition=cur_state != prev_state)  # logging
+                    # market closed for the day, wait a while
+                    traced_wait(sleep_time_sec=3600, wake_at=next_market_state_at)
+                else:
+                    app_logger.warning(f"Market status for day / time mismatch")  # logging
+                    app_logger.debug(f"Today market status: {today.status}")  # logging
+                    app_logger.debug(f"Today market description {today.description}")  # logging
+                    app_logger.debug(f"Today Market Open Time: {today.market_open.isoformat()}")  # logging
+                    app_logger.debug(f"Today Market Close Time: {today.market_close.isoformat()}")  # logging
+                    app_logger.debug(f"Current Time: {current_dts.isoformat()}")  # logging
             else:
-                wait(sleep_time_sec=5)
-        elif current_dts >= today.market_close:
-            cur_state.update({'market_state': 'after_close'})  # logging
-            conditional_info_log(message=f"Market already closed for the day", condition=cur_state != prev_state)  # logging
-            # market closed for the day, wait a while
-            wait(sleep_time_sec=3600)
-        else:
-            app_logger.warning(f"Market status for day / time mismatch")  # logging
-            app_logger.debug(f"Today market status: {today.status}")  # logging
-            app_logger.debug(f"Today market description {today.description}")  # logging
-            app_logger.debug(f"Today Market Open Time: {today.market_open.isoformat()}")  # logging
-            app_logger.debug(f"Today Market Close Time: {today.market_close.isoformat()}")  # logging
-            app_logger.debug(f"Current Time: {current_dts.isoformat()}")  # logging
-    else:
-        cur_state.update({'date_state': f'open on {current_dts.date().isoformat()}'})  # logging
-        cur_state.update({'market_state': 'closed'})  # logging
-        conditional_info_log(message=f"Market closed today", condition=cur_state != prev_state)  # logging
-        wait(sleep_time_sec=3600)
-    if (current_dts - app_start_time).total_seconds() >= app_time_limit_in_seconds:
-        app_logger.info(f"Main loop ending due to time limit being reached")  # logging
-        break
-    elif main_loop_counter >= app_loop_limit:
-        app_logger.info(f"Main loop ending due to loop limit being reached")  # logging
-        break
-    prev_state = cur_state.copy()  # logging
-
-
-app_logger.info(f"App terminated")  # logging
+                cur_state.update({'date_state': f'open on {current_dts.date().isoformat()}'})  # logging
+                cur_state.update({'market_state': 'closed'})  # logging
+                conditional_info_log(message=f"Market closed today", condition=cur_state != prev_state)  # logging
+                traced_wait(sleep_time_sec=3600, wake_at=next_market_state_at)
+        tracer.maybe_dump(interval_sec=trace_dump_interval_sec)
+        if profile_trigger is not None:
+            profile_trigger.check_flag()
+        if (current_dts - app_start_time).total_seconds() >= app_time_limit_in_seconds:
+            app_logger.info(f"Main loop ending due to time limit being reached")  # logging
+            break
+        elif main_loop_counter >= app_loop_limit:
+            app_logger.info(f"Main loop ending due to loop limit being reached")  # logging
+            break
+        prev_state = cur_state.copy()  # logging
+    app_logger.info(f"Exit rule timing: {exit_rules.stats()}")  # logging
+    if polling_planner is not None:
+        app_logger.info(f"Polling planner: {polling_planner.stats()}")  # logging
+    app_logger.info(f"Span timings:\n{tracer.format_summary()}")  # logging
+    if journal is not None:
+        journal.record_loop(counter=main_loop_counter)
+        journal.snapshot()
+    return main_loop_counter
+
 
+if __name__ == '__main__':
+    startup_timer.mark('imports')
+    # correct for timezone discrepancies (log timestamps - the loop itself runs on the server synced clock below)
+    adjust_timezone()
+    # initialize logger - currently only a single logger at debug level
+    app_logger = get_online_logger(name='primary_logger')
+    app_logger.info(f"global variables initialized")
+    # time spent sending log records to the remote logger shows up as its own span
+    trace_log_handlers()
+    # kill -USR1 <pid> or touch profile.flag to write a 30 second flamegraph profile of the main loop
+    profile_trigger = ProfileTrigger(output_dir='.', duration_sec=30)
+    profile_trigger.install_signal_handler()
+    startup_timer.mark('timezone and logging')
 
+    # api client for the brokerage account
+    api = TradierApi.brokerage()
+    startup_timer.mark('api client')
+    # market hours are judged on the broker's clock, not the host's - one market clock sample to start with,
+    # then the Date header of every response refines the offset
+    time_service = TimeService()
+    api.attach_time_service(time_service)
+    time_service.sync(api=api)
+    set_clock(ServerSyncedClock(time_service))
+    current_dts = get_clock().now()
+    app_logger.info(f"Clock synced to broker time: {time_service.stats()}")  # logging
+    startup_timer.mark('clock sync')
+    # record all api traffic so the session can be replayed offline (see replay_benchmark.py) - a new file per
+    # start, a restart never appends to a recording a crash left unfinished
+    api.start_recording(path=f"api_recording_{current_dts.strftime('%Y-%m-%d_%H%M%S')}_{os.getpid()}.jsonl.gz")
 
+    # warm restart - calendar, positions and submitted exit orders come back from the journal,
+    # open orders are checked against the api with a single request
+    journal = StateJournal(directory='state')
+    journal.load()
+    startup_timer.mark('journal')
+    # initialize market calendar (shouldn't need refreshed unless app running for weeks) - the binary snapshot
+    # is fastest, then the journal, the api only when neither covers the coming week
+    market_calendar = MarketCalendar.load_snapshot(path='market_calendar.pkl', base_date=current_dts.date())
+    if market_calendar is None:
+        market_calendar = journal.market_calendar(base_date=current_dts.date())
+        if market_calendar is None:
+            market_calendar = MarketCalendar(api=api, base_date=current_dts.date(), mo_hist=3, mo_fut=3)
+            journal.record_calendar(market_calendar=market_calendar)
+        market_calendar.save_snapshot(path='market_calendar.pkl')
+    startup_timer.mark('market calendar')
+    journal.reconcile(api=api)
+    startup_timer.mark('order reconcile')
+    # every polled quote is persisted for post-trade analysis and research
+    tick_store = TickStore(directory='ticks')
+    current_market_state = market_calendar.get_market_state(eval_dts=current_dts, n_future=0)
+    app_logger.info(f"Current Market State: {current_market_state.name} is tradeable: {current_market_state.tradeable}")
+    # current_positions = api.get_account_positions()
+    # current_orders = api.get_account_orders()
+    # current_balances = api.get_account_balances()
 
+    # positions close to their exit (or to expiry) are quoted sub-second, the rest every few seconds, within one quota
+    # (ticks are much shorter than the fixed 5 second poll, hence the higher loop limit)
+    polling_planner = PollingPlanner(min_interval_sec=0.5, max_interval_sec=30.0, max_requests_per_min=20,
+                                     profit_target=0.20)
+    # whatever expires today is flattened in one concurrent batch 15 minutes before the close
+    liquidator = Liquidator(api=api, journal=journal)
+    startup_timer.mark('loop setup')
+    startup_timer.stop_recording_imports()
+    app_logger.info(f"Startup timing:\n{startup_timer.report()}")  # logging
 
+    try:
+        run_main_loop(api=api, market_calendar=market_calendar, app_time_limit_in_seconds=24 * 60 * 60,
+                      app_loop_limit=200000, option_profit_target=0.20, tick_budget_sec=4.0,
+                      profile_trigger=profile_trigger, journal=journal, tick_store=tick_store,
+                      polling_planner=polling_planner, liquidator=liquidator)
+    finally:
+        journal.close()
+        tick_store.close()
+        api.stop_recording()
+    app_logger.info(f"App terminated")  # logging
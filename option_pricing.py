@@ -0,0 +1,135 @@
+import numpy as np
+from datetime import datetime
+from typing import List, Dict, Union
+
+
+# time to expiry is measured in market hours, so a year is 252 sessions of 6.5 hours
+SECONDS_PER_TRADING_YEAR = 252 * 6.5 * 3600
+TRADING_DAYS_PER_YEAR = 252
+
+
+def _erf(x: np.ndarray) -> np.ndarray:
+    # Abramowitz and Stegun 7.1.26 (max error 1.5e-7) - avoids a scipy dependency
+    sign = np.sign(x)
+    x = np.abs(x)
+    t = 1.0 / (1.0 + 0.3275911 * x)
+    y = 1.0 - (((((1.061405429 * t - 1.453152027) * t) + 1.421413741) * t - 0.284496736) * t + 0.254829592) * t * np.exp(-x * x)
+    return sign * y
+
+
+def norm_cdf(x: np.ndarray) -> np.ndarray:
+    return 0.5 * (1.0 + _erf(x / np.sqrt(2.0)))
+
+
+def norm_pdf(x: np.ndarray) -> np.ndarray:
+    return np.exp(-0.5 * x * x) / np.sqrt(2.0 * np.pi)
+
+
+def _d1_d2(s, k, t, r, sigma):
+    sqrt_t = np.sqrt(t)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d1 = (np.log(s / k) + (r + 0.5 * sigma * sigma) * t) / (sigma * sqrt_t)
+    return d1, d1 - sigma * sqrt_t
+
+
+def black_scholes_price(s, k, t, r, sigma, is_call) -> np.ndarray:
+    s, k, t, sigma = (np.asarray(a, dtype=float) for a in (s, k, t, sigma))
+    is_call = np.asarray(is_call, dtype=bool)
+    d1, d2 = _d1_d2(s, k, t, r, sigma)
+    discount = np.exp(-r * t)
+    call = s * norm_cdf(d1) - k * discount * norm_cdf(d2)
+    put = k * discount * norm_cdf(-d2) - s * norm_cdf(-d1)
+    return np.where(is_call, call, put)
+
+
+def black_scholes_greeks(s, k, t, r, sigma, is_call) -> Dict[str, np.ndarray]:
+    # theta per trading day, vega per 1 vol point
+    s, k, t, sigma = (np.asarray(a, dtype=float) for a in (s, k, t, sigma))
+    is_call = np.asarray(is_call, dtype=bool)
+    d1, d2 = _d1_d2(s, k, t, r, sigma)
+    sqrt_t = np.sqrt(t)
+    pdf_d1 = norm_pdf(d1)
+    discount = np.exp(-r * t)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gamma = pdf_d1 / (s * sigma * sqrt_t)
+        theta_common = -s * pdf_d1 * sigma / (2 * sqrt_t)
+    delta = np.where(is_call, norm_cdf(d1), norm_cdf(d1) - 1.0)
+    theta = np.where(is_call,
+                     theta_common - r * k * discount * norm_cdf(d2),
+                     theta_common + r * k * discount * norm_cdf(-d2))
+    return {'delta': delta,
+            'gamma': gamma,
+            'theta': theta / TRADING_DAYS_PER_YEAR,
+            'vega': s * pdf_d1 * sqrt_t / 100}
+
+
+def implied_volatility(price, s, k, t, r, is_call, tol: float = 1e-6, max_iter: int = 50,
+                       vol_low: float = 1e-4, vol_high: float = 5.0) -> np.ndarray:
+    # vectorized Newton with a bisection fallback - the bracket shrinks every step so it always converges
+    price, s, k, t = (np.asarray(a, dtype=float) for a in (price, s, k, t))
+    is_call = np.asarray(is_call, dtype=bool)
+    shape = np.broadcast(price, s, k, t, is_call).shape
+    price, s, k, t, is_call = (np.broadcast_to(a, shape).ravel() for a in (price, s, k, t, is_call))
+    discount = np.exp(-r * t)
+    intrinsic = np.where(is_call, np.maximum(s - k * discount, 0.0), np.maximum(k * discount - s, 0.0))
+    upper = np.where(is_call, s, k * discount)
+    valid = (t > 0) & (price > intrinsic) & (price < upper) & (s > 0) & (k > 0)
+    low = np.full(price.shape, vol_low)
+    high = np.full(price.shape, vol_high)
+    sigma = np.full(price.shape, 0.3)
+    active = valid.copy()
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        idx = np.nonzero(active)[0]
+        sig = sigma[idx]
+        diff = black_scholes_price(s[idx], k[idx], t[idx], r, sig, is_call[idx]) - price[idx]
+        # price is increasing in sigma, so the sign of the error tells which side of the root we are on
+        high[idx] = np.where(diff > 0, sig, high[idx])
+        low[idx] = np.where(diff <= 0, sig, low[idx])
+        d1, _ = _d1_d2(s[idx], k[idx], t[idx], r, sig)
+        vega = s[idx] * norm_pdf(d1) * np.sqrt(t[idx])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            newton = sig - diff / vega
+        bisect = 0.5 * (low[idx] + high[idx])
+        use_newton = np.isfinite(newton) & (newton > low[idx]) & (newton < high[idx])
+        # converged rows keep the sigma that was just checked - at an exact root newton lands on the bracket edge
+        # and the bisection step would move away from it
+        done = (np.abs(diff) < tol) | (high[idx] - low[idx] < tol)
+        sigma[idx] = np.where(done, sig, np.where(use_newton, newton, bisect))
+        active[idx] = ~done
+    return np.where(valid, sigma, np.nan).reshape(shape)
+
+
+def quote_prices(bid, ask, last) -> np.ndarray:
+    # mid when there is a two sided market, otherwise the last trade
+    bid, ask, last = (np.asarray(a, dtype=float) for a in (bid, ask, last))
+    two_sided = (bid > 0) & (ask > 0) & (ask >= bid)
+    return np.where(two_sided, 0.5 * (bid + ask), last)
+
+
+def chain_greeks(quotes: List, underlying_price: float, market_calendar, eval_dts: Union[datetime, None] = None,
+                 rate: float = 0.0) -> Dict[str, np.ndarray]:
+    # quotes - option Quote objects (from get_quotes or get_option_chains), greeks not required from the api
+    # returns columns aligned with quotes: symbol, price, time_to_expiry (years of trading time), iv and greeks
+    n = len(quotes)
+    symbols = np.array([q.symbol for q in quotes], dtype=object)
+    strike = np.array([np.nan if q.strike is None else q.strike for q in quotes], dtype=float)
+    bid = np.array([np.nan if q.bid is None else q.bid for q in quotes], dtype=float)
+    ask = np.array([np.nan if q.ask is None else q.ask for q in quotes], dtype=float)
+    last = np.array([np.nan if q.last is None else q.last for q in quotes], dtype=float)
+    is_call = np.array([q.option_type == 'call' for q in quotes], dtype=bool)
+    # one calendar lookup per expiration, not per contract
+    seconds_to_expiry = {}
+    time_to_expiry = np.empty(n, dtype=float)
+    for i, q in enumerate(quotes):
+        if q.expiration_date not in seconds_to_expiry:
+            seconds_to_expiry[q.expiration_date] = market_calendar.tradeable_seconds_to_expiry(
+                expiration=q.expiration_date, eval_dts=eval_dts)
+        time_to_expiry[i] = seconds_to_expiry[q.expiration_date] / SECONDS_PER_TRADING_YEAR
+    price = quote_prices(bid=bid, ask=ask, last=last)
+    iv = implied_volatility(price=price, s=underlying_price, k=strike, t=time_to_expiry, r=rate, is_call=is_call)
+    output = {'symbol': symbols, 'price': price, 'time_to_expiry': time_to_expiry, 'iv': iv}
+    output.update(black_scholes_greeks(s=underlying_price, k=strike, t=time_to_expiry, r=rate, sigma=iv,
+                                       is_call=is_call))
+    return output
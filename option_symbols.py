@@ -0,0 +1,172 @@
+import json
+import os
+import re
+import threading
+from bisect import bisect_left
+from datetime import date
+from functools import lru_cache
+from typing import NamedTuple, Union, List, Dict
+from clock import get_clock
+
+
+# OCC option symbol: root (up to 6 chars), expiration YYMMDD, C / P, strike * 1000 padded to 8 digits
+# the api sends them without the space padding of the official format, e.g. SPY230120C00400000
+_OCC_PATTERN = re.compile(r'^([A-Z0-9.]{1,6}) *(\d{6})([CP])(\d{8})$')
+
+
+class OccSymbol(NamedTuple):
+    root: str
+    expiration: date
+    option_type: str
+    strike: float
+
+    @property
+    def expiration_date(self) -> str:
+        # same format as Quote.expiration_date
+        return self.expiration.isoformat()
+
+    @property
+    def is_call(self) -> bool:
+        return self.option_type == 'call'
+
+    @property
+    def symbol(self) -> str:
+        return build_occ_symbol(root=self.root, expiration=self.expiration, option_type=self.option_type,
+                                strike=self.strike)
+
+
+@lru_cache(maxsize=65536)
+def parse_occ_symbol(symbol: str) -> Union[OccSymbol, None]:
+    # None for anything that is not an option symbol (stocks, etfs, ...) so it doubles as a classifier
+    match = _OCC_PATTERN.match(symbol)
+    if match is None:
+        return None
+    root, yymmdd, cp, strike = match.groups()
+    try:
+        expiration = date(2000 + int(yymmdd[:2]), int(yymmdd[2:4]), int(yymmdd[4:]))
+    except ValueError:
+        return None
+    return OccSymbol(root=root, expiration=expiration, option_type='call' if cp == 'C' else 'put',
+                     strike=int(strike) / 1000)
+
+
+@lru_cache(maxsize=65536)
+def build_occ_symbol(root: str, expiration: Union[date, str], option_type: str, strike: float) -> str:
+    if isinstance(expiration, str):
+        expiration = date.fromisoformat(expiration)
+    cp = 'C' if option_type.lower() in ('call', 'c') else 'P'
+    return f'{root.upper()}{expiration.strftime("%y%m%d")}{cp}{int(round(strike * 1000)):08d}'
+
+
+def is_option_symbol(symbol: str) -> bool:
+    return parse_occ_symbol(symbol) is not None
+
+
+class OptionSymbolIndex:
+
+    def __init__(self, api, cache_dir: str = 'option_symbol_cache'):
+        # listed option symbols per underlying, kept in memory and on disk and refreshed once per day
+        # api - TradierApi (only get_option_symbols is used)
+        self.api = api
+        self.cache_dir = cache_dir
+        self._symbols = {}
+        self._loaded_on = {}
+        self._lock = threading.Lock()
+        self.refresh_count = 0
+
+    def _cache_path(self, underlying: str) -> str:
+        return os.path.join(self.cache_dir, f'{underlying.upper()}.json')
+
+    def _load_from_disk(self, underlying: str, today: date) -> Union[List[str], None]:
+        path = self._cache_path(underlying)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            cached = json.load(f)
+        if cached.get('date') != today.isoformat():
+            return None
+        return cached['symbols']
+
+    def _save_to_disk(self, underlying: str, today: date, symbols: List[str]) -> None:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._cache_path(underlying)
+        # write then rename so a crash never leaves a half written file behind
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump({'date': today.isoformat(), 'symbols': symbols}, f, separators=(',', ':'))
+        os.replace(f'{path}.tmp', path)
+
+    def _fetch(self, underlying: str) -> Union[List[str], None]:
+        roots = self.api.get_option_symbols(underlying=underlying)
+        if roots is None:
+            return None
+        symbols = []
+        for root in roots:
+            options = root.get('options') or []
+            symbols += [options] if isinstance(options, str) else options
+        return sorted(symbols)
+
+    def symbols(self, underlying: str) -> List[str]:
+        underlying = underlying.upper()
+        today = get_clock().now().date()
+        with self._lock:
+            if self._loaded_on.get(underlying) == today:
+                return self._symbols[underlying]
+        symbols = self._load_from_disk(underlying=underlying, today=today)
+        if symbols is None:
+            symbols = self._fetch(underlying=underlying)
+            if symbols is None:
+                # keep serving yesterday's list rather than nothing when the refresh fails
+                return self._symbols.get(underlying, [])
+            self._save_to_disk(underlying=underlying, today=today, symbols=symbols)
+            self.refresh_count += 1
+        with self._lock:
+            self._symbols[underlying] = symbols
+            self._loaded_on[underlying] = today
+        return symbols
+
+    def contracts(self, underlying: str, expiration: Union[date, str, None] = None, option_type: Union[str, None] = None,
+                  min_strike: Union[float, None] = None, max_strike: Union[float, None] = None) -> List[OccSymbol]:
+        # chain filter without a chain request - decoded symbols are memoized so repeat calls are cheap
+        if isinstance(expiration, str):
+            expiration = date.fromisoformat(expiration)
+        output = []
+        for symbol in self.symbols(underlying=underlying):
+            occ = parse_occ_symbol(symbol)
+            if occ is None:
+                continue
+            if expiration is not None and occ.expiration != expiration:
+                continue
+            if option_type is not None and occ.option_type != option_type:
+                continue
+            if min_strike is not None and occ.strike < min_strike:
+                continue
+            if max_strike is not None and occ.strike > max_strike:
+                continue
+            output.append(occ)
+        return output
+
+    def expirations(self, underlying: str) -> List[str]:
+        return sorted({occ.expiration_date for occ in self.contracts(underlying=underlying)})
+
+    def strikes(self, underlying: str, expiration: Union[date, str], option_type: str = 'call') -> List[float]:
+        return sorted({occ.strike for occ in self.contracts(underlying=underlying, expiration=expiration,
+                                                            option_type=option_type)})
+
+    def nearest(self, underlying: str, expiration: Union[date, str], option_type: str,
+                strike: float) -> Union[OccSymbol, None]:
+        # listed contract closest to the requested strike, for building orders from a target strike
+        contracts = self.contracts(underlying=underlying, expiration=expiration, option_type=option_type)
+        return min(contracts, key=lambda occ: abs(occ.strike - strike)) if contracts else None
+
+    def is_listed(self, symbol: str, underlying: Union[str, None] = None) -> bool:
+        # underlying defaults to the option root, pass it for roots that differ (e.g. SPXW -> SPX)
+        occ = parse_occ_symbol(symbol)
+        if occ is None:
+            return False
+        symbols = self.symbols(underlying=occ.root if underlying is None else underlying)
+        i = bisect_left(symbols, symbol)
+        return i < len(symbols) and symbols[i] == symbol
+
+    def summary(self) -> Dict[str, int]:
+        with self._lock:
+            return {underlying: len(symbols) for underlying, symbols in self._symbols.items()}
@@ -0,0 +1,211 @@
+import os
+import sys
+import time
+import numpy as np
+from datetime import date, timedelta
+from typing import Union, List, Dict
+from option_symbols import parse_occ_symbol
+from tradier_api import TradierApi
+
+
+# closed position columns - fixed width unicode instead of object arrays so the npz cache loads without pickle
+CLOSED_POSITION_COLUMNS = ('symbol', 'underlying', 'expiration', 'open_date', 'close_date', 'quantity', 'cost',
+                           'proceeds', 'gain_loss')
+HISTORY_COLUMNS = ('date', 'type', 'symbol', 'amount', 'commission')
+
+
+def _datetime64(value: Union[str, None], unit: str = 's') -> np.datetime64:
+    # api timestamps look like 2023-01-20T00:00:00.000Z
+    return np.datetime64('NaT', unit) if not value else np.datetime64(value.rstrip('Z'), unit)
+
+
+def closed_positions_to_columns(records: List[Dict]) -> Dict[str, np.ndarray]:
+    occ = [parse_occ_symbol(r.get('symbol', '')) for r in records]
+    return {'symbol': np.array([r.get('symbol', '') for r in records], dtype='U32'),
+            'underlying': np.array([r.get('symbol', '') if o is None else o.root for r, o in zip(records, occ)],
+                                   dtype='U16'),
+            'expiration': np.array([np.datetime64('NaT', 'D') if o is None else np.datetime64(o.expiration, 'D')
+                                    for o in occ], dtype='datetime64[D]'),
+            'open_date': np.array([_datetime64(r.get('open_date')) for r in records], dtype='datetime64[s]'),
+            'close_date': np.array([_datetime64(r.get('close_date')) for r in records], dtype='datetime64[s]'),
+            'quantity': np.array([r.get('quantity') or 0.0 for r in records], dtype=float),
+            'cost': np.array([r.get('cost') or 0.0 for r in records], dtype=float),
+            'proceeds': np.array([r.get('proceeds') or 0.0 for r in records], dtype=float),
+            'gain_loss': np.array([r.get('gain_loss') or 0.0 for r in records], dtype=float)}
+
+
+def history_to_columns(records: List[Dict]) -> Dict[str, np.ndarray]:
+    # trade / option events keep symbol and commission in a nested dict named after the event type
+    nested = [r.get(r.get('type'), {}) if isinstance(r.get(r.get('type')), dict) else {} for r in records]
+    return {'date': np.array([_datetime64(r.get('date')) for r in records], dtype='datetime64[s]'),
+            'type': np.array([r.get('type', '') for r in records], dtype='U16'),
+            'symbol': np.array([n.get('symbol', '') or '' for n in nested], dtype='U32'),
+            'amount': np.array([r.get('amount') or 0.0 for r in records], dtype=float),
+            'commission': np.array([n.get('commission') or 0.0 for n in nested], dtype=float)}
+
+
+def _concat(a: Dict[str, np.ndarray], b: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    return {k: np.concatenate((a[k], b[k])) for k in a}
+
+
+def _take(columns: Dict[str, np.ndarray], idx) -> Dict[str, np.ndarray]:
+    return {k: v[idx] for k, v in columns.items()}
+
+
+def _fetch_pages(fetch, limit: int = 1000, max_pages: int = 1000, **params) -> List[Dict]:
+    records = []
+    for page in range(1, max_pages + 1):
+        data = fetch(page=str(page), limit=str(limit), **params)
+        if not data:
+            break
+        records += data
+        if len(data) < limit:
+            break
+    return records
+
+
+def group_pnl(keys: np.ndarray, gain_loss: np.ndarray, holding_days: Union[np.ndarray, None] = None) -> Dict[str, np.ndarray]:
+    # one row per distinct key, every statistic is a single bincount over the group index
+    if len(keys) == 0:
+        return {'key': keys, 'trades': np.zeros(0, dtype=int), 'realized': np.zeros(0), 'wins': np.zeros(0, dtype=int),
+                'win_rate': np.zeros(0), 'mean': np.zeros(0), 'gross_profit': np.zeros(0), 'gross_loss': np.zeros(0)}
+    unique, inverse = np.unique(keys, return_inverse=True)
+    n = len(unique)
+    trades = np.bincount(inverse, minlength=n)
+    realized = np.bincount(inverse, weights=gain_loss, minlength=n)
+    wins = np.bincount(inverse, weights=gain_loss > 0, minlength=n).astype(int)
+    output = {'key': unique,
+              'trades': trades,
+              'realized': realized,
+              'wins': wins,
+              'win_rate': wins / trades,
+              'mean': realized / trades,
+              'gross_profit': np.bincount(inverse, weights=np.maximum(gain_loss, 0.0), minlength=n),
+              'gross_loss': np.bincount(inverse, weights=np.minimum(gain_loss, 0.0), minlength=n)}
+    if holding_days is not None:
+        output['mean_holding_days'] = np.bincount(inverse, weights=holding_days, minlength=n) / trades
+    # biggest contributors (either sign) first
+    order = np.argsort(-np.abs(realized), kind='stable')
+    return {k: v[order] for k, v in output.items()}
+
+
+def pnl_report(closed: Dict[str, np.ndarray], history: Union[Dict[str, np.ndarray], None] = None,
+               start: Union[date, None] = None, end: Union[date, None] = None) -> Dict:
+    # realized p&l over closed positions (optionally limited to a close date range)
+    mask = np.ones(len(closed['gain_loss']), dtype=bool)
+    if start is not None:
+        mask &= closed['close_date'] >= np.datetime64(start, 's')
+    if end is not None:
+        mask &= closed['close_date'] < np.datetime64(end + timedelta(days=1), 's')
+    c = _take(closed, mask)
+    gain_loss = c['gain_loss']
+    holding_days = (c['close_date'] - c['open_date']).astype('timedelta64[s]').astype(float) / 86400
+    wins = gain_loss > 0
+    losses = gain_loss < 0
+    gross_profit = float(gain_loss[wins].sum())
+    gross_loss = float(gain_loss[losses].sum())
+    report = {'trades': int(len(gain_loss)),
+              'realized': float(gain_loss.sum()),
+              'win_rate': float(wins.mean()) if len(gain_loss) else 0.0,
+              'average_win': float(gain_loss[wins].mean()) if wins.any() else 0.0,
+              'average_loss': float(gain_loss[losses].mean()) if losses.any() else 0.0,
+              'profit_factor': gross_profit / -gross_loss if gross_loss else (float('inf') if gross_profit else 0.0),
+              'holding_days': {f'p{p}': float(np.percentile(holding_days, p)) if len(holding_days) else 0.0
+                               for p in (10, 25, 50, 75, 90)},
+              'by_symbol': group_pnl(c['symbol'], gain_loss, holding_days),
+              'by_underlying': group_pnl(c['underlying'], gain_loss, holding_days),
+              'by_expiration': group_pnl(c['expiration'][~np.isnat(c['expiration'])],
+                                         gain_loss[~np.isnat(c['expiration'])]),
+              'by_month': group_pnl(c['close_date'].astype('datetime64[M]'), gain_loss)}
+    if history is not None:
+        h_mask = np.ones(len(history['amount']), dtype=bool)
+        if start is not None:
+            h_mask &= history['date'] >= np.datetime64(start, 's')
+        if end is not None:
+            h_mask &= history['date'] < np.datetime64(end + timedelta(days=1), 's')
+        report['commissions'] = float(history['commission'][h_mask].sum())
+        report['fees'] = float(-history['amount'][h_mask & (history['type'] == 'fee')].sum())
+        report['net_realized'] = report['realized'] - report['fees']
+    return report
+
+
+class PnlCache:
+
+    def __init__(self, api: TradierApi, path: str = 'pnl_cache.npz'):
+        # columnar copy of the account's closed positions and history, only new days are fetched on update
+        self.api = api
+        self.path = path
+        self.closed = closed_positions_to_columns([])
+        self.history = history_to_columns([])
+        self.last_update_requests = 0
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self) -> None:
+        with np.load(self.path) as data:
+            self.closed = {k: data[f'closed_{k}'] for k in CLOSED_POSITION_COLUMNS}
+            self.history = {k: data[f'history_{k}'] for k in HISTORY_COLUMNS}
+
+    def _save(self) -> None:
+        arrays = {f'closed_{k}': v for k, v in self.closed.items()}
+        arrays.update({f'history_{k}': v for k, v in self.history.items()})
+        # write then rename so an interrupted save can't corrupt the cache
+        tmp_path = f'{self.path}.tmp.npz'
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _refresh_from(dates: np.ndarray) -> Union[date, None]:
+        # the last cached day is fetched again (it may have been partial), everything before it is final
+        valid = dates[~np.isnat(dates)]
+        return None if not len(valid) else valid.max().astype('datetime64[D]').astype(date)
+
+    def update(self) -> Dict[str, int]:
+        requests_before = self.api.request_count
+        closed_from = self._refresh_from(self.closed['close_date'])
+        params = {} if closed_from is None else {'start': closed_from.isoformat()}
+        new_closed = closed_positions_to_columns(_fetch_pages(self.api.get_account_gain_loss, sortBy='closeDate',
+                                                              sort='asc', **params))
+        if closed_from is not None:
+            self.closed = _take(self.closed, self.closed['close_date'] < np.datetime64(closed_from, 's'))
+            new_closed = _take(new_closed, new_closed['close_date'] >= np.datetime64(closed_from, 's'))
+        self.closed = _concat(self.closed, new_closed)
+        history_from = self._refresh_from(self.history['date'])
+        params = {} if history_from is None else {'start': history_from.isoformat()}
+        new_history = history_to_columns(_fetch_pages(self.api.get_account_history, **params))
+        if history_from is not None:
+            self.history = _take(self.history, self.history['date'] < np.datetime64(history_from, 's'))
+            new_history = _take(new_history, new_history['date'] >= np.datetime64(history_from, 's'))
+        self.history = _concat(self.history, new_history)
+        # sorted by close date so date range filters stay cheap and the cache is deterministic
+        self.closed = _take(self.closed, np.argsort(self.closed['close_date'], kind='stable'))
+        self.history = _take(self.history, np.argsort(self.history['date'], kind='stable'))
+        self._save()
+        self.last_update_requests = self.api.request_count - requests_before
+        return {'closed_positions': len(new_closed['gain_loss']), 'history_events': len(new_history['amount']),
+                'requests': self.last_update_requests}
+
+    def report(self, start: Union[date, None] = None, end: Union[date, None] = None) -> Dict:
+        return pnl_report(closed=self.closed, history=self.history, start=start, end=end)
+
+
+def format_groups(groups: Dict[str, np.ndarray], top: int = 10) -> str:
+    lines = [f"{'key':<24}{'trades':>8}{'realized':>12}{'win %':>8}{'mean':>10}"]
+    for i in range(min(top, len(groups['key']))):
+        lines.append(f"{str(groups['key'][i]):<24}{groups['trades'][i]:>8}{groups['realized'][i]:>12.2f}"
+                     f"{groups['win_rate'][i] * 100:>8.1f}{groups['mean'][i]:>10.2f}")
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    # python pnl_analytics.py [cache path]
+    cache = PnlCache(api=TradierApi.brokerage(), path=sys.argv[1] if len(sys.argv) > 1 else 'pnl_cache.npz')
+    print(f"update: {cache.update()}")
+    report_start = time.perf_counter()
+    pnl = cache.report()
+    print(f"report computed in {round((time.perf_counter() - report_start) * 1e3, 2)} ms")
+    for k in ('trades', 'realized', 'win_rate', 'average_win', 'average_loss', 'profit_factor', 'holding_days',
+              'commissions', 'fees', 'net_realized'):
+        print(f"{k}: {pnl[k]}")
+    for group in ('by_underlying', 'by_expiration', 'by_month'):
+        print(f"\n{group}\n{format_groups(pnl[group])}")
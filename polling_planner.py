@@ -0,0 +1,176 @@
+import heapq
+import math
+import numpy as np
+from typing import Union, List, Dict, Iterable
+from option_pricing import SECONDS_PER_TRADING_YEAR
+
+
+# timestamps come from datetimes (microsecond resolution), anything due within this is due now
+_DUE_SLACK_SEC = 0.001
+
+
+def exit_distance(fields: Dict[str, np.ndarray], profit_target: Union[float, None] = None) -> np.ndarray:
+    # relative price move (fraction of last) still needed to reach the nearest exit level - profit target or trailing stop
+    # nan where there is no price yet
+    last = fields['last']
+    distance = np.full(len(last), np.inf)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if profit_target is not None:
+            target_price = fields['unit_cost'] * (1 + profit_target)
+            distance = np.fmin(distance, np.abs(target_price - last) / last)
+        if 'trailing_stop' in fields:
+            distance = np.fmin(distance, np.abs(last - fields['trailing_stop']) / last)
+    distance[~np.isfinite(last) | (last <= 0)] = np.nan
+    return distance
+
+
+class PollingPlanner:
+
+    def __init__(self, min_interval_sec: float = 0.5, max_interval_sec: float = 30.0, max_requests_per_min: float = 20,
+                 max_symbols_per_request: int = 200, trigger_sigmas: float = 3.0, default_volatility: float = 2.0,
+                 near_expiry_sec: float = 3600.0, coalesce_fraction: float = 0.5,
+                 profit_target: Union[float, None] = None):
+        # every symbol gets its own refresh interval - the time a trigger_sigmas move (at the symbol's realized
+        # volatility) needs to cover the distance to its exit level, shortened in the last near_expiry_sec of trading
+        # due symbols are packed into as few quote requests as possible, and the requests are held to
+        # max_requests_per_min no matter how many symbols want to be fresh
+        self.min_interval_sec = min_interval_sec
+        self.max_interval_sec = max_interval_sec
+        self.max_requests_per_min = max_requests_per_min
+        self.max_symbols_per_request = max_symbols_per_request
+        self.trigger_sigmas = trigger_sigmas
+        self.default_volatility = default_volatility
+        self.near_expiry_sec = near_expiry_sec
+        self.coalesce_fraction = coalesce_fraction
+        self.profit_target = profit_target
+        # heap of (due ts, symbol) - entries whose due ts no longer matches _due are stale and skipped when popped
+        self._heap = []
+        self._due = {}
+        self._interval = {}
+        self._last_polled = {}
+        # token bucket on the caller's timestamps (so it follows a simulated clock), 10 seconds worth of burst
+        self._capacity = max(1.0, max_requests_per_min / 6)
+        self._tokens = self._capacity
+        self._tokens_ts = None
+        self.requests = 0
+        self.symbols_polled = 0
+        self.deferred = 0
+
+    def _schedule(self, symbol: str, due_ts: float) -> None:
+        self._due[symbol] = due_ts
+        heapq.heappush(self._heap, (due_ts, symbol))
+
+    def _peek(self) -> Union[float, None]:
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def _refill(self, now: float) -> None:
+        if self._tokens_ts is not None:
+            self._tokens = min(self._capacity,
+                               self._tokens + (now - self._tokens_ts) * self.max_requests_per_min / 60)
+        self._tokens_ts = now
+
+    @property
+    def symbols(self) -> List[str]:
+        return list(self._due.keys())
+
+    def sync(self, symbols: Iterable[str], now: float) -> None:
+        # new symbols are due right away, symbols no longer held are forgotten
+        symbols = set(symbols)
+        for symbol in symbols:
+            if symbol not in self._due:
+                self._interval[symbol] = self.min_interval_sec
+                self._schedule(symbol=symbol, due_ts=now)
+        for symbol in [s for s in self._due if s not in symbols]:
+            del self._due[symbol]
+            self._interval.pop(symbol, None)
+            self._last_polled.pop(symbol, None)
+        # stale entries would otherwise pile up when symbols keep changing
+        if len(self._heap) > 4 * len(self._due) + 64:
+            self._heap = [(due_ts, s) for s, due_ts in self._due.items()]
+            heapq.heapify(self._heap)
+
+    def intervals(self, fields: Dict[str, np.ndarray]) -> np.ndarray:
+        # refresh interval per row of position_fields()
+        distance = exit_distance(fields=fields, profit_target=self.profit_target)
+        volatility = fields.get('realized_vol', np.full(len(distance), np.nan))
+        volatility = np.where(np.isfinite(volatility) & (volatility > 0), volatility, self.default_volatility)
+        sigma_per_sqrt_sec = volatility / math.sqrt(SECONDS_PER_TRADING_YEAR)
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            interval = (distance / (self.trigger_sigmas * sigma_per_sqrt_sec)) ** 2
+        # no price yet - poll as soon as allowed
+        interval = np.where(np.isnan(distance), self.min_interval_sec, interval)
+        if 'seconds_to_expiry' in fields:
+            to_expiry = fields['seconds_to_expiry']
+            near = np.isfinite(to_expiry) & (to_expiry < self.near_expiry_sec)
+            interval = np.where(near, np.minimum(interval, self.max_interval_sec * to_expiry / self.near_expiry_sec),
+                                interval)
+        # stock positions have no exit rule to race, they only need the slow refresh
+        if 'is_option' in fields:
+            interval = np.where(fields['is_option'], interval, self.max_interval_sec)
+        return np.clip(interval, self.min_interval_sec, self.max_interval_sec)
+
+    def due(self, now: float) -> List[str]:
+        # symbols to request now (empty while nothing is due or the request quota is used up)
+        # symbols that are due soon ride along in the same request, since filling a request costs nothing extra
+        next_due = self._peek()
+        if next_due is None or next_due > now + _DUE_SLACK_SEC:
+            return []
+        self._refill(now=now)
+        if self._tokens < 1:
+            self.deferred += 1
+            return []
+        max_symbols = int(self._tokens) * self.max_symbols_per_request
+        due = []
+        coalesce = []
+        for symbol, due_ts in sorted(self._due.items(), key=lambda item: item[1]):
+            if due_ts <= now + _DUE_SLACK_SEC:
+                due.append(symbol)
+            elif due_ts - now <= self.coalesce_fraction * self._interval.get(symbol, self.min_interval_sec):
+                coalesce.append(symbol)
+            if len(due) >= max_symbols:
+                break
+        # most overdue first, the rest of the quota is only used to fill up requests that go out anyway
+        n_requests = math.ceil(len(due) / self.max_symbols_per_request)
+        polled = (due + coalesce)[:n_requests * self.max_symbols_per_request]
+        self._tokens -= n_requests
+        for symbol in polled:
+            self._last_polled[symbol] = now
+            # polled symbols are rescheduled by update(), until then they are not due again
+            self._schedule(symbol=symbol, due_ts=now + self._interval.get(symbol, self.min_interval_sec))
+        self.requests += n_requests
+        self.symbols_polled += len(polled)
+        return polled
+
+    def update(self, symbols: List[str], intervals: np.ndarray, now: float, failed: Iterable[str] = ()) -> None:
+        # new intervals from the latest prices - a shorter interval also pulls an already scheduled poll forward
+        failed = set(failed)
+        for symbol, interval in zip(symbols, intervals):
+            if symbol not in self._due:
+                continue
+            self._interval[symbol] = self.min_interval_sec if symbol in failed else float(interval)
+            last_polled = self._last_polled.get(symbol)
+            if last_polled == now:
+                self._schedule(symbol=symbol, due_ts=now + self._interval[symbol])
+            elif last_polled is not None and last_polled + self._interval[symbol] < self._due[symbol]:
+                self._schedule(symbol=symbol, due_ts=max(now, last_polled + self._interval[symbol]))
+
+    def seconds_until_next(self, now: float) -> float:
+        # how long the loop can sleep before the next request is both due and within the quota
+        next_due = self._peek()
+        if next_due is None:
+            return self.max_interval_sec
+        self._refill(now=now)
+        quota_wait = 0.0 if self._tokens >= 1 else (1 - self._tokens) * 60 / self.max_requests_per_min
+        return max(next_due - now, quota_wait, 0.0)
+
+    def stats(self) -> Dict[str, float]:
+        intervals = list(self._interval.values())
+        return {'symbols': len(self._due),
+                'requests': self.requests,
+                'symbols_polled': self.symbols_polled,
+                'symbols_per_request': round(self.symbols_polled / self.requests, 2) if self.requests else 0.0,
+                'deferred': self.deferred,
+                'min_interval_sec': round(min(intervals), 3) if intervals else None,
+                'median_interval_sec': round(float(np.median(intervals)), 3) if intervals else None}
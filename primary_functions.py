@@ -1,14 +1,38 @@
-import time
-
-
-def wait(sleep_time_sec: int = 5) -> None:
-    time.sleep(sleep_time_sec)
-
-
-
-
-
-
-
-
-
+import math
+from datetime import datetime
+from typing import List, Tuple, Union
+from clock import get_clock
+
+
+def wait(sleep_time_sec: float = 5, wake_at: Union[datetime, None] = None) -> None:
+    # wake_at cuts the wait short so the caller wakes up exactly at the next event (e.g. a market state change)
+    clock = get_clock()
+    if wake_at is not None:
+        sleep_time_sec = min(sleep_time_sec, max(0.0, (wake_at - clock.now()).total_seconds()))
+    clock.sleep(sleep_time_sec)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    # nearest-rank percentile, pct in the range 0 - 100
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[idx]
+
+
+def option_profit_pct(position, quote) -> float:
+    option_purchase_price = position.unit_cost() / 100
+    option_current_price = quote.last
+    return (option_current_price - option_purchase_price) / option_purchase_price
+
+
+def get_option_positions_to_close(positions, quotes, profit_target: float = 0.20) -> List[Tuple]:
+    # positions and quotes are expected in the same order (as returned by get_quotes)
+    output = []
+    for quo, pos in zip(quotes, positions):
+        if quo.symbol == pos.symbol and quo.type == 'option' and quo.last is not None:
+            profit_pct = option_profit_pct(position=pos, quote=quo)
+            if profit_pct >= profit_target:
+                output.append((pos, quo, profit_pct))
+    return output
@@ -0,0 +1,189 @@
+import math
+import numpy as np
+from collections import deque
+from typing import Union, List, Dict
+from clock import get_clock
+from option_pricing import SECONDS_PER_TRADING_YEAR
+
+
+class QuoteRingBuffer:
+
+    def __init__(self, capacity: int = 1024, ema_span: int = 20, trailing_stop_pct: float = 0.10):
+        # fixed memory per symbol - the oldest tick is overwritten once the buffer is full
+        self.capacity = capacity
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.last = np.zeros(capacity, dtype=np.float64)
+        self.bid = np.zeros(capacity, dtype=np.float64)
+        self.ask = np.zeros(capacity, dtype=np.float64)
+        self.volume = np.zeros(capacity, dtype=np.float64)
+        self.tick_volume = np.zeros(capacity, dtype=np.float64)
+        self.log_returns = np.zeros(capacity, dtype=np.float64)
+        self.count = 0
+        self._seq = 0
+        # incremental indicator state - every append is O(1) (amortized for the rolling high / low)
+        self.ema_alpha = 2.0 / (ema_span + 1)
+        self.ema = None
+        self.trailing_stop_pct = trailing_stop_pct
+        self.trailing_high = None
+        self._pv_sum = 0.0
+        self._v_sum = 0.0
+        self._r_sum = 0.0
+        self._r2_sum = 0.0
+        self._max_deque = deque()
+        self._min_deque = deque()
+
+    def _idx(self, seq: int) -> int:
+        return seq % self.capacity
+
+    def append(self, ts: float, last: float, bid: Union[float, None] = None, ask: Union[float, None] = None,
+               volume: Union[float, None] = None) -> None:
+        if last is None:
+            return
+        bid = np.nan if bid is None else bid
+        ask = np.nan if ask is None else ask
+        volume = 0.0 if volume is None else volume
+        prev_idx = self._idx(self._seq - 1)
+        # volume from the api is cumulative for the day, the difference is what traded since the last poll
+        if self.count == 0:
+            tick_volume = 0.0
+            log_return = 0.0
+        else:
+            tick_volume = volume - self.volume[prev_idx] if volume >= self.volume[prev_idx] else volume
+            prev_last = self.last[prev_idx]
+            log_return = math.log(last / prev_last) if last > 0 and prev_last > 0 else 0.0
+        idx = self._idx(self._seq)
+        if self.count == self.capacity:
+            # evict the oldest tick from the running sums
+            self._pv_sum -= self.last[idx] * self.tick_volume[idx]
+            self._v_sum -= self.tick_volume[idx]
+            # the oldest stored return belongs to a pair that is no longer fully in the window
+            oldest_return = self.log_returns[self._idx(self._seq + 1)]
+            self._r_sum -= oldest_return
+            self._r2_sum -= oldest_return * oldest_return
+        else:
+            self.count += 1
+        self.timestamps[idx] = ts
+        self.last[idx] = last
+        self.bid[idx] = bid
+        self.ask[idx] = ask
+        self.volume[idx] = volume
+        self.tick_volume[idx] = tick_volume
+        self.log_returns[idx] = log_return
+        self._pv_sum += last * tick_volume
+        self._v_sum += tick_volume
+        self._r_sum += log_return
+        self._r2_sum += log_return * log_return
+        first_seq = self._seq - self.count + 1
+        while self._max_deque and self._max_deque[-1][1] <= last:
+            self._max_deque.pop()
+        self._max_deque.append((self._seq, last))
+        while self._max_deque[0][0] < first_seq:
+            self._max_deque.popleft()
+        while self._min_deque and self._min_deque[-1][1] >= last:
+            self._min_deque.pop()
+        self._min_deque.append((self._seq, last))
+        while self._min_deque[0][0] < first_seq:
+            self._min_deque.popleft()
+        self.ema = last if self.ema is None else self.ema + self.ema_alpha * (last - self.ema)
+        self.trailing_high = last if self.trailing_high is None else max(self.trailing_high, last)
+        self._seq += 1
+        if self._seq % self.capacity == 0:
+            # re-sum once per buffer cycle so floating point drift in the running sums can't build up
+            self._resync()
+
+    def _resync(self) -> None:
+        tick_volume = self.window('tick_volume')
+        self._pv_sum = float(np.dot(self.window('last'), tick_volume))
+        self._v_sum = float(tick_volume.sum())
+        returns = self.window('log_returns')[1:]
+        self._r_sum = float(returns.sum())
+        self._r2_sum = float(np.dot(returns, returns))
+
+    def window(self, field: str = 'last') -> np.ndarray:
+        # chronological copy of a stored column
+        data = getattr(self, field)
+        if self.count < self.capacity:
+            return data[:self.count].copy()
+        start = self._idx(self._seq)
+        return np.concatenate((data[start:], data[:start]))
+
+    @property
+    def latest(self) -> Union[float, None]:
+        return None if self.count == 0 else float(self.last[self._idx(self._seq - 1)])
+
+    @property
+    def latest_ts(self) -> Union[float, None]:
+        return None if self.count == 0 else float(self.timestamps[self._idx(self._seq - 1)])
+
+    @property
+    def vwap(self) -> Union[float, None]:
+        return None if self._v_sum <= 0 else self._pv_sum / self._v_sum
+
+    @property
+    def rolling_high(self) -> Union[float, None]:
+        return None if not self._max_deque else self._max_deque[0][1]
+
+    @property
+    def rolling_low(self) -> Union[float, None]:
+        return None if not self._min_deque else self._min_deque[0][1]
+
+    @property
+    def trailing_stop(self) -> Union[float, None]:
+        return None if self.trailing_high is None else self.trailing_high * (1 - self.trailing_stop_pct)
+
+    def reset_trailing_stop(self) -> None:
+        self.trailing_high = self.latest
+
+    def realized_volatility(self, annualize: bool = True) -> Union[float, None]:
+        # standard deviation of the log returns in the window, optionally scaled to a trading year
+        n = self.count - 1
+        if n < 2:
+            return None
+        variance = max(0.0, (self._r2_sum - self._r_sum * self._r_sum / n) / (n - 1))
+        if not annualize:
+            return math.sqrt(variance)
+        first_ts = self.timestamps[self._idx(self._seq - self.count)]
+        mean_interval = (self.latest_ts - first_ts) / n
+        if mean_interval <= 0:
+            return None
+        return math.sqrt(variance * SECONDS_PER_TRADING_YEAR / mean_interval)
+
+
+class QuoteHistory:
+
+    def __init__(self, capacity: int = 1024, ema_span: int = 20, trailing_stop_pct: float = 0.10):
+        self.capacity = capacity
+        self.ema_span = ema_span
+        self.trailing_stop_pct = trailing_stop_pct
+        self._buffers = {}
+
+    def get(self, symbol: str) -> Union[QuoteRingBuffer, None]:
+        return self._buffers.get(symbol)
+
+    def __getitem__(self, symbol: str) -> QuoteRingBuffer:
+        buffer = self._buffers.get(symbol)
+        if buffer is None:
+            buffer = QuoteRingBuffer(capacity=self.capacity, ema_span=self.ema_span,
+                                     trailing_stop_pct=self.trailing_stop_pct)
+            self._buffers[symbol] = buffer
+        return buffer
+
+    def __contains__(self, symbol: str) -> bool:
+        return symbol in self._buffers
+
+    @property
+    def symbols(self) -> List[str]:
+        return list(self._buffers.keys())
+
+    def update(self, quotes: Union[List, Dict], ts: Union[float, None] = None) -> None:
+        # quotes - a list of Quote objects or a symbol -> Quote mapping (as from get_quotes_batched)
+        if ts is None:
+            ts = get_clock().timestamp()
+        if isinstance(quotes, dict):
+            quotes = quotes.values()
+        for q in quotes:
+            if q is not None and q.last is not None:
+                self[q.symbol].append(ts=ts, last=q.last, bid=q.bid, ask=q.ask, volume=q.volume)
+
+    def drop(self, symbol: str) -> None:
+        self._buffers.pop(symbol, None)
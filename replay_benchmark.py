@@ -0,0 +1,68 @@
+import sys
+import time
+from typing import Union, List
+from tradier_api import TradierApi, MarketCalendar
+from primary_functions import percentile, wait
+from clock import set_clock
+from rule_engine import RuleEngine, position_fields
+from main import default_exit_rules
+
+
+def run_replay_benchmark(path: Union[str, List[str]], api: Union[TradierApi, None] = None, poll_interval_sec: float = 5,
+                         profit_target: float = 0.20, exit_rules: Union[RuleEngine, None] = None,
+                         market_calendar: Union[MarketCalendar, None] = None) -> dict:
+    # replays a recorded session through the exit logic of run_main_loop (batched quotes, position fields, exit
+    # rules), stepping the virtual clock one poll interval per tick
+    # the client must be for the same account the session was recorded with (urls include the account id)
+    if api is None:
+        api = TradierApi.brokerage()
+    if exit_rules is None:
+        exit_rules = default_exit_rules(option_profit_target=profit_target)
+    replayer = api.use_replay(path=path)
+    previous_clock = set_clock(replayer.clock)
+    tick_latencies = []
+    decision_latencies = []
+    n_ticks = 0
+    n_sell_decisions = 0
+    try:
+        bench_start = time.perf_counter()
+        while not replayer.finished:
+            tick_start = time.perf_counter()
+            positions = api.get_account_positions()
+            if positions:
+                quotes = api.get_quotes_batched(symbols=positions)
+                if quotes:
+                    decision_start = time.perf_counter()
+                    fields = position_fields(positions=positions, quotes=quotes, market_calendar=market_calendar,
+                                             eval_dts=replayer.now())
+                    exit_signals = exit_rules.first_triggered(fields=fields)
+                    decision_latencies.append(time.perf_counter() - decision_start)
+                    n_sell_decisions += sum(signal is not None for signal in exit_signals)
+            tick_latencies.append(time.perf_counter() - tick_start)
+            n_ticks += 1
+            wait(sleep_time_sec=poll_interval_sec)
+        bench_elapsed = time.perf_counter() - bench_start
+    finally:
+        api.stop_replay()
+        set_clock(previous_clock)
+    return {'ticks': n_ticks,
+            'simulated_seconds': n_ticks * poll_interval_sec,
+            'elapsed_seconds': bench_elapsed,
+            'ticks_per_second': n_ticks / bench_elapsed if bench_elapsed else 0.0,
+            'tick_latency_p50_us': percentile(tick_latencies, 50) * 1e6,
+            'tick_latency_p99_us': percentile(tick_latencies, 99) * 1e6,
+            'decision_latency_p50_us': percentile(decision_latencies, 50) * 1e6,
+            'decision_latency_p99_us': percentile(decision_latencies, 99) * 1e6,
+            'sell_decisions': n_sell_decisions,
+            'requests_served': replayer.request_count,
+            'requests_missed': replayer.miss_count}
+
+
+if __name__ == '__main__':
+    # python replay_benchmark.py <recording.jsonl.gz>[,<recording.jsonl.gz>...] [poll_interval_sec] [profit_target]
+    recording_path = sys.argv[1].split(',')
+    interval = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    target = float(sys.argv[3]) if len(sys.argv) > 3 else 0.20
+    report = run_replay_benchmark(path=recording_path, poll_interval_sec=interval, profit_target=target)
+    for k, v in report.items():
+        print(f"{k}: {round(v, 3) if isinstance(v, float) else v}")
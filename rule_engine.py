@@ -0,0 +1,189 @@
+import ast
+import time
+import numpy as np
+from datetime import datetime
+from typing import Union, List, Dict
+from clock import get_clock
+from option_symbols import parse_occ_symbol
+
+
+# functions that may be used inside rule expressions (all work element-wise on arrays)
+_RULE_FUNCTIONS = {'abs': np.abs, 'minimum': np.minimum, 'maximum': np.maximum, 'where': np.where,
+                   'isnan': np.isnan, 'log': np.log, 'sqrt': np.sqrt}
+_ALLOWED_NODES = (ast.Expression, ast.BoolOp, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Name, ast.Load,
+                  ast.Constant, ast.Call, ast.And, ast.Or, ast.Not, ast.USub, ast.UAdd, ast.Invert, ast.Add,
+                  ast.Sub, ast.Mult, ast.Div, ast.Mod, ast.Pow, ast.BitAnd, ast.BitOr, ast.Eq, ast.NotEq, ast.Lt,
+                  ast.LtE, ast.Gt, ast.GtE)
+
+
+class _VectorizeBooleans(ast.NodeTransformer):
+    # 'and' / 'or' / 'not' / chained comparisons don't work on arrays, rewrite them as & | == 0 and &
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        op = ast.BitAnd() if isinstance(node.op, ast.And) else ast.BitOr()
+        output = node.values[0]
+        for value in node.values[1:]:
+            output = ast.BinOp(left=output, op=op, right=value)
+        return output
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            # not ~ on the operand - that is a bitwise not on ints and a TypeError on floats
+            return ast.Compare(left=node.operand, ops=[ast.Eq()], comparators=[ast.Constant(value=0)])
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) == 1:
+            return node
+        left = node.left
+        output = None
+        for op, right in zip(node.ops, node.comparators):
+            part = ast.Compare(left=left, ops=[op], comparators=[right])
+            output = part if output is None else ast.BinOp(left=output, op=ast.BitAnd(), right=part)
+            left = right
+        return output
+
+
+def compile_expression(expression: str):
+    tree = ast.parse(expression, mode='eval')
+    for node in ast.walk(tree):
+        if not isinstance(node, _ALLOWED_NODES):
+            raise ValueError(f"Unsupported syntax in rule expression '{expression}': {type(node).__name__}")
+        if isinstance(node, ast.Call) and not (isinstance(node.func, ast.Name) and node.func.id in _RULE_FUNCTIONS):
+            raise ValueError(f"Unsupported function in rule expression '{expression}'")
+    tree = ast.fix_missing_locations(_VectorizeBooleans().visit(tree))
+    names = {node.id for node in ast.walk(tree) if isinstance(node, ast.Name)} - set(_RULE_FUNCTIONS)
+    return compile(tree, filename=f'<rule: {expression}>', mode='eval'), names
+
+
+def evaluate_compiled(code, fields: Dict[str, np.ndarray]):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return eval(code, {'__builtins__': {}}, dict(_RULE_FUNCTIONS, **fields))
+
+
+class Rule:
+
+    def __init__(self, name: str, expression: str):
+        # expression over field names, e.g. "is_option and profit_pct >= 0.20"
+        self.name = name
+        self.expression = expression
+        self._code, self.fields = compile_expression(expression)
+        self.evaluations = 0
+        self.rows_evaluated = 0
+        self.total_time_sec = 0.0
+
+    def evaluate(self, fields: Dict[str, np.ndarray], n_rows: int) -> np.ndarray:
+        missing = self.fields - set(fields)
+        if missing:
+            raise KeyError(f"Rule {self.name} uses unknown fields: {sorted(missing)}")
+        start = time.perf_counter()
+        mask = evaluate_compiled(code=self._code, fields=fields)
+        # comparisons against nan (missing data) are False - use isnan() in the expression where that matters
+        mask = np.broadcast_to(np.asarray(mask, dtype=bool), (n_rows,))
+        self.total_time_sec += time.perf_counter() - start
+        self.evaluations += 1
+        self.rows_evaluated += n_rows
+        return mask
+
+    def __repr__(self):
+        return f'Rule(name={self.name}, expression={self.expression})'
+
+
+class RuleEngine:
+
+    def __init__(self, rules: Union[List[Rule], None] = None):
+        # rules are checked in order - the first one that matches a row is reported for that row
+        self.rules = [] if rules is None else list(rules)
+
+    def add_rule(self, name: str, expression: str) -> Rule:
+        rule = Rule(name=name, expression=expression)
+        self.rules.append(rule)
+        return rule
+
+    def evaluate(self, fields: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        n_rows = len(next(iter(fields.values()))) if fields else 0
+        return {rule.name: rule.evaluate(fields=fields, n_rows=n_rows) for rule in self.rules}
+
+    def first_triggered(self, fields: Dict[str, np.ndarray]) -> np.ndarray:
+        # name of the first matching rule per row, None where nothing matched
+        masks = self.evaluate(fields=fields)
+        n_rows = len(next(iter(fields.values()))) if fields else 0
+        output = np.full(n_rows, None, dtype=object)
+        for rule in reversed(self.rules):
+            output[masks[rule.name]] = rule.name
+        return output
+
+    def stats(self) -> List[Dict]:
+        # per rule timing so expensive rules are easy to spot
+        return [{'rule': rule.name,
+                 'evaluations': rule.evaluations,
+                 'rows': rule.rows_evaluated,
+                 'total_ms': rule.total_time_sec * 1e3,
+                 'mean_us': rule.total_time_sec / rule.evaluations * 1e6 if rule.evaluations else 0.0}
+                for rule in sorted(self.rules, key=lambda r: r.total_time_sec, reverse=True)]
+
+
+def _column(values: List, dtype=float) -> np.ndarray:
+    return np.array([np.nan if v is None else v for v in values], dtype=dtype)
+
+
+def position_fields(positions: List, quotes: Dict, market_calendar=None, eval_dts: Union[datetime, None] = None,
+                    quote_history=None) -> Dict[str, np.ndarray]:
+    # columnar view of positions joined with their quotes (symbol -> Quote, as from get_quotes_batched)
+    # plus calendar and quote history fields - everything a rule expression can refer to
+    if eval_dts is None:
+        eval_dts = get_clock().now()
+    n = len(positions)
+    matched = [quotes.get(p.symbol) for p in positions]
+    # option details come from the (memoized) symbol decode, so they are there even when a quote is missing
+    occ = [parse_occ_symbol(p.symbol) for p in positions]
+    is_option = np.array([o is not None for o in occ], dtype=bool)
+    quantity = _column([p.quantity for p in positions])
+    cost_basis = _column([p.cost_basis for p in positions])
+    # option cost basis is per contract (100 shares)
+    unit_cost = cost_basis / quantity / np.where(is_option, 100.0, 1.0)
+    last = _column([None if q is None else q.last for q in matched])
+    bid = _column([None if q is None else q.bid for q in matched])
+    ask = _column([None if q is None else q.ask for q in matched])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        profit_pct = (last - unit_cost) / unit_cost
+    fields = {'quantity': quantity,
+              'cost_basis': cost_basis,
+              'unit_cost': unit_cost,
+              'last': last,
+              'bid': bid,
+              'ask': ask,
+              'mid': (bid + ask) / 2,
+              'profit_pct': profit_pct,
+              'is_option': is_option,
+              'is_long': quantity > 0,
+              'strike': _column([None if o is None else o.strike for o in occ]),
+              'is_call': np.array([o is not None and o.is_call for o in occ], dtype=bool),
+              'days_held': _column([(eval_dts - p.date_acquired).total_seconds() / 86400 for p in positions]),
+              'weekday': np.full(n, eval_dts.isoweekday()),
+              'is_friday': np.full(n, eval_dts.isoweekday() == 5)}
+    if market_calendar is not None:
+        today = market_calendar.get_day(day=eval_dts)
+        seconds_to_close = np.nan
+        if today is not None and today.is_market_day() and today.market_close > eval_dts:
+            seconds_to_close = (today.market_close - eval_dts).total_seconds()
+        fields['seconds_to_close'] = np.full(n, seconds_to_close)
+        to_expiry = {}
+        for o in occ:
+            if o is not None and o.expiration_date not in to_expiry:
+                to_expiry[o.expiration_date] = market_calendar.tradeable_seconds_to_expiry(
+                    expiration=o.expiration_date, eval_dts=eval_dts)
+        fields['seconds_to_expiry'] = _column([None if o is None else to_expiry[o.expiration_date] for o in occ])
+        fields['hours_to_expiry'] = fields['seconds_to_expiry'] / 3600
+    if quote_history is not None:
+        buffers = [quote_history.get(p.symbol) for p in positions]
+        fields['ema'] = _column([None if b is None else b.ema for b in buffers])
+        fields['vwap'] = _column([None if b is None else b.vwap for b in buffers])
+        fields['rolling_high'] = _column([None if b is None else b.rolling_high for b in buffers])
+        fields['rolling_low'] = _column([None if b is None else b.rolling_low for b in buffers])
+        fields['trailing_stop'] = _column([None if b is None else b.trailing_stop for b in buffers])
+        fields['realized_vol'] = _column([None if b is None else b.realized_volatility() for b in buffers])
+    return fields
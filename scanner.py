@@ -0,0 +1,184 @@
+import contextvars
+import logging
+import sys
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Union, List, Dict
+from app_logging import get_online_logger
+from clock import get_clock
+from deadline import time_budget
+from option_pricing import chain_greeks, SECONDS_PER_TRADING_YEAR
+from primary_functions import wait
+from rule_engine import RuleEngine, Rule, compile_expression, evaluate_compiled
+from tradier_api import TradierApi, MarketCalendar, Quote
+
+
+scanner_logger = logging.getLogger('scanner')
+
+# default screens - override with RuleEngine / expressions of your own
+DEFAULT_UNDERLYING_RULES = [Rule(name='liquid_underlying',
+                                 expression='last >= 5 and average_volume >= 1000000 and spread_pct <= 0.002')]
+DEFAULT_CONTRACT_RULES = [Rule(name='liquid_contract',
+                               expression='open_interest >= 100 and spread_pct <= 0.10 and '
+                                          'abs(delta) >= 0.30 and abs(delta) <= 0.60')]
+DEFAULT_RANK_EXPRESSION = 'open_interest * abs(delta) / (spread_pct + 0.01)'
+
+
+def _column(values: List, dtype=float) -> np.ndarray:
+    return np.array([np.nan if v is None else v for v in values], dtype=dtype)
+
+
+def underlying_fields(quotes: List[Quote]) -> Dict[str, np.ndarray]:
+    last = _column([q.last for q in quotes])
+    bid = _column([q.bid for q in quotes])
+    ask = _column([q.ask for q in quotes])
+    volume = _column([q.volume for q in quotes])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        spread_pct = (ask - bid) / ((ask + bid) / 2)
+    return {'last': last,
+            'bid': bid,
+            'ask': ask,
+            'spread_pct': spread_pct,
+            'volume': volume,
+            'dollar_volume': volume * last,
+            'average_volume': _column([q.average_volume for q in quotes]),
+            'change_percentage': _column([q.change_percentage for q in quotes]),
+            'prevclose': _column([q.prevclose for q in quotes]),
+            'week_52_high': _column([q.week_52_high for q in quotes]),
+            'week_52_low': _column([q.week_52_low for q in quotes])}
+
+
+def contract_fields(contracts: List[Quote], underlying_price: float, market_calendar: MarketCalendar,
+                    eval_dts: Union[datetime, None] = None) -> Dict[str, np.ndarray]:
+    fields = chain_greeks(quotes=contracts, underlying_price=underlying_price, market_calendar=market_calendar,
+                          eval_dts=eval_dts)
+    bid = _column([q.bid for q in contracts])
+    ask = _column([q.ask for q in contracts])
+    strike = _column([q.strike for q in contracts])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fields['spread_pct'] = (ask - bid) / ((ask + bid) / 2)
+    fields.update({'bid': bid,
+                   'ask': ask,
+                   'strike': strike,
+                   'moneyness': strike / underlying_price,
+                   'volume': _column([q.volume for q in contracts]),
+                   'open_interest': _column([q.open_interest for q in contracts]),
+                   'is_call': np.array([q.option_type == 'call' for q in contracts], dtype=bool),
+                   'hours_to_expiry': fields['time_to_expiry'] * SECONDS_PER_TRADING_YEAR / 3600})
+    return fields
+
+
+class WatchlistScanner:
+
+    def __init__(self, api: TradierApi, market_calendar: MarketCalendar,
+                 underlying_rules: Union[RuleEngine, None] = None, contract_rules: Union[RuleEngine, None] = None,
+                 rank_expression: str = DEFAULT_RANK_EXPRESSION, min_days_to_expiry: int = 7,
+                 max_days_to_expiry: int = 45, cycle_budget_sec: float = 20.0, max_workers: int = 4,
+                 max_candidates: int = 50):
+        self.api = api
+        self.market_calendar = market_calendar
+        self.underlying_rules = RuleEngine(DEFAULT_UNDERLYING_RULES) if underlying_rules is None else underlying_rules
+        self.contract_rules = RuleEngine(DEFAULT_CONTRACT_RULES) if contract_rules is None else contract_rules
+        self.rank_expression = rank_expression
+        self._rank_code, _ = compile_expression(rank_expression)
+        self.min_days_to_expiry = min_days_to_expiry
+        self.max_days_to_expiry = max_days_to_expiry
+        self.cycle_budget_sec = cycle_budget_sec
+        self.max_workers = max_workers
+        self.max_candidates = max_candidates
+        self.last_cycle_stats = {}
+
+    def screen_underlyings(self, watchlist: List[str]) -> List[Quote]:
+        quotes = self.api.get_quotes_batched(symbols=watchlist, max_workers=self.max_workers)
+        quotes = [q for q in quotes.values() if q is not None and q.type in ('stock', 'etf', 'index')]
+        if not quotes:
+            return []
+        masks = self.underlying_rules.evaluate(fields=underlying_fields(quotes=quotes))
+        passed = np.logical_and.reduce(list(masks.values())) if masks else np.ones(len(quotes), dtype=bool)
+        return [q for q, ok in zip(quotes, passed) if ok]
+
+    def _expirations_in_range(self, symbol: str, eval_dts: datetime) -> List[str]:
+        expirations = self.api.get_option_expirations(symbol=symbol) or []
+        first = (eval_dts + timedelta(days=self.min_days_to_expiry)).date().isoformat()
+        last = (eval_dts + timedelta(days=self.max_days_to_expiry)).date().isoformat()
+        return [e for e in expirations if first <= e <= last]
+
+    def _scan_underlying(self, underlying: Quote, eval_dts: datetime) -> List[Dict]:
+        candidates = []
+        for expiration in self._expirations_in_range(symbol=underlying.symbol, eval_dts=eval_dts):
+            contracts = self.api.get_option_chains(symbol=underlying.symbol, expiration=expiration, greeks='false')
+            if not contracts:
+                continue
+            fields = contract_fields(contracts=contracts, underlying_price=underlying.last,
+                                     market_calendar=self.market_calendar, eval_dts=eval_dts)
+            masks = self.contract_rules.evaluate(fields=fields)
+            passed = np.logical_and.reduce(list(masks.values())) if masks else np.ones(len(contracts), dtype=bool)
+            if not passed.any():
+                continue
+            score = np.broadcast_to(evaluate_compiled(code=self._rank_code, fields=fields), (len(contracts),))
+            for i in np.nonzero(passed & np.isfinite(score))[0]:
+                candidates.append({'underlying': underlying.symbol,
+                                   'symbol': contracts[i].symbol,
+                                   'expiration': expiration,
+                                   'option_type': contracts[i].option_type,
+                                   'strike': contracts[i].strike,
+                                   'bid': contracts[i].bid,
+                                   'ask': contracts[i].ask,
+                                   'iv': float(fields['iv'][i]),
+                                   'delta': float(fields['delta'][i]),
+                                   'score': float(score[i])})
+        return candidates
+
+    def scan(self, watchlist: List[str]) -> List[Dict]:
+        # one pass: batched underlying quotes -> vectorized screen -> chains for survivors -> ranked contracts
+        # every api call shares the cycle budget, calls that no longer fit are skipped (partial results)
+        cycle_start = time.perf_counter()
+        eval_dts = get_clock().now()
+        skipped_before = self.api.skipped_request_count
+        candidates = []
+        with time_budget(self.cycle_budget_sec):
+            survivors = self.screen_underlyings(watchlist=watchlist)
+            screen_sec = time.perf_counter() - cycle_start
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [executor.submit(contextvars.copy_context().run, self._scan_underlying, underlying, eval_dts)
+                           for underlying in survivors]
+                for future in futures:
+                    try:
+                        candidates += future.result()
+                    except Exception as e:
+                        scanner_logger.error(f"Chain scan failed: {e}")
+        candidates.sort(key=lambda c: c['score'], reverse=True)
+        self.last_cycle_stats = {'watchlist': len(watchlist),
+                                 'survivors': len(survivors),
+                                 'candidates': len(candidates),
+                                 'screen_sec': screen_sec,
+                                 'cycle_sec': time.perf_counter() - cycle_start,
+                                 'skipped_requests': self.api.skipped_request_count - skipped_before}
+        return candidates[:self.max_candidates]
+
+    def run(self, watchlist: List[str], cycle_interval_sec: float = 60.0, n_cycles: Union[int, None] = None) -> None:
+        cycle = 0
+        while n_cycles is None or cycle < n_cycles:
+            cycle += 1
+            cycle_start = get_clock().now()
+            candidates = self.scan(watchlist=watchlist)
+            scanner_logger.info(f"Scan cycle {cycle}: {self.last_cycle_stats}")
+            for c in candidates[:10]:
+                scanner_logger.info(f"Candidate {c['symbol']} score {round(c['score'], 2)} "
+                                    f"delta {round(c['delta'], 2)} iv {round(c['iv'], 3)}")
+            elapsed = (get_clock().now() - cycle_start).total_seconds()
+            wait(sleep_time_sec=max(0.0, cycle_interval_sec - elapsed))
+
+
+if __name__ == '__main__':
+    # python scanner.py <watchlist file, one symbol per line> [cycle_interval_sec]
+    get_online_logger(name='scanner')
+    with open(sys.argv[1]) as f:
+        symbols = [line.strip().upper() for line in f if line.strip() and not line.startswith('#')]
+    interval = float(sys.argv[2]) if len(sys.argv) > 2 else 60.0
+    scanner_api = TradierApi.brokerage()
+    scanner = WatchlistScanner(api=scanner_api, market_calendar=MarketCalendar(api=scanner_api),
+                               cycle_budget_sec=interval / 2)
+    scanner.run(watchlist=symbols, cycle_interval_sec=interval)
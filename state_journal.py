@@ -0,0 +1,253 @@
+import json
+import logging
+import os
+import threading
+import time
+from datetime import date
+from typing import Union, List, Dict
+from clock import get_clock
+from tradier_api import TradierApi, MarketCalendar, MarketCalendarDay, Position, NOT_SENT_OUTCOMES, REQUEST_OK
+
+
+journal_logger = logging.getLogger('state_journal')
+
+# order states that still block a new exit order for the same symbol
+OPEN_ORDER_STATUSES = ('pending', 'open', 'partially_filled', 'submitted')
+
+
+def order_tag(symbol: str) -> str:
+    # unique per submission - the tag is how a submitted order is found again after a crash
+    # (tags may only contain letters, numbers and dashes)
+    return f'exit-{symbol}-{int(get_clock().timestamp() * 1000)}'
+
+
+class StateJournal:
+
+    def __init__(self, directory: str = 'state', fsync_every: int = 50, fsync_interval_sec: float = 1.0,
+                 snapshot_every: int = 5000):
+        # append-only json lines journal plus a compact snapshot, the journal is truncated on every snapshot
+        # writes are flushed to the os right away but only fsynced in batches (every fsync_every records or
+        # fsync_interval_sec) - order intents are the exception and are fsynced before the order goes out
+        self.directory = directory
+        self.journal_path = os.path.join(directory, 'journal.jsonl')
+        self.snapshot_path = os.path.join(directory, 'snapshot.json')
+        self.fsync_every = fsync_every
+        self.fsync_interval_sec = fsync_interval_sec
+        self.snapshot_every = snapshot_every
+        self.state = self._empty_state()
+        self._file = None
+        self._unsynced = 0
+        self._records_since_snapshot = 0
+        self._last_fsync = time.monotonic()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _empty_state() -> Dict:
+        return {'calendar': [], 'positions': [], 'orders': {}, 'decisions': {}, 'loop_counter': 0}
+
+    def _open(self) -> None:
+        if self._file is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._file = open(self.journal_path, 'a')
+
+    def _apply(self, record: Dict) -> None:
+        kind = record['type']
+        if kind == 'calendar':
+            self.state['calendar'] = record['days']
+        elif kind == 'positions':
+            self.state['positions'] = record['positions']
+        elif kind == 'order':
+            order = self.state['orders'].setdefault(record['tag'], {})
+            order.update({k: v for k, v in record.items() if k not in ('type', 'tag')})
+        elif kind == 'order_closed':
+            self.state['orders'].pop(record['tag'], None)
+        elif kind == 'decision':
+            self.state['decisions'][record['symbol']] = record['rule']
+        elif kind == 'loop':
+            self.state['loop_counter'] = record['counter']
+
+    def _append(self, record: Dict, sync: bool = False) -> None:
+        with self._lock:
+            self._open()
+            self._apply(record)
+            self._file.write(json.dumps(record, separators=(',', ':'), default=str) + '\n')
+            self._file.flush()
+            self._unsynced += 1
+            self._records_since_snapshot += 1
+            if sync or self._unsynced >= self.fsync_every or \
+                    time.monotonic() - self._last_fsync >= self.fsync_interval_sec:
+                self._fsync()
+        if self._records_since_snapshot >= self.snapshot_every:
+            self.snapshot()
+
+    def _fsync(self) -> None:
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_fsync = time.monotonic()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._fsync()
+
+    def load(self) -> Dict:
+        # snapshot first, then every journal record written after it - a torn last line (crash mid write) is dropped
+        self.state = self._empty_state()
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as f:
+                self.state.update(json.load(f))
+        n_records = 0
+        if os.path.exists(self.journal_path):
+            # end of the last complete record, anything after it is cut off so the next append starts on a fresh line
+            complete_bytes = 0
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError('no line end')
+                        record = json.loads(line)
+                    except ValueError:
+                        journal_logger.warning(f"Dropping incomplete journal record")
+                        break
+                    self._apply(record)
+                    n_records += 1
+                    complete_bytes += len(line)
+            if complete_bytes < os.path.getsize(self.journal_path):
+                with self._lock:
+                    if self._file is not None:
+                        self._file.close()
+                        self._file = None
+                    os.truncate(self.journal_path, complete_bytes)
+        self._records_since_snapshot = n_records
+        journal_logger.info(f"Journal loaded: {n_records} records, {len(self.state['orders'])} tracked orders")
+        return self.state
+
+    def snapshot(self) -> None:
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(f'{self.snapshot_path}.tmp', 'w') as f:
+                json.dump(self.state, f, separators=(',', ':'), default=str)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(f'{self.snapshot_path}.tmp', self.snapshot_path)
+            # everything in the journal is now in the snapshot
+            if self._file is not None:
+                self._file.close()
+            self._file = open(self.journal_path, 'w')
+            self._unsynced = 0
+            self._records_since_snapshot = 0
+
+    def close(self) -> None:
+        self.snapshot()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    # calendar
+
+    def record_calendar(self, market_calendar: MarketCalendar) -> None:
+        self._append({'type': 'calendar', 'days': [d.to_dict() for d in market_calendar.days]})
+
+    def market_calendar(self, base_date: Union[date, None] = None, days_ahead: int = 7) -> Union[MarketCalendar, None]:
+        # the journaled calendar, if it still covers base_date and the days after it
+        if not self.state['calendar']:
+            return None
+        base_date = get_clock().now().date() if base_date is None else base_date
+        calendar = MarketCalendar.from_days([MarketCalendarDay(**d) for d in self.state['calendar']])
+        last = date.fromordinal(base_date.toordinal() + days_ahead)
+        return calendar if calendar.covers(first=base_date, last=last) else None
+
+    # positions
+
+    def record_positions(self, positions: List[Position]) -> bool:
+        # only journaled when something changed, so polling the same positions doesn't grow the journal
+        data = [p.to_dict() for p in positions]
+        if data == self.state['positions']:
+            return False
+        self._append({'type': 'positions', 'positions': data})
+        # an exit order for a symbol that is no longer held has done its job
+        held = {p.symbol for p in positions}
+        for tag, order in list(self.state['orders'].items()):
+            if order.get('symbol') not in held:
+                self._append({'type': 'order_closed', 'tag': tag})
+        return True
+
+    def positions(self) -> List[Position]:
+        return [Position(**d) for d in self.state['positions']]
+
+    # orders
+
+    def open_order(self, symbol: str) -> Union[Dict, None]:
+        for tag, order in self.state['orders'].items():
+            if order.get('symbol') == symbol and order.get('status') in OPEN_ORDER_STATUSES:
+                return dict(order, tag=tag)
+        return None
+
+    def record_order_intent(self, tag: str, symbol: str, side: str, quantity: float, rule: Union[str, None] = None) -> None:
+        # written (and fsynced) before the order is sent, so a crash between sending and journaling the
+        # response still leaves a record that reconcile() can resolve by tag
+        self._append({'type': 'order', 'tag': tag, 'symbol': symbol, 'side': side, 'quantity': quantity,
+                      'rule': rule, 'status': 'submitted', 'id': None, 'ts': get_clock().timestamp()}, sync=True)
+
+    def record_order_result(self, tag: str, response: Union[Dict, None], outcome: Union[str, None] = None) -> None:
+        # outcome - the api client's last_request_outcome for the order request
+        if response is not None and response.get('id') is not None:
+            # the order endpoint answers 'ok' for an accepted order, it is open until reconcile() says otherwise
+            status = response.get('status', 'open')
+            self._append({'type': 'order', 'tag': tag, 'id': response.get('id'),
+                          'status': 'open' if status == 'ok' else status}, sync=True)
+        elif outcome in NOT_SENT_OUTCOMES:
+            # skipped before sending or rejected outright - nothing to block a retry
+            self._append({'type': 'order_closed', 'tag': tag}, sync=True)
+        else:
+            # no answer (e.g. a read timeout) - the broker may have accepted the order, it stays submitted and
+            # blocks a second exit until reconcile() finds it by tag (or doesn't)
+            journal_logger.warning(f"No response for order {tag}, keeping it as submitted until reconciled")
+
+    def record_order_closed(self, tag: str) -> None:
+        # the order is done at the broker (filled, canceled, expired, ...)
+        self._append({'type': 'order_closed', 'tag': tag}, sync=True)
+
+    def record_decision(self, symbol: str, rule: Union[str, None]) -> None:
+        if self.state['decisions'].get(symbol) != rule:
+            self._append({'type': 'decision', 'symbol': symbol, 'rule': rule})
+
+    def record_loop(self, counter: int) -> None:
+        self._append({'type': 'loop', 'counter': counter})
+
+    @property
+    def tracked_orders(self) -> int:
+        return len(self.state['orders'])
+
+    def reconcile(self, api: TradierApi, unconfirmed_grace_sec: float = 30.0) -> int:
+        # one get_account_orders call resolves every tracked order: still open, done, or never sent
+        # an order without a broker id that the broker doesn't list (yet) is only taken as never sent once it is
+        # older than unconfirmed_grace_sec
+        # returns the number of orders that are still open at the broker
+        if not self.state['orders']:
+            return 0
+        account_orders = api.get_account_orders(include_tags='true')
+        if account_orders is None and api.last_request_outcome == REQUEST_OK:
+            # answered, but there are no orders on the account
+            account_orders = []
+        if account_orders is None:
+            journal_logger.warning(f"Could not reconcile journal, keeping tracked orders as they are")
+            return len(self.state['orders'])
+        by_tag = {o.get('tag'): o for o in account_orders if o.get('tag')}
+        by_id = {o.get('id'): o for o in account_orders}
+        still_open = 0
+        now = get_clock().timestamp()
+        for tag in list(self.state['orders']):
+            tracked = self.state['orders'][tag]
+            remote = by_id.get(tracked.get('id')) or by_tag.get(tag)
+            if remote is None and tracked.get('id') is None and now - (tracked.get('ts') or 0.0) < unconfirmed_grace_sec:
+                still_open += 1
+            elif remote is None or remote.get('status') not in OPEN_ORDER_STATUSES:
+                self._append({'type': 'order_closed', 'tag': tag})
+            else:
+                self._append({'type': 'order', 'tag': tag, 'id': remote.get('id'), 'status': remote.get('status')})
+                still_open += 1
+        self.flush()
+        journal_logger.info(f"Journal reconciled: {still_open} exit orders still open")
+        return still_open
@@ -0,0 +1,184 @@
+import logging
+import multiprocessing
+import queue
+import resource
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Union, List, Dict
+from app_logging import get_online_logger
+from clock import get_clock
+from tradier_api import TradierApi, MarketCalendar, MarketDataCache
+from main import run_main_loop
+from state_journal import StateJournal
+
+
+supervisor_logger = logging.getLogger('supervisor')
+
+
+class SharedMarketDataCache(MarketDataCache):
+
+    def __init__(self, shared_data, subscriptions=None, quote_ttl_sec: float = 1.0,
+                 calendar_ttl_sec: float = 24 * 60 * 60):
+        # same as MarketDataCache but backed by manager proxies so every process sees the same entries
+        super().__init__(quote_ttl_sec=quote_ttl_sec, calendar_ttl_sec=calendar_ttl_sec)
+        self._data = shared_data
+        self._subscriptions = subscriptions
+
+    def get(self, key) -> Union[Dict, List, None]:
+        if self._subscriptions is not None and key[0] == 'quote':
+            # remember which symbols workers care about so the feed can keep them warm
+            self._subscriptions[key[1:]] = get_clock().timestamp()
+        return super().get(key)
+
+
+def run_market_data_feed(api: TradierApi, subscriptions, stop_event: threading.Event, interval_sec: float = 2.0,
+                         subscription_ttl_sec: float = 60.0) -> None:
+    # one poll for the union of every worker's symbols, results land in the shared cache via api.get_quotes_batched
+    while not stop_event.is_set():
+        try:
+            current_ts = get_clock().timestamp()
+            by_greeks = {}
+            for (symbol, greeks), requested_at in list(subscriptions.items()):
+                if current_ts - requested_at > subscription_ttl_sec:
+                    subscriptions.pop((symbol, greeks), None)
+                else:
+                    by_greeks.setdefault(greeks, []).append(symbol)
+            for greeks, symbols in by_greeks.items():
+                # fetched past the cache and written over the old entries, a worker reading in between still gets
+                # the previous quote instead of a miss
+                api.get_quotes_batched(symbols=symbols, greeks=greeks, use_cache=False)
+        except Exception as e:
+            # a failed poll (or a manager hiccup) must not end the feed - the workers would silently fall back
+            # to polling on their own
+            supervisor_logger.error(f"Market data feed poll failed: {e}")
+        stop_event.wait(interval_sec)
+
+
+def run_strategy_worker(worker_spec: Dict, market_calendar: MarketCalendar, shared_data, subscriptions,
+                        log_queue, metrics_queue, metrics_interval_sec: float = 30.0) -> None:
+    # all logging goes back to the supervisor, which owns the only remote handler
+    root_logger = logging.getLogger()
+    root_logger.handlers = [QueueHandler(log_queue)]
+    root_logger.setLevel(logging.DEBUG)
+    cache = SharedMarketDataCache(shared_data=shared_data, subscriptions=subscriptions,
+                                  quote_ttl_sec=worker_spec.get('quote_ttl_sec', 5.0))
+    api = TradierApi.from_creds(worker_spec['account'], market_data_cache=cache)
+    stop_event = threading.Event()
+
+    def report_metrics():
+        while not stop_event.wait(metrics_interval_sec):
+            metrics_queue.put({'worker': worker_spec['name'],
+                               'account': worker_spec['account'],
+                               'requests': api.request_count,
+                               'cache_hits': cache.hits,
+                               'cache_misses': cache.misses,
+                               'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+
+    threading.Thread(target=report_metrics, daemon=True).start()
+    # a restarted worker picks its submitted exit orders back up instead of sending them again
+    journal = StateJournal(directory=f"state/{worker_spec['name']}")
+    try:
+        journal.load()
+        journal.reconcile(api=api)
+        run_main_loop(api=api, market_calendar=market_calendar,
+                      app_time_limit_in_seconds=worker_spec.get('app_time_limit_in_seconds', 24 * 60 * 60),
+                      app_loop_limit=worker_spec.get('app_loop_limit', 20000),
+                      option_profit_target=worker_spec.get('option_profit_target', 0.20), journal=journal)
+    finally:
+        stop_event.set()
+        journal.close()
+
+
+class Supervisor:
+
+    def __init__(self, worker_specs: List[Dict], market_data_account: str = 'brokerage', feed_interval_sec: float = 2.0,
+                 max_restarts: int = 5, restart_backoff_sec: float = 5.0):
+        # worker_specs - one dict per worker, e.g. {'name': 'acct1', 'account': 'brokerage', 'option_profit_target': 0.2}
+        self.worker_specs = {spec.get('name', spec['account']): dict(spec, name=spec.get('name', spec['account']))
+                             for spec in worker_specs}
+        self.market_data_account = market_data_account
+        self.feed_interval_sec = feed_interval_sec
+        self.max_restarts = max_restarts
+        self.restart_backoff_sec = restart_backoff_sec
+        self.restarts = {name: 0 for name in self.worker_specs}
+        self.metrics = {}
+        self._processes = {}
+        self._stop_event = threading.Event()
+        self._manager = multiprocessing.Manager()
+        self._shared_data = self._manager.dict()
+        self._subscriptions = self._manager.dict()
+        self._log_queue = multiprocessing.Queue()
+        self._metrics_queue = multiprocessing.Queue()
+        self._feed_cache = SharedMarketDataCache(shared_data=self._shared_data, quote_ttl_sec=2 * feed_interval_sec)
+        self._feed_api = TradierApi.from_creds(market_data_account, market_data_cache=self._feed_cache)
+        self.market_calendar = None
+
+    def _start_worker(self, name: str) -> None:
+        process = multiprocessing.Process(target=run_strategy_worker, name=f'worker-{name}', daemon=True,
+                                          args=(self.worker_specs[name], self.market_calendar, self._shared_data,
+                                                self._subscriptions, self._log_queue, self._metrics_queue))
+        process.start()
+        self._processes[name] = process
+        supervisor_logger.info(f"Worker {name} started with pid {process.pid}")
+
+    def _collect_metrics(self) -> None:
+        while True:
+            try:
+                m = self._metrics_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.metrics[m['worker']] = m
+
+    def total_requests(self) -> int:
+        return self._feed_api.request_count + sum(m['requests'] for m in self.metrics.values())
+
+    def run(self, monitor_interval_sec: float = 1.0, metrics_log_interval_sec: float = 300.0) -> None:
+        log_listener = QueueListener(self._log_queue, *logging.getLogger().handlers, respect_handler_level=True)
+        log_listener.start()
+        # single calendar fetch for every worker (shipped to each worker process when it starts)
+        self.market_calendar = MarketCalendar(api=self._feed_api, mo_hist=3, mo_fut=3)
+        feed_thread = threading.Thread(target=run_market_data_feed, daemon=True,
+                                       args=(self._feed_api, self._subscriptions, self._stop_event,
+                                             self.feed_interval_sec))
+        feed_thread.start()
+        for name in self.worker_specs:
+            self._start_worker(name)
+        last_metrics_log = time.monotonic()
+        try:
+            while self._processes:
+                time.sleep(monitor_interval_sec)
+                self._collect_metrics()
+                for name, process in list(self._processes.items()):
+                    if process.is_alive():
+                        continue
+                    if process.exitcode == 0:
+                        supervisor_logger.info(f"Worker {name} finished")
+                        del self._processes[name]
+                    elif self.restarts[name] < self.max_restarts:
+                        self.restarts[name] += 1
+                        supervisor_logger.warning(f"Worker {name} exited with code {process.exitcode}, "
+                                                  f"restart {self.restarts[name]} of {self.max_restarts}")
+                        time.sleep(self.restart_backoff_sec)
+                        self._start_worker(name)
+                    else:
+                        supervisor_logger.error(f"Worker {name} exceeded restart limit, not restarting")
+                        del self._processes[name]
+                if time.monotonic() - last_metrics_log >= metrics_log_interval_sec:
+                    last_metrics_log = time.monotonic()
+                    supervisor_logger.info(f"Workers: {len(self._processes)} "
+                                           f"Total requests: {self.total_requests()} "
+                                           f"Metrics: {self.metrics}")
+        finally:
+            self._stop_event.set()
+            for process in self._processes.values():
+                process.terminate()
+            log_listener.stop()
+            self._manager.shutdown()
+
+
+if __name__ == '__main__':
+    # python supervisor.py <creds account name> [<creds account name> ...]
+    get_online_logger(name='supervisor')
+    Supervisor(worker_specs=[{'account': name} for name in sys.argv[1:]]).run()
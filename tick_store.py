@@ -0,0 +1,209 @@
+import json
+import logging
+import os
+import queue
+import threading
+import numpy as np
+from datetime import date, datetime
+from typing import Union, List, Dict
+from clock import get_clock
+
+
+tick_store_logger = logging.getLogger('tick_store')
+
+# one fixed width record per quote snapshot
+TICK_DTYPE = np.dtype([('ts', '<f8'), ('symbol_id', '<u4'), ('bidsize', '<f4'), ('asksize', '<f4'),
+                       ('bid', '<f8'), ('ask', '<f8'), ('last', '<f8'), ('volume', '<f8')])
+# header: magic, record size, record count - the count is written after the records it covers,
+# so a reader never sees a half written record
+_HEADER_DTYPE = np.dtype([('magic', 'S8'), ('itemsize', '<u8'), ('count', '<u8')])
+_HEADER_SIZE = 64
+_MAGIC = b'TICKS001'
+
+
+class _TickFile:
+
+    def __init__(self, path: str, initial_capacity: int = 4096):
+        # append only memory mapped file of TICK_DTYPE records, grown by doubling
+        self.path = path
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.truncate(_HEADER_SIZE + initial_capacity * TICK_DTYPE.itemsize)
+            header = np.memmap(path, dtype=_HEADER_DTYPE, mode='r+', shape=(1,))
+            header[0] = (_MAGIC, TICK_DTYPE.itemsize, 0)
+            header.flush()
+            del header
+        self._map()
+
+    def _map(self) -> None:
+        capacity = (os.path.getsize(self.path) - _HEADER_SIZE) // TICK_DTYPE.itemsize
+        self.header = np.memmap(self.path, dtype=_HEADER_DTYPE, mode='r+', shape=(1,))
+        if self.header[0]['magic'] != _MAGIC or self.header[0]['itemsize'] != TICK_DTYPE.itemsize:
+            raise ValueError(f"{self.path} is not a tick file of the current record layout")
+        self.records = np.memmap(self.path, dtype=TICK_DTYPE, mode='r+', offset=_HEADER_SIZE, shape=(capacity,))
+        self.count = int(self.header[0]['count'])
+
+    def append(self, records: np.ndarray) -> None:
+        needed = self.count + len(records)
+        if needed > len(self.records):
+            capacity = max(needed, 2 * len(self.records))
+            self.records.flush()
+            del self.records
+            with open(self.path, 'r+b') as f:
+                f.truncate(_HEADER_SIZE + capacity * TICK_DTYPE.itemsize)
+            self._map()
+        self.records[self.count:needed] = records
+        self.count = needed
+        self.header[0]['count'] = needed
+
+    def flush(self) -> None:
+        self.records.flush()
+        self.header.flush()
+
+
+def _read_count(path: str) -> int:
+    header = np.fromfile(path, dtype=_HEADER_DTYPE, count=1)
+    return 0 if not len(header) or header[0]['magic'] != _MAGIC else int(header[0]['count'])
+
+
+class TickStore:
+
+    def __init__(self, directory: str = 'ticks', flush_interval_sec: float = 1.0, max_queue: int = 100000):
+        # <directory>/<YYYY-MM-DD>/<SYMBOL>.ticks plus symbols.json (symbol -> id)
+        # append() only queues - a background thread does the file work so the trading loop never waits on disk
+        self.directory = directory
+        self.flush_interval_sec = flush_interval_sec
+        os.makedirs(directory, exist_ok=True)
+        self._symbols_path = os.path.join(directory, 'symbols.json')
+        self._symbol_ids = {}
+        if os.path.exists(self._symbols_path):
+            with open(self._symbols_path) as f:
+                self._symbol_ids = json.load(f)
+        self._files = {}
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self.written = 0
+        self.dropped = 0
+        self._writer = threading.Thread(target=self._run, name='tick_store_writer', daemon=True)
+        self._writer.start()
+
+    def symbol_id(self, symbol: str) -> int:
+        symbol_id = self._symbol_ids.get(symbol)
+        if symbol_id is None:
+            symbol_id = len(self._symbol_ids)
+            self._symbol_ids[symbol] = symbol_id
+            with open(f'{self._symbols_path}.tmp', 'w') as f:
+                json.dump(self._symbol_ids, f)
+            os.replace(f'{self._symbols_path}.tmp', self._symbols_path)
+        return symbol_id
+
+    def append(self, quotes: Union[List, Dict], ts: Union[float, None] = None) -> None:
+        # quotes - Quote objects or a symbol -> Quote mapping (as from get_quotes_batched)
+        if ts is None:
+            ts = get_clock().timestamp()
+        if isinstance(quotes, dict):
+            quotes = quotes.values()
+        rows = [(q.symbol, ts, q.bidsize, q.asksize, q.bid, q.ask, q.last, q.volume) for q in quotes if q is not None]
+        if not rows:
+            return
+        try:
+            self._queue.put_nowait(rows)
+        except queue.Full:
+            # never block the loop - a full queue means the disk can't keep up, count what is lost
+            self.dropped += len(rows)
+
+    def _run(self) -> None:
+        while not self._stop.is_set() or not self._queue.empty():
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval_sec)]
+            except queue.Empty:
+                self._flush_files()
+                continue
+            # drain whatever else is waiting so files are written in as few appends as possible
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write([row for rows in batch for row in rows])
+            except Exception as e:
+                tick_store_logger.error(f"Tick store write failed: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, rows: List) -> None:
+        by_file = {}
+        for symbol, ts, bidsize, asksize, bid, ask, last, volume in rows:
+            day = datetime.fromtimestamp(ts).date().isoformat()
+            by_file.setdefault((day, symbol), []).append(
+                (ts, self.symbol_id(symbol), np.nan if bidsize is None else bidsize,
+                 np.nan if asksize is None else asksize, np.nan if bid is None else bid,
+                 np.nan if ask is None else ask, np.nan if last is None else last,
+                 np.nan if volume is None else volume))
+        for (day, symbol), records in by_file.items():
+            tick_file = self._files.get((day, symbol))
+            if tick_file is None:
+                os.makedirs(os.path.join(self.directory, day), exist_ok=True)
+                tick_file = _TickFile(path=self._path(day=day, symbol=symbol))
+                self._files[(day, symbol)] = tick_file
+            tick_file.append(np.array(records, dtype=TICK_DTYPE))
+            self.written += len(records)
+        # files of earlier days are complete, let go of their maps
+        today = max(day for day, _ in by_file)
+        for key in [k for k in self._files if k[0] < today]:
+            self._files.pop(key).flush()
+
+    def _flush_files(self) -> None:
+        for tick_file in self._files.values():
+            tick_file.flush()
+
+    def _path(self, day: str, symbol: str) -> str:
+        # option symbols are plain alphanumerics, safe as file names
+        return os.path.join(self.directory, day, f'{symbol}.ticks')
+
+    def flush(self) -> None:
+        # wait until everything queued so far is on disk (for tests / shutdown, not for the trading loop)
+        self._queue.join()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._writer.join()
+        self._flush_files()
+        self._files.clear()
+
+    # reads - any process can read while another one writes
+
+    def days(self, symbol: Union[str, None] = None) -> List[str]:
+        days = sorted(d for d in os.listdir(self.directory) if os.path.isdir(os.path.join(self.directory, d)))
+        if symbol is None:
+            return days
+        return [d for d in days if os.path.exists(self._path(day=d, symbol=symbol))]
+
+    def read_day(self, symbol: str, day: Union[date, str], start_ts: Union[float, None] = None,
+                 end_ts: Union[float, None] = None) -> np.ndarray:
+        # read only memmap view of one day of records, the time window is two binary searches on ts
+        day = day.isoformat() if isinstance(day, date) else day
+        path = self._path(day=day, symbol=symbol)
+        count = _read_count(path) if os.path.exists(path) else 0
+        if count == 0:
+            return np.zeros(0, dtype=TICK_DTYPE)
+        records = np.memmap(path, dtype=TICK_DTYPE, mode='r', offset=_HEADER_SIZE, shape=(count,))
+        ts = records['ts']
+        lo = 0 if start_ts is None else int(np.searchsorted(ts, start_ts, side='left'))
+        hi = count if end_ts is None else int(np.searchsorted(ts, end_ts, side='right'))
+        return records[lo:hi]
+
+    def read(self, symbol: str, start: Union[datetime, float], end: Union[datetime, float]) -> np.ndarray:
+        # records in [start, end] - a zero copy view when the window is within one day, concatenated otherwise
+        start_ts = start.timestamp() if isinstance(start, datetime) else start
+        end_ts = end.timestamp() if isinstance(end, datetime) else end
+        first = datetime.fromtimestamp(start_ts).date().isoformat()
+        last = datetime.fromtimestamp(end_ts).date().isoformat()
+        parts = [self.read_day(symbol=symbol, day=d, start_ts=start_ts, end_ts=end_ts)
+                 for d in self.days(symbol=symbol) if first <= d <= last]
+        parts = [p for p in parts if len(p)]
+        if not parts:
+            return np.zeros(0, dtype=TICK_DTYPE)
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
@@ -0,0 +1,136 @@
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from typing import Union, Dict
+from zoneinfo import ZoneInfo
+from clock import Clock
+
+
+EXCHANGE_TIMEZONE = 'America/New_York'
+_NS = 1_000_000_000
+
+
+class TimeService:
+
+    def __init__(self, tz: str = EXCHANGE_TIMEZONE, max_samples: int = 64, max_sample_age_sec: float = 3600.0,
+                 drift_ppm: float = 100.0):
+        # offset from the local monotonic clock to the broker's clock, estimated from the server time every response
+        # carries (Date header, market clock timestamp)
+        # both only have whole second resolution, but each one bounds the offset to an interval: the server read its
+        # clock somewhere between sending the request and receiving the response, and truncated it to the second
+        # intersecting the intervals of many requests (each landing at a different point of a second) narrows the
+        # estimate down towards the round trip time - older samples are widened by drift_ppm for the time they aged
+        self.tz = ZoneInfo(tz)
+        self.max_sample_age_sec = max_sample_age_sec
+        self.drift_ppm = drift_ppm
+        # (sample monotonic ns, lowest offset ns, highest offset ns)
+        self._samples = deque(maxlen=max_samples)
+        self._lock = threading.Lock()
+        # until the first sample the local wall clock is all there is
+        self._local_offset_ns = time.time_ns() - time.monotonic_ns()
+        self.offset_ns = None
+        self.uncertainty_ns = None
+        self.sample_count = 0
+        self.conflicts = 0
+
+    def observe(self, server_ts: float, sent_mono_ns: int, received_mono_ns: int, resolution_sec: float = 1.0) -> None:
+        # server_ts - server epoch seconds as reported (truncated to resolution_sec)
+        server_ns = int(server_ts * _NS)
+        low = server_ns - received_mono_ns
+        high = server_ns + int(resolution_sec * _NS) - sent_mono_ns
+        with self._lock:
+            self._samples.append((received_mono_ns, low, high))
+            self.sample_count += 1
+            self._estimate(now_mono_ns=received_mono_ns)
+
+    def _estimate(self, now_mono_ns: int) -> None:
+        max_age_ns = self.max_sample_age_sec * _NS
+        while self._samples and now_mono_ns - self._samples[0][0] > max_age_ns:
+            self._samples.popleft()
+        while True:
+            low, high = -(1 << 63), 1 << 63
+            for mono_ns, sample_low, sample_high in self._samples:
+                widen = int((now_mono_ns - mono_ns) * self.drift_ppm * 1e-6)
+                low = max(low, sample_low - widen)
+                high = min(high, sample_high + widen)
+            if low <= high or len(self._samples) <= 1:
+                break
+            # samples disagree - the server clock was stepped (or a sample was bad), the older ones go
+            self._samples.popleft()
+            self.conflicts += 1
+        if self._samples:
+            self.offset_ns = (low + high) // 2
+            self.uncertainty_ns = (high - low) // 2
+
+    def observe_date_header(self, date_header: Union[str, None], sent_mono_ns: int, received_mono_ns: int) -> None:
+        # e.g. 'Tue, 10 Jan 2023 14:30:05 GMT'
+        if not date_header:
+            return
+        try:
+            server_dts = parsedate_to_datetime(date_header)
+        except (TypeError, ValueError):
+            return
+        self.observe(server_ts=server_dts.timestamp(), sent_mono_ns=sent_mono_ns, received_mono_ns=received_mono_ns)
+
+    def observe_market_clock(self, market_clock: Union[Dict, None], sent_mono_ns: int, received_mono_ns: int) -> None:
+        if market_clock and market_clock.get('timestamp') is not None:
+            self.observe(server_ts=float(market_clock['timestamp']), sent_mono_ns=sent_mono_ns,
+                         received_mono_ns=received_mono_ns)
+
+    def sync(self, api, samples: int = 1) -> Union[int, None]:
+        # explicit samples from the market clock endpoint, for when there has been no other traffic yet
+        # (with the service attached to the api, the Date header of each of these requests counts as well)
+        for _ in range(samples):
+            sent = time.monotonic_ns()
+            market_clock = api.get_market_clock()
+            self.observe_market_clock(market_clock=market_clock, sent_mono_ns=sent, received_mono_ns=time.monotonic_ns())
+        return self.uncertainty_ns
+
+    def now_ns(self) -> int:
+        # broker epoch time in nanoseconds
+        offset_ns = self._local_offset_ns if self.offset_ns is None else self.offset_ns
+        return time.monotonic_ns() + offset_ns
+
+    def now(self) -> datetime:
+        # tz aware (exchange time zone by default), microsecond resolution as datetime allows
+        seconds, ns = divmod(self.now_ns(), _NS)
+        return datetime.fromtimestamp(seconds, tz=self.tz) + timedelta(microseconds=ns // 1000)
+
+    @property
+    def local_clock_error_sec(self) -> Union[float, None]:
+        # how far the host wall clock is off the broker's clock (positive - host is behind)
+        if self.offset_ns is None:
+            return None
+        return (self.offset_ns - (time.time_ns() - time.monotonic_ns())) / _NS
+
+    def stats(self) -> Dict:
+        return {'samples': len(self._samples),
+                'sample_count': self.sample_count,
+                'conflicts': self.conflicts,
+                'uncertainty_ms': None if self.uncertainty_ns is None else round(self.uncertainty_ns / 1e6, 3),
+                'local_clock_error_ms': None if self.offset_ns is None else round(self.local_clock_error_sec * 1e3, 3)}
+
+
+class ServerSyncedClock(Clock):
+
+    def __init__(self, time_service: TimeService):
+        # process clock on broker time - now() is naive wall time of the exchange time zone (like the market
+        # calendar), whatever the host's TZ setting or clock drift
+        # timestamp() is left as now().timestamp(), so timestamps line up with the calendar's tradeable time index
+        self.time_service = time_service
+
+    def now(self) -> datetime:
+        return self.time_service.now().replace(tzinfo=None)
+
+    def now_aware(self) -> datetime:
+        return self.time_service.now()
+
+    def now_ns(self) -> int:
+        return self.time_service.now_ns()
+
+    def sleep(self, seconds: float) -> None:
+        # durations are the same on any clock, only the start point is corrected
+        if seconds > 0:
+            time.sleep(seconds)
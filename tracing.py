@@ -0,0 +1,364 @@
+import contextvars
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import deque, Counter
+from contextlib import contextmanager
+from typing import Union, List, Dict
+from primary_functions import percentile
+
+
+tracing_logger = logging.getLogger('tracing')
+
+# name of the enclosing span so nested spans are reported as parent/child (e.g. quotes/http)
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Tracer:
+
+    def __init__(self, max_samples: int = 2048, enabled: bool = True):
+        # the last max_samples durations are kept per span, so memory stays flat however long the bot runs
+        self.max_samples = max_samples
+        self.enabled = enabled
+        self._durations = {}
+        self._counts = Counter()
+        self._totals = Counter()
+        self._lock = threading.Lock()
+        self._last_dump = time.monotonic()
+
+    def begin(self, name: str):
+        # begin / end for spans that don't fit a with block (e.g. a whole loop iteration)
+        if not self.enabled:
+            return None
+        parent = _current_span.get()
+        path = name if parent is None else f'{parent}/{name}'
+        return _current_span.set(path), path, time.perf_counter_ns()
+
+    def end(self, handle) -> None:
+        if handle is None:
+            return
+        token, path, start = handle
+        elapsed = time.perf_counter_ns() - start
+        _current_span.reset(token)
+        self.record(path, elapsed)
+
+    @contextmanager
+    def span(self, name: str):
+        handle = self.begin(name)
+        try:
+            yield
+        finally:
+            self.end(handle)
+
+    def record(self, name: str, elapsed_ns: int) -> None:
+        with self._lock:
+            durations = self._durations.get(name)
+            if durations is None:
+                durations = deque(maxlen=self.max_samples)
+                self._durations[name] = durations
+            durations.append(elapsed_ns)
+            self._counts[name] += 1
+            self._totals[name] += elapsed_ns
+
+    def summary(self, pcts=(50, 95, 99)) -> List[Dict]:
+        # milliseconds, percentiles over the retained samples, count and total over the whole run
+        with self._lock:
+            snapshot = {name: list(durations) for name, durations in self._durations.items()}
+            counts = dict(self._counts)
+            totals = dict(self._totals)
+        output = []
+        for name in sorted(snapshot):
+            row = {'span': name, 'count': counts[name], 'total_ms': totals[name] / 1e6}
+            row.update({f'p{p}_ms': percentile(snapshot[name], p) / 1e6 for p in pcts})
+            row['max_ms'] = max(snapshot[name]) / 1e6
+            output.append(row)
+        return output
+
+    def format_summary(self) -> str:
+        lines = [f"{'span':<32}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'total s':>10}"]
+        for row in self.summary():
+            lines.append(f"{row['span']:<32}{row['count']:>8}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}"
+                         f"{row['p99_ms']:>10.2f}{row['max_ms']:>10.2f}{row['total_ms'] / 1e3:>10.2f}")
+        return '\n'.join(lines)
+
+    def maybe_dump(self, interval_sec: float = 300.0) -> bool:
+        # cheap enough to call every tick, only logs once per interval
+        now = time.monotonic()
+        if now - self._last_dump < interval_sec:
+            return False
+        self._last_dump = now
+        tracing_logger.info(f"Span timings:\n{self.format_summary()}")
+        return True
+
+    def reset(self) -> None:
+        with self._lock:
+            self._durations.clear()
+            self._counts.clear()
+            self._totals.clear()
+
+
+_tracer = Tracer()
+
+
+def get_tracer() -> Tracer:
+    return _tracer
+
+
+def span(name: str):
+    # with span('quotes'): ...
+    return _tracer.span(name)
+
+
+class TracedHandler(logging.Handler):
+    # wraps a (possibly remote) log handler so time spent shipping log records shows up as its own span
+
+    def __init__(self, handler: logging.Handler, name: str = 'log'):
+        super().__init__(level=handler.level)
+        self.handler = handler
+        self.span_name = name
+
+    def emit(self, record):
+        with span(self.span_name):
+            self.handler.handle(record)
+
+
+def trace_log_handlers(logger: Union[logging.Logger, None] = None, name: str = 'log') -> None:
+    logger = logging.getLogger() if logger is None else logger
+    logger.handlers = [h if isinstance(h, TracedHandler) else TracedHandler(h, name=name) for h in logger.handlers]
+
+
+class SamplingProfiler:
+
+    def __init__(self, interval_sec: float = 0.005, thread_id: Union[int, None] = None):
+        # samples the stacks of running threads from a background thread - no tracing hooks, so the
+        # bot runs at full speed apart from the GIL taken for each sample
+        # thread_id - only sample this thread (e.g. the trading loop), None for every thread
+        self.interval_sec = interval_sec
+        self.thread_id = thread_id
+        self.stacks = Counter()
+        self.sample_count = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _collapse(frame) -> str:
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval_sec):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or (self.thread_id is not None and thread_id != self.thread_id):
+                    continue
+                self.stacks[self._collapse(frame)] += 1
+            self.sample_count += 1
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling_profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def write_collapsed(self, path: str) -> str:
+        # one 'frame;frame;frame count' line per stack - the input format of flamegraph.pl and speedscope
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        return path
+
+    def profile_for(self, duration_sec: float, path: str) -> str:
+        self.stacks.clear()
+        self.sample_count = 0
+        self.start()
+        time.sleep(duration_sec)
+        self.stop()
+        tracing_logger.info(f"Profiler collected {self.sample_count} samples, writing {path}")
+        return self.write_collapsed(path)
+
+
+class ProfileTrigger:
+
+    def __init__(self, output_dir: str = '.', duration_sec: float = 30.0, interval_sec: float = 0.005,
+                 flag_path: Union[str, None] = 'profile.flag', thread_id: Union[int, None] = None):
+        # starts a profile of duration_sec on SIGUSR1 or when flag_path appears (touch profile.flag),
+        # so a live bot can be profiled without a restart - the output goes to output_dir
+        self.output_dir = output_dir
+        self.duration_sec = duration_sec
+        self.interval_sec = interval_sec
+        self.flag_path = flag_path
+        self.thread_id = threading.get_ident() if thread_id is None else thread_id
+        self.last_output = None
+        self._worker = None
+
+    def install_signal_handler(self, signum: Union[int, None] = None) -> bool:
+        # signal handlers can only be set from the main thread, and SIGUSR1 doesn't exist on windows
+        signum = getattr(signal, 'SIGUSR1', None) if signum is None else signum
+        if signum is None or threading.current_thread() is not threading.main_thread():
+            return False
+        signal.signal(signum, lambda *_: self.trigger())
+        return True
+
+    def check_flag(self) -> bool:
+        # cheap stat, meant to be called once per tick
+        if self.flag_path is None or not os.path.exists(self.flag_path):
+            return False
+        try:
+            os.remove(self.flag_path)
+        except OSError:
+            pass
+        return self.trigger()
+
+    def trigger(self) -> bool:
+        if self._worker is not None and self._worker.is_alive():
+            return False
+        path = os.path.join(self.output_dir, f'profile_{time.strftime("%Y%m%d_%H%M%S")}.collapsed')
+        profiler = SamplingProfiler(interval_sec=self.interval_sec, thread_id=self.thread_id)
+        self._worker = threading.Thread(target=self._profile, args=(profiler, path), name='profile_trigger',
+                                        daemon=True)
+        self._worker.start()
+        return True
+
+    def _profile(self, profiler: SamplingProfiler, path: str) -> None:
+        self.last_output = profiler.profile_for(duration_sec=self.duration_sec, path=path)
+
+
+class _TimedLoader:
+
+    def __init__(self, loader, name: str, startup_timer):
+        self._loader = loader
+        self._name = name
+        self._startup_timer = startup_timer
+
+    def __getattr__(self, item):
+        return getattr(self._loader, item)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module) -> None:
+        timer = self._startup_timer
+        timer._import_stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = timer._import_stack.pop()
+            if timer._import_stack:
+                timer._import_stack[-1] += elapsed
+            timer.imports[self._name] = (elapsed, elapsed - nested)
+            # the module keeps its real loader, the wrapper is only there while it executes
+            module.__loader__ = self._loader
+            if getattr(module, '__spec__', None) is not None:
+                module.__spec__.loader = self._loader
+
+
+class _ImportTimingFinder:
+
+    def __init__(self, startup_timer):
+        self._startup_timer = startup_timer
+
+    def find_spec(self, fullname, path, target=None):
+        # the rest of meta_path finds the module, only its loader is wrapped
+        spec = None
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        if spec is None or spec.loader is None or not hasattr(spec.loader, 'exec_module'):
+            return spec
+        spec.loader = _TimedLoader(loader=spec.loader, name=fullname, startup_timer=self._startup_timer)
+        return spec
+
+
+def _seconds_since_process_start() -> Union[float, None]:
+    # linux only - process start time from /proc, in clock ticks since boot
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = float(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class StartupTimer:
+
+    def __init__(self, record_imports: bool = False):
+        # where the time between process start and the first loop goes - named phases plus, with record_imports,
+        # the time of every module imported from here on (cumulative and without its own imports)
+        self._created = time.perf_counter()
+        self._interpreter_sec = _seconds_since_process_start()
+        self._last_mark = self._created
+        self.phases = []
+        self.imports = {}
+        self._import_stack = []
+        self._finder = None
+        if record_imports:
+            self.start_recording_imports()
+
+    def start_recording_imports(self) -> None:
+        if self._finder is None:
+            self._finder = _ImportTimingFinder(startup_timer=self)
+            sys.meta_path.insert(0, self._finder)
+
+    def stop_recording_imports(self) -> None:
+        if self._finder is not None:
+            sys.meta_path.remove(self._finder)
+            self._finder = None
+
+    def mark(self, name: str) -> float:
+        # closes a phase that started at the previous mark (or at creation)
+        current = time.perf_counter()
+        elapsed = current - self._last_mark
+        self.phases.append((name, elapsed))
+        self._last_mark = current
+        return elapsed
+
+    @contextmanager
+    def phase(self, name: str):
+        self._last_mark = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.mark(name)
+
+    @property
+    def elapsed_sec(self) -> float:
+        return time.perf_counter() - self._created + (self._interpreter_sec or 0.0)
+
+    def report(self, top_imports: int = 10) -> str:
+        lines = [f"{'startup phase':<32}{'ms':>10}"]
+        if self._interpreter_sec is not None:
+            lines.append(f"{'interpreter (before timer)':<32}{self._interpreter_sec * 1e3:>10.1f}")
+        for name, elapsed in self.phases:
+            lines.append(f"{name:<32}{elapsed * 1e3:>10.1f}")
+        lines.append(f"{'total':<32}{self.elapsed_sec * 1e3:>10.1f}")
+        if self.imports:
+            lines.append(f"\n{'slowest imports':<32}{'self ms':>10}{'cumul ms':>10}")
+            ranked = sorted(self.imports.items(), key=lambda kv: kv[1][1], reverse=True)[:top_imports]
+            for module, (cumulative, own) in ranked:
+                lines.append(f"{module:<32}{own * 1e3:>10.1f}{cumulative * 1e3:>10.1f}")
+        return '\n'.join(lines)
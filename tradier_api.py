@@ -1,15 +1,49 @@
-import requests
-from requests.exceptions import RequestException
 from datetime import datetime, date, time, timedelta
-from dateutil.relativedelta import relativedelta
-from typing import Union, List, Dict
-from creds import tradier_api_creds
+from typing import Union, List, Dict, Tuple
+from api_recording import ApiRecorder, ApiReplayer
+from clock import get_clock
+from deadline import current_deadline
+from option_symbols import OccSymbol, parse_occ_symbol
+from tracing import span
+from time_service import TimeService
 import logging
+import os
+import pickle
+import time as timer
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from bisect import bisect_right
+
+# requests, urllib3 and the creds file are only imported when first needed (see _api_creds and
+# TradierApiBase._http_session), importing this module stays cheap for replays, simulations and tooling
 
 # prevent urllib from logging every single request
 urllib_logger = logging.getLogger('urllib3.connectionpool')
 urllib_logger.setLevel(logging.ERROR)
 
+# how the last request of a thread ended (TradierApiBase.last_request_outcome) - skipped and rejected requests
+# definitely didn't change anything at the broker, a failed one (timeout, connection error, 5xx) may have
+REQUEST_OK = 'ok'
+REQUEST_SKIPPED = 'skipped'
+REQUEST_REJECTED = 'rejected'
+REQUEST_FAILED = 'failed'
+NOT_SENT_OUTCOMES = (REQUEST_SKIPPED, REQUEST_REJECTED)
+
+# bump when the pickled MarketCalendar layout changes, older snapshots are then ignored
+CALENDAR_SNAPSHOT_VERSION = 1
+
+
+def _api_creds() -> Dict:
+    from creds import tradier_api_creds
+    return tradier_api_creds
+
+
+def shift_months(day: date, months: int) -> date:
+    # first of the month, months before / after day
+    month_index = day.year * 12 + day.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
 
 def dict_to_list_of_dict(data: Union[List, Dict, None]) -> Union[List[Dict], None]:
     if data:
@@ -18,82 +52,297 @@ def dict_to_list_of_dict(data: Union[List, Dict, None]) -> Union[List[Dict], Non
     return data
 
 
+def chunk_symbols(symbols: List[str], max_symbols: int = 200, max_chars: Union[int, None] = None) -> List[List[str]]:
+    # split into chunks bounded by symbol count and (for query strings) joined length
+    chunks = []
+    chunk = []
+    chunk_chars = 0
+    for symbol in symbols:
+        symbol_chars = len(symbol) + 1
+        if chunk and (len(chunk) >= max_symbols or (max_chars is not None and chunk_chars + symbol_chars > max_chars)):
+            chunks.append(chunk)
+            chunk = []
+            chunk_chars = 0
+        chunk.append(symbol)
+        chunk_chars += symbol_chars
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+class RateLimiter:
+
+    def __init__(self, max_requests: int = 120, period_sec: float = 60):
+        # token bucket - allows short bursts up to max_requests, refills evenly over the period
+        self.max_requests = max_requests
+        self.period_sec = period_sec
+        self._tokens = float(max_requests)
+        self._updated = timer.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        current = timer.monotonic()
+        self._tokens = min(self.max_requests,
+                           self._tokens + (current - self._updated) * self.max_requests / self.period_sec)
+        self._updated = current
+
+    def acquire(self, max_wait_sec: Union[float, None] = None) -> bool:
+        # returns False if a token would not be available within max_wait_sec
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait_sec = (1 - self._tokens) * self.period_sec / self.max_requests
+            if max_wait_sec is not None:
+                if wait_sec > max_wait_sec:
+                    return False
+                max_wait_sec -= wait_sec
+            timer.sleep(wait_sec)
+
+    @property
+    def available(self) -> float:
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+
+class MarketDataCache:
+
+    def __init__(self, quote_ttl_sec: float = 1.0, calendar_ttl_sec: float = 24 * 60 * 60):
+        # market data is the same for every account, so one cache can be shared by many clients
+        self.quote_ttl_sec = quote_ttl_sec
+        self.calendar_ttl_sec = calendar_ttl_sec
+        self.hits = 0
+        self.misses = 0
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Union[Dict, List, None]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < get_clock().timestamp():
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, ttl_sec: float) -> None:
+        if ttl_sec <= 0:
+            return
+        with self._lock:
+            self._data[key] = (get_clock().timestamp() + ttl_sec, value)
+
+    def invalidate(self, key) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
 class TradierApiBase:
     _brokerage_request_endpoint = r'https://api.tradier.com/v1/'
     _brokerage_streaming_endpoint = r'https://stream.tradier.com/v1/'
     _sandbox_request_endpoint = r'https://sandbox.tradier.com/v1/'
-    _brokerage_api_key = tradier_api_creds['brokerage']['key']
-    _brokerage_account_id = tradier_api_creds['brokerage']['account']
-    _sandbox_api_key = tradier_api_creds['sandbox']['key']
-    _sandbox_account_id = tradier_api_creds['sandbox']['account']
-    _legacy_sandbox_api_key = tradier_api_creds['legacy_sandbox']['key']
-    _legacy_sandbox_account_id = tradier_api_creds['legacy_sandbox']['account']
-    _request_endpoint = _brokerage_request_endpoint
-    _streaming_endpoint = _brokerage_streaming_endpoint
-    _api_key = _brokerage_api_key
-    _account_id = _brokerage_account_id
-    _request_headers = {'Authorization': f"Bearer {_api_key}", 'Accept': 'application/json'}
+
+    def __init__(self, api_key: str, account_id: str, request_endpoint: str = _brokerage_request_endpoint,
+                 streaming_endpoint: Union[str, None] = _brokerage_streaming_endpoint,
+                 rate_limiter: Union[RateLimiter, None] = None,
+                 market_data_cache: Union[MarketDataCache, None] = None,
+                 pool_size: int = 10, connect_timeout_sec: float = 3.05, read_timeout_sec: float = 10.0,
+                 min_request_time_sec: float = 0.05):
+        # each client owns its credentials, connection pool, rate limit budget and (optionally shared) cache
+        self._api_key = api_key
+        self._account_id = account_id
+        self._request_endpoint = request_endpoint
+        self._streaming_endpoint = streaming_endpoint
+        self._request_headers = {'Authorization': f"Bearer {self._api_key}", 'Accept': 'application/json'}
+        self._pool_size = pool_size
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._rate_limiter = RateLimiter() if rate_limiter is None else rate_limiter
+        self._market_data_cache = MarketDataCache() if market_data_cache is None else market_data_cache
+        # every request gets connect / read timeouts, shortened further by any active deadline (see deadline.py)
+        self._connect_timeout_sec = connect_timeout_sec
+        self._read_timeout_sec = read_timeout_sec
+        self._min_request_time_sec = min_request_time_sec
+        self._recorder = None
+        self._replayer = None
+        self._time_service = None
+        self._outcome = threading.local()
+        # requests go out from thread pools (batched quotes, liquidations), += on a shared counter is not atomic
+        self._count_lock = threading.Lock()
+        self.request_count = 0
+        self.skipped_request_count = 0
 
     @classmethod
-    def use_brokerage(cls) -> None:
-        cls._request_endpoint = cls._brokerage_request_endpoint
-        cls._streaming_endpoint = cls._brokerage_streaming_endpoint
-        cls._api_key = cls._brokerage_api_key
-        cls._account_id = cls._brokerage_account_id
-        cls._request_headers = {'Authorization': f"Bearer {cls._api_key}", 'Accept': 'application/json'}
+    def brokerage(cls, **kwargs):
+        creds = _api_creds()
+        return cls(api_key=creds['brokerage']['key'],
+                   account_id=creds['brokerage']['account'],
+                   request_endpoint=cls._brokerage_request_endpoint,
+                   streaming_endpoint=cls._brokerage_streaming_endpoint, **kwargs)
 
     @classmethod
-    def use_sandbox(cls) -> None:
-        cls._request_endpoint = cls._sandbox_request_endpoint
-        # cls._streaming_endpoint = cls._brokerage_streaming_endpoint
-        cls._api_key = cls._sandbox_api_key
-        cls._account_id = cls._sandbox_account_id
-        cls._request_headers = {'Authorization': f"Bearer {cls._api_key}", 'Accept': 'application/json'}
+    def sandbox(cls, **kwargs):
+        creds = _api_creds()
+        return cls(api_key=creds['sandbox']['key'],
+                   account_id=creds['sandbox']['account'],
+                   request_endpoint=cls._sandbox_request_endpoint,
+                   streaming_endpoint=None, **kwargs)
 
     @classmethod
-    def use_legacy_sandbox(cls) -> None:
-        cls._request_endpoint = cls._sandbox_request_endpoint
-        # cls._streaming_endpoint = cls._brokerage_streaming_endpoint
-        cls._api_key = cls._legacy_sandbox_api_key
-        cls._account_id = cls._legacy_sandbox_account_id
-        cls._request_headers = {'Authorization': f"Bearer {cls._api_key}", 'Accept': 'application/json'}
+    def legacy_sandbox(cls, **kwargs):
+        creds = _api_creds()
+        return cls(api_key=creds['legacy_sandbox']['key'],
+                   account_id=creds['legacy_sandbox']['account'],
+                   request_endpoint=cls._sandbox_request_endpoint,
+                   streaming_endpoint=None, **kwargs)
 
     @classmethod
-    def request(cls, method, url, **kwargs) -> Union[Dict, None]:
+    def from_creds(cls, name: str, **kwargs):
+        # any entry in tradier_api_creds, e.g. additional accounts - sandbox entries are detected by name
+        if 'sandbox' in name:
+            kwargs.setdefault('request_endpoint', cls._sandbox_request_endpoint)
+            kwargs.setdefault('streaming_endpoint', None)
+        creds = _api_creds()
+        return cls(api_key=creds[name]['key'], account_id=creds[name]['account'], **kwargs)
+
+    @property
+    def account_id(self) -> str:
+        return self._account_id
+
+    @property
+    def market_data_cache(self) -> MarketDataCache:
+        return self._market_data_cache
+
+    @property
+    def last_request_outcome(self) -> Union[str, None]:
+        # outcome of this thread's last request (REQUEST_OK, REQUEST_SKIPPED, ...) - tells a None from an order
+        # endpoint that never went out apart from one whose response got lost
+        return getattr(self._outcome, 'value', None)
+
+    def start_recording(self, path: str) -> ApiRecorder:
+        self.stop_recording()
+        self._recorder = ApiRecorder(path=path)
+        return self._recorder
+
+    def stop_recording(self) -> None:
+        if self._recorder is not None:
+            self._recorder.close()
+            self._recorder = None
+
+    def use_replay(self, path: Union[str, List[str]]) -> ApiReplayer:
+        # serve all requests from a recording instead of the network
+        self._replayer = ApiReplayer(path=path)
+        return self._replayer
+
+    def stop_replay(self) -> None:
+        self._replayer = None
+
+    def attach_time_service(self, time_service: Union[TimeService, None]) -> None:
+        # every response's Date header becomes a clock offset sample, no extra requests
+        self._time_service = time_service
+
+    def _http_session(self):
+        # the connection pool is built on the first real request - replayed and simulated runs never import requests
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    import requests
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=self._pool_size,
+                                                            pool_maxsize=self._pool_size)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    session.headers.update(self._request_headers)
+                    self._session = session
+        return self._session
+
+    def request(self, method, url, **kwargs) -> Union[Dict, None]:
+        with self._count_lock:
+            self.request_count += 1
+        if self._replayer is not None:
+            results = self._replayer.request(method=method, url=url, **kwargs)
+            self._outcome.value = REQUEST_FAILED if results is None else REQUEST_OK
+            return results
         results = None
+        status_code = None
+        timeout = (self._connect_timeout_sec, self._read_timeout_sec)
+        deadline = current_deadline()
+        if deadline is not None:
+            # skip calls that cannot finish inside the caller's time budget
+            if deadline.remaining() < self._min_request_time_sec or \
+                    not self._rate_limiter.acquire(max_wait_sec=deadline.remaining() - self._min_request_time_sec):
+                with self._count_lock:
+                    self.skipped_request_count += 1
+                self._outcome.value = REQUEST_SKIPPED
+                urllib_logger.warning(f"Request skipped, time budget exhausted: {method} {url}")
+                return None
+            remaining = deadline.remaining()
+            timeout = (min(timeout[0], remaining), min(timeout[1], remaining))
+        else:
+            self._rate_limiter.acquire()
+        session = self._http_session()
+        from requests.exceptions import RequestException
+        request_start = timer.perf_counter()
+        # anything that ends without a response (timeouts included) may still have reached the broker
+        self._outcome.value = REQUEST_FAILED
         try:
-            response = requests.request(method=method, url=url, headers=cls._request_headers, **kwargs)
+            with span('http'):
+                sent_ns = timer.monotonic_ns()
+                response = session.request(method=method, url=url, timeout=timeout, **kwargs)
+            if self._time_service is not None:
+                self._time_service.observe_date_header(date_header=response.headers.get('Date'), sent_mono_ns=sent_ns,
+                                                       received_mono_ns=timer.monotonic_ns())
+            status_code = response.status_code
             if response.status_code == 200:
-                results = response.json()
+                with span('json'):
+                    results = response.json()
+                rejected = isinstance(results, dict) and 'errors' in results
+                self._outcome.value = REQUEST_REJECTED if rejected else REQUEST_OK
             else:
+                # a 4xx with an errors body is an explicit rejection, the request was not acted on
+                errors = None
+                if 400 <= response.status_code < 500:
+                    try:
+                        errors = response.json().get('errors')
+                    except (ValueError, AttributeError):
+                        errors = None
+                    if errors:
+                        self._outcome.value = REQUEST_REJECTED
                 raise RuntimeError(f"Unexpected Response"
                                    f"\nStatus code: {response.status_code} "
-                                   f"\nStatus reason: {response.reason}")
+                                   f"\nStatus reason: {response.reason}"
+                                   f"\nErrors: {errors}")
         except RuntimeError as e1:
             urllib_logger.error(str(e1))
         except RequestException as e2:
             urllib_logger.error(str(e2))
+        if self._recorder is not None:
+            self._recorder.record(method=method, url=url, status_code=status_code, results=results,
+                                  elapsed=timer.perf_counter() - request_start, **kwargs)
         return results
 
-    @classmethod
-    def get_user_profile(cls) -> Union[List[Dict], Dict]:
-        url = f'{cls._request_endpoint}user/profile'
+    def get_user_profile(self) -> Union[List[Dict], Dict]:
+        url = f'{self._request_endpoint}user/profile'
         params = {}
-        results = cls.request(method='GET', url=url, params=params)
+        results = self.request(method='GET', url=url, params=params)
         return None if results is None else results.get('profile', {}).get('account', None)
 
-    @classmethod
-    def get_account_balances(cls) -> Dict:
-        url = f'{cls._request_endpoint}accounts/{cls._account_id}/balances'
+    def get_account_balances(self) -> Dict:
+        url = f'{self._request_endpoint}accounts/{self._account_id}/balances'
         params = {}
-        results = cls.request(method='GET', url=url, params=params)
+        results = self.request(method='GET', url=url, params=params)
         return None if results is None else results.get('balances', None)
 
-    @classmethod
-    def get_account_positions(cls) -> Union[List[Dict], None]:
-        url = f'{cls._request_endpoint}accounts/{cls._account_id}/positions'
+    def get_account_positions(self) -> Union[List[Dict], None]:
+        url = f'{self._request_endpoint}accounts/{self._account_id}/positions'
         params = {}
-        results = cls.request(method='GET', url=url, params=params)
+        results = self.request(method='GET', url=url, params=params)
         if results:
             for key in ['positions', 'position']:
                 if isinstance(results, dict):
@@ -102,15 +351,14 @@ class TradierApiBase:
                     results = {}
         return None if not results else dict_to_list_of_dict(results)
 
-    @classmethod
-    def get_account_history(cls, **params) -> Union[List[Dict], None]:
-        url = f'{cls._request_endpoint}accounts/{cls._account_id}/history'
+    def get_account_history(self, **params) -> Union[List[Dict], None]:
+        url = f'{self._request_endpoint}accounts/{self._account_id}/history'
         if not params:
             params = {}
         # {'page': '3', 'limit': '100',
         #  'type': 'trade, option, ach, wire, dividend, fee, tax, journal, check, transfer, adjustment, interest',
         #  'start': 'yyyy-mm-dd', 'end': 'yyyy-mm-dd', 'symbol': 'SPY', 'exactMatch': 'true'}
-        results = cls.request(method='GET', url=url, params=params)
+        results = self.request(method='GET', url=url, params=params)
         if results:
             for key in ['history', 'event']:
                 if isinstance(results, dict):
@@ -119,16 +367,15 @@ class TradierApiBase:
                     results = {}
         return None if not results else dict_to_list_of_dict(results)
 
-    @classmethod
-    def get_account_gain_loss(cls, **kwargs) -> Union[List[Dict], None]:
-        url = f'{cls._request_endpoint}accounts/{cls._account_id}/gainloss'
+    def get_account_gain_loss(self, **kwargs) -> Union[List[Dict], None]:
+        url = f'{self._request_endpoint}accounts/{self._account_id}/gainloss'
         if kwargs:
             params = kwargs
         else:
             params = {}
         # {'page': '3', 'limit': '100', 'sortBy': 'closeDate', 'sort': 'desc',
         # 'start': 'yyyy-mm-dd', 'end': 'yyyy-mm-dd', 'symbol': 'SPY'}
-        results = cls.request(method='GET', url=url, params=params)
+        results = self.request(method='GET', url=url, params=params)
         if results:
             for key in ['gainloss', 'closed_position']:
                 if isinstance(results, dict):
@@ -137,11 +384,10 @@ class TradierApiBase:
                     results = {}
         return None if not results else dict_to_list_of_dict(results)
 
-    @classmethod
-    def get_account_orders(cls, include_tags='true') -> Union[List[Dict], None]:
-        url = f'{cls._request_endpoint}accounts/{cls._account_id}/orders'
+    def get_account_orders(self, include_tags='true') -> Union[List[Dict], None]:
+        url = f'{self._request_endpoint}accounts/{self._account_id}/orders'
         params = {'includeTags': include_tags}
-        results = cls.request(method='GET', url=url, params=params)
+        results = self.request(method='GET', url=url, params=params)
         if results:
             for key in ['orders', 'order']:
                 if isinstance(results, dict):
@@ -150,60 +396,156 @@ class TradierApiBase:
                     results = {}
         return None if not results else dict_to_list_of_dict(results)
 
-    @classmethod
-    def get_an_account_order(cls, order_id, include_tags='true') -> Union[Dict, None]:
-        url = f'{cls._request_endpoint}accounts/{cls._account_id}/orders/{order_id}'
+    def get_an_account_order(self, order_id, include_tags='true') -> Union[Dict, None]:
+        url = f'{self._request_endpoint}accounts/{self._account_id}/orders/{order_id}'
         params = {'includeTags': include_tags}
-        results = cls.request(method='GET', url=url, params=params)
+        results = self.request(method='GET', url=url, params=params)
         return None if results is None else results.get('order', None)
 
-    @classmethod
-    def cancel_order(cls, order_id) -> Union[Dict, None]:
-        url = f'{cls._request_endpoint}accounts/{cls._account_id}/orders/{order_id}'
+    def cancel_order(self, order_id) -> Union[Dict, None]:
+        url = f'{self._request_endpoint}accounts/{self._account_id}/orders/{order_id}'
         data = {}
-        results = cls.request(method='DELETE', url=url, data=data)
+        results = self.request(method='DELETE', url=url, data=data)
         return None if results is None else results.get('order', None)
 
-    @classmethod
-    def get_quotes(cls, symbols: Union[List[str], str], greeks: str = 'false') -> Union[List[Dict], None]:
-        url = f'{cls._request_endpoint}markets/quotes'
-        if isinstance(symbols, list):
-            symbols = ",".join(symbols)
-        params = {'symbols': symbols, 'greeks': greeks}
-        results = cls.request(method='GET', url=url, params=params)
+    def _request_quotes(self, symbols: List[str], greeks: str = 'false', use_post: bool = False) -> Union[List[Dict], None]:
+        url = f'{self._request_endpoint}markets/quotes'
+        payload = {'symbols': ",".join(symbols), 'greeks': greeks}
+        if use_post:
+            # form body instead of query string, no url length limit
+            results = self.request(method='POST', url=url, data=payload)
+        else:
+            results = self.request(method='GET', url=url, params=payload)
         if results:
             for key in ['quotes', 'quote']:
                 if isinstance(results, dict):
                     results = results.get(key, {})
                 else:
                     results = {}
-        return None if not results else dict_to_list_of_dict(results)
-
-    @classmethod
-    def get_market_clock(cls, delayed: str = 'false') -> Union[Dict, None]:
-        url = f'{cls._request_endpoint}markets/clock'
+        if results is None:
+            return None
+        quotes = dict_to_list_of_dict(results) or []
+        for quote in quotes:
+            self._market_data_cache.put(('quote', quote.get('symbol'), greeks), quote,
+                                        ttl_sec=self._market_data_cache.quote_ttl_sec)
+        return quotes
+
+    def _get_cached_quotes(self, symbols: List[str], greeks: str) -> Tuple[Dict[str, Dict], List[str]]:
+        # serve what we can from the (shared) market data cache and return the symbols still needed
+        quotes = {}
+        missing = []
+        for symbol in symbols:
+            quote = self._market_data_cache.get(('quote', symbol, greeks))
+            if quote is None:
+                missing.append(symbol)
+            else:
+                quotes[symbol] = quote
+        return quotes, missing
+
+    def get_quotes(self, symbols: Union[List[str], str], greeks: str = 'false') -> Union[List[Dict], None]:
+        if isinstance(symbols, str):
+            symbols = symbols.split(',')
+        quotes, missing = self._get_cached_quotes(symbols=symbols, greeks=greeks)
+        if missing:
+            for quote in self._request_quotes(symbols=missing, greeks=greeks) or []:
+                quotes[quote.get('symbol')] = quote
+        results = [quotes[symbol] for symbol in symbols if symbol in quotes]
+        return None if not results else results
+
+    def get_quotes_batched(self, symbols: List[str], greeks: str = 'false', max_chunk_symbols: int = 200,
+                           max_chunk_chars: int = 1500, use_post: bool = True, max_workers: int = 4,
+                           use_cache: bool = True) -> Dict[str, Union[Dict, None]]:
+        # symbol -> quote; symbols whose chunk failed map to None, unknown symbols are left out
+        # use_cache=False fetches every symbol, the cache entries are overwritten in place (readers never see a gap)
+        symbols = list(dict.fromkeys(symbols))
+        if use_cache:
+            quotes, missing = self._get_cached_quotes(symbols=symbols, greeks=greeks)
+        else:
+            quotes, missing = {}, symbols
+        chunks = chunk_symbols(symbols=missing, max_symbols=max_chunk_symbols,
+                               max_chars=None if use_post else max_chunk_chars)
+        if chunks:
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks)))) as executor:
+                # copy the context so each chunk inherits the caller's deadline
+                futures = [executor.submit(contextvars.copy_context().run, self._request_quotes, symbols=chunk,
+                                           greeks=greeks, use_post=use_post)
+                           for chunk in chunks]
+                for chunk, future in zip(chunks, futures):
+                    try:
+                        results = future.result()
+                    except Exception as e:
+                        urllib_logger.error(f"Quote chunk failed: {e}")
+                        results = None
+                    if results is None:
+                        quotes.update({symbol: None for symbol in chunk})
+                    else:
+                        quotes.update({quote.get('symbol'): quote for quote in results})
+        return quotes
+
+    def get_market_clock(self, delayed: str = 'false') -> Union[Dict, None]:
+        url = f'{self._request_endpoint}markets/clock'
         params = {'delayed': delayed}
-        results = cls.request(method='GET', url=url, params=params)
+        results = self.request(method='GET', url=url, params=params)
         return None if results is None else results.get('clock', None)
 
-    @classmethod
-    def get_market_calendar(cls, month, year) -> Union[List[Dict], None]:
-        url = f'{cls._request_endpoint}markets/calendar'
+    def get_market_calendar(self, month, year) -> Union[List[Dict], None]:
+        cache_key = ('calendar', month, year)
+        cached = self._market_data_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        url = f'{self._request_endpoint}markets/calendar'
         params = {'month': month, 'year': year}
-        results = cls.request(method='GET', url=url, params=params)
-        return None if results is None else results.get('calendar', {}).get('days', {}).get('day', None)
+        results = self.request(method='GET', url=url, params=params)
+        results = None if results is None else results.get('calendar', {}).get('days', {}).get('day', None)
+        if results:
+            self._market_data_cache.put(cache_key, results, ttl_sec=self._market_data_cache.calendar_ttl_sec)
+        return results
 
-    @classmethod
-    def get_option_chains(cls, symbol, expiration, greeks='true') -> Union[List[Dict], None]:
-        url = f'{cls._request_endpoint}markets/options/chains'
+    def get_option_chains(self, symbol, expiration, greeks='true') -> Union[List[Dict], None]:
+        url = f'{self._request_endpoint}markets/options/chains'
         params = {'symbol': symbol, 'expiration': expiration, 'greeks': greeks}
-        results = cls.request(method='GET', url=url, params=params)
-        return None if results is None else results.get('options', {}).get('option', None)
+        results = self.request(method='GET', url=url, params=params)
+        return None if results is None else dict_to_list_of_dict(results.get('options', {}).get('option', None))
+
+    def get_option_expirations(self, symbol, include_all_roots='true') -> Union[List[str], None]:
+        cache_key = ('expirations', symbol, include_all_roots)
+        cached = self._market_data_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        url = f'{self._request_endpoint}markets/options/expirations'
+        params = {'symbol': symbol, 'includeAllRoots': include_all_roots}
+        results = self.request(method='GET', url=url, params=params)
+        results = None if not results else results.get('expirations', {}) or {}
+        results = None if not results else results.get('date', None)
+        if isinstance(results, str):
+            results = [results]
+        if results:
+            # listed expirations only change overnight
+            self._market_data_cache.put(cache_key, results, ttl_sec=self._market_data_cache.calendar_ttl_sec)
+        return results
 
-    @classmethod
-    def post_option_order(cls, underlying_symbol, option_symbol, side, quantity, order_type='market', duration='day',
+    def get_option_symbols(self, underlying) -> Union[List[Dict], None]:
+        # every listed option symbol for the underlying, one entry per option root
+        url = f'{self._request_endpoint}markets/options/lookup'
+        params = {'underlying': underlying}
+        results = self.request(method='GET', url=url, params=params)
+        return None if results is None else dict_to_list_of_dict(results.get('symbols', None))
+
+    def symbol_lookup(self, symbol, exchanges=None, types=None) -> Union[List[Dict], None]:
+        # exchanges - e.g. 'Q,N', types - e.g. 'stock,option,etf,index'
+        url = f'{self._request_endpoint}markets/lookup'
+        params = {'q': symbol}
+        if exchanges:
+            params.update({'exchanges': exchanges})
+        if types:
+            params.update({'types': types})
+        results = self.request(method='GET', url=url, params=params)
+        results = None if not results else results.get('securities', {}) or {}
+        return None if not results else dict_to_list_of_dict(results.get('security', None))
+
+    def post_option_order(self, underlying_symbol, option_symbol, side, quantity, order_type='market', duration='day',
                           price=None, stop=None, tag=None, preview=True) -> Union[Dict, None]:
-        url = f'{cls._request_endpoint}accounts/{cls._account_id}/orders'
+        url = f'{self._request_endpoint}accounts/{self._account_id}/orders'
         # for equity orders
         # side = ['buy', 'buy_to_cover', 'sell', 'sell_short']
         # for option orders
@@ -228,7 +570,7 @@ class TradierApiBase:
             data.update({'tag': tag})
         if preview:
             data.update({'preview': 'true'})
-        results = cls.request(method='POST', url=url, data=data)
+        results = self.request(method='POST', url=url, data=data)
         return None if results is None else results.get('order', None)
 
 
@@ -257,6 +599,21 @@ class Position:
     def unit_cost(self) -> float:
         return self.cost_basis / self.quantity
 
+    def occ_symbol(self) -> Union[OccSymbol, None]:
+        # decoded from the symbol itself, no quote needed to tell options apart
+        return parse_occ_symbol(self.symbol)
+
+    def is_option(self) -> bool:
+        return self.occ_symbol() is not None
+
+    def to_dict(self) -> Dict:
+        # same shape as the api response, Position(**p.to_dict()) round trips
+        return {'cost_basis': self.cost_basis,
+                'date_acquired': self.date_acquired.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+                'id': self.id,
+                'quantity': self.quantity,
+                'symbol': self.symbol}
+
 
 class Quote:
 
@@ -296,6 +653,8 @@ class Quote:
         self.expiration_type = kwargs.get('expiration_type', None)
         self.option_type = kwargs.get('option_type', None)
         self.root_symbol = kwargs.get('root_symbol', None)
+        # only present for option chains requested with greeks (delta, gamma, theta, vega, rho, phi, *_iv, updated_at)
+        self.greeks = kwargs.get('greeks', None)
 
     def expiration_dt(self) -> Union[None, date]:
         return None if not self.expiration_date else date.fromisoformat(self.expiration_date)
@@ -424,6 +783,18 @@ class MarketCalendarDay:
     def early_close(self) -> bool:
         return None if not self.is_market_day() is None else self.market_close.time() < time(hour=16, minute=0)
 
+    def to_dict(self) -> Dict:
+        # same shape as the api response, MarketCalendarDay(**d.to_dict()) round trips
+        output = {'date': self.date.isoformat(), 'status': self.status, 'description': self.description}
+        if self.market_open is not None:
+            output.update({'premarket': {'start': self.premarket_open.strftime('%H:%M') if self.premarket_open else None,
+                                         'end': self.market_open.strftime('%H:%M')},
+                           'open': {'start': self.market_open.strftime('%H:%M'),
+                                    'end': self.market_close.strftime('%H:%M')},
+                           'postmarket': {'start': self.market_close.strftime('%H:%M'),
+                                          'end': self.postmarket_close.strftime('%H:%M') if self.postmarket_close else None}})
+        return output
+
     def get_market_state_at_time(self, eval_ts: time):
         return [x for x in self.market_states if x.start_dts.time() <= eval_ts < x.end_dts.time()][0]
 
@@ -445,41 +816,104 @@ class MarketCalendarDay:
 
 class TradierApi(TradierApiBase):
 
-    @classmethod
-    def get_account_positions(cls) -> Union[List[Position], None]:
+    def get_account_balances(self) -> Union[AccountBalances, None]:
+        data = super().get_account_balances()
+        return None if data is None else AccountBalances(**data)
+
+    def get_account_positions(self) -> Union[List[Position], None]:
         data = super().get_account_positions()
-        return None if data is None else [Position(**d) for d in data]
+        with span('models'):
+            return None if data is None else [Position(**d) for d in data]
 
-    @classmethod
-    def get_quotes(cls, symbols: Union[List[str], List[Position], str], greeks: str = 'false') -> Union[List[Quote], None]:
+    def get_quotes(self, symbols: Union[List[str], List[Position], str], greeks: str = 'false') -> Union[List[Quote], None]:
         if isinstance(symbols, list):
             symbols = [s.symbol if isinstance(s, Position) else s for s in symbols]
         data = super().get_quotes(symbols=symbols, greeks=greeks)
         return None if data is None else [Quote(**d) for d in data]
 
-    @classmethod
-    def get_market_calendar(cls, month, year) -> Union[List[MarketCalendarDay], None]:
+    def get_quotes_batched(self, symbols: List[Union[str, Position]], greeks: str = 'false', **kwargs) -> Dict[str, Union[Quote, None]]:
+        symbols = [s.symbol if isinstance(s, Position) else s for s in symbols]
+        data = super().get_quotes_batched(symbols=symbols, greeks=greeks, **kwargs)
+        with span('models'):
+            return {symbol: None if d is None else Quote(**d) for symbol, d in data.items()}
+
+    def get_option_chains(self, symbol, expiration, greeks='true') -> Union[List[Quote], None]:
+        data = super().get_option_chains(symbol=symbol, expiration=expiration, greeks=greeks)
+        return None if data is None else [Quote(**d) for d in data]
+
+    def get_market_calendar(self, month, year) -> Union[List[MarketCalendarDay], None]:
         data = super().get_market_calendar(month=month, year=year)
         return None if data is None else [MarketCalendarDay(**d) for d in data]
 
-    @classmethod
-    def get_market_calendar_range(cls, base_date: Union[date, datetime], mo_hist: int = 3, mo_fut: int = 3) -> List[MarketCalendarDay]:
+    def get_market_calendar_range(self, base_date: Union[date, datetime], mo_hist: int = 3, mo_fut: int = 3) -> List[MarketCalendarDay]:
         if isinstance(base_date, datetime):
             base_date = base_date.date()
         data = []
         for x in range(-mo_hist, mo_fut + 1, 1):
-            loop_date = base_date + relativedelta(months=x)
-            data += cls.get_market_calendar(month=loop_date.month, year=loop_date.year)
+            loop_date = shift_months(day=base_date, months=x)
+            data += self.get_market_calendar(month=loop_date.month, year=loop_date.year)
         return data
 
 
 class MarketCalendar:
 
-    def __init__(self, base_date: Union[date, None] = None, mo_hist: int = 3, mo_fut: int = 3):
+    def __init__(self, api: TradierApi, base_date: Union[date, None] = None, mo_hist: int = 3, mo_fut: int = 3):
         if base_date is None:
-            base_date = date.today()
-        self._days = TradierApi.get_market_calendar_range(base_date=base_date, mo_hist=mo_hist, mo_fut=mo_fut)
+            base_date = get_clock().now().date()
+        self._days = api.get_market_calendar_range(base_date=base_date, mo_hist=mo_hist, mo_fut=mo_fut)
+        self._build_index()
+
+    @classmethod
+    def from_days(cls, days: List[MarketCalendarDay]):
+        # calendar from already known days (e.g. reloaded from the state journal), no api calls
+        calendar = cls.__new__(cls)
+        calendar._days = list(days)
+        calendar._build_index()
+        return calendar
+
+    def covers(self, first: date, last: date) -> bool:
+        return bool(self._days) and self._days[0].date <= first and last <= self._days[-1].date
+
+    def save_snapshot(self, path: str) -> None:
+        # the calendar with its built index, pickled - loading it needs no api calls, no parsing and no index build
+        # the index holds epoch timestamps of local times, so a snapshot is only valid for the timezone it was made in
+        header = {'version': CALENDAR_SNAPSHOT_VERSION, 'tzname': timer.tzname, 'created': get_clock().timestamp()}
+        with open(f'{path}.tmp', 'wb') as f:
+            pickle.dump((header, self), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f'{path}.tmp', path)
+
+    @classmethod
+    def load_snapshot(cls, path: str, base_date: Union[date, None] = None, days_ahead: int = 7):
+        # the snapshot calendar, if there is a usable one covering base_date and the days after it
+        base_date = get_clock().now().date() if base_date is None else base_date
+        try:
+            with open(path, 'rb') as f:
+                header, calendar = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError, TypeError):
+            return None
+        if not isinstance(calendar, cls) or header.get('version') != CALENDAR_SNAPSHOT_VERSION or \
+                tuple(header.get('tzname', ())) != tuple(timer.tzname):
+            return None
+        last = date.fromordinal(base_date.toordinal() + days_ahead)
+        return calendar if calendar.covers(first=base_date, last=last) else None
+
+    def _build_index(self) -> None:
         self._days.sort()
+        self._days_dict = {d.date: d for d in self._days}
+        # prefix sum of tradeable seconds - _tradeable_before[i] is the tradeable time before _tradeable_starts[i]
+        self._tradeable_starts = []
+        self._tradeable_ends = []
+        self._tradeable_before = []
+        total = 0.0
+        for d in self._days:
+            for ms in d.market_states:
+                if ms.tradeable and ms.start_dts is not None and ms.end_dts is not None:
+                    start_ts = ms.start_dts.timestamp()
+                    end_ts = ms.end_dts.timestamp()
+                    self._tradeable_starts.append(start_ts)
+                    self._tradeable_ends.append(end_ts)
+                    self._tradeable_before.append(total)
+                    total += end_ts - start_ts
 
     @property
     def days(self) -> List[MarketCalendarDay]:
@@ -487,14 +921,20 @@ class MarketCalendar:
 
     @property
     def days_dict(self) -> Dict[date, MarketCalendarDay]:
-        return {d.date: d for d in self.days}
-
-    def get_day(self, day: Union[date, datetime, MarketCalendarDay]) -> MarketCalendarDay:
-        if isinstance(day, datetime) or isinstance(day, MarketCalendarDay):
+        return self._days_dict
+
+    def get_day(self, day: Union[date, datetime, MarketCalendarDay, None] = None) -> MarketCalendarDay:
+        if day is None:
+            day = get_clock().now()
+        if isinstance(day, datetime):
+            day = day.date()
+        elif isinstance(day, MarketCalendarDay):
             day = day.date
         return self.days_dict.get(day, None)
 
-    def get_future_market_states(self, eval_dts: datetime) -> List[MarketState]:
+    def get_future_market_states(self, eval_dts: Union[datetime, None] = None) -> List[MarketState]:
+        if eval_dts is None:
+            eval_dts = get_clock().now()
         market_states = []
         for d in self.days:
             if d.date >= eval_dts.date():
@@ -504,21 +944,61 @@ class MarketCalendar:
         market_states.sort()
         return market_states
 
-    def get_tradeable_future_market_states(self, eval_dts: datetime) -> List[MarketState]:
+    def get_tradeable_future_market_states(self, eval_dts: Union[datetime, None] = None) -> List[MarketState]:
         return [ms for ms in self.get_future_market_states(eval_dts=eval_dts) if ms.tradeable]
 
-    def get_non_tradeable_future_market_states(self, eval_dts: datetime) -> List[MarketState]:
+    def get_non_tradeable_future_market_states(self, eval_dts: Union[datetime, None] = None) -> List[MarketState]:
         return [ms for ms in self.get_future_market_states(eval_dts=eval_dts) if not ms.tradeable]
 
-    def get_market_state(self, eval_dts: datetime, n_future: int = 0) -> MarketState:
+    def get_market_state(self, eval_dts: Union[datetime, None] = None, n_future: int = 0) -> MarketState:
         return self.get_future_market_states(eval_dts=eval_dts)[n_future]
 
-    def get_tradeable_market_state(self, eval_dts: datetime, n_future: int = 0) -> MarketState:
+    def get_tradeable_market_state(self, eval_dts: Union[datetime, None] = None, n_future: int = 0) -> MarketState:
         return self.get_tradeable_future_market_states(eval_dts=eval_dts)[n_future]
 
-    def get_non_tradeable_market_state(self, eval_dts: datetime, n_future: int = 0) -> MarketState:
+    def get_non_tradeable_market_state(self, eval_dts: Union[datetime, None] = None, n_future: int = 0) -> MarketState:
         return self.get_non_tradeable_future_market_states(eval_dts=eval_dts)[n_future]
 
+    def get_next_market_state_change(self, eval_dts: Union[datetime, None] = None) -> Union[datetime, None]:
+        # first market state boundary strictly after eval_dts (used to schedule wake ups)
+        if eval_dts is None:
+            eval_dts = get_clock().now()
+        for d in self.days:
+            if d.end_of_day > eval_dts:
+                for ms in d.market_states:
+                    if ms.start_dts > eval_dts:
+                        return ms.start_dts
+        return None
+
+    def _tradeable_seconds_at(self, ts: float) -> float:
+        # cumulative tradeable seconds from the start of the calendar up to ts
+        i = bisect_right(self._tradeable_starts, ts) - 1
+        if i < 0:
+            return 0.0
+        return self._tradeable_before[i] + min(ts, self._tradeable_ends[i]) - self._tradeable_starts[i]
+
+    def tradeable_seconds_between(self, start_dts: datetime, end_dts: datetime) -> float:
+        # accounts for weekends, holidays and early closes - only covers the loaded calendar range
+        if end_dts <= start_dts:
+            return 0.0
+        return self._tradeable_seconds_at(end_dts.timestamp()) - self._tradeable_seconds_at(start_dts.timestamp())
+
+    def tradeable_seconds_until(self, end_dts: datetime, eval_dts: Union[datetime, None] = None) -> float:
+        if eval_dts is None:
+            eval_dts = get_clock().now()
+        return self.tradeable_seconds_between(start_dts=eval_dts, end_dts=end_dts)
+
+    def tradeable_seconds_to_expiry(self, expiration: Union[date, str], eval_dts: Union[datetime, None] = None) -> float:
+        # options stop trading at the close on expiration day
+        if isinstance(expiration, str):
+            expiration = date.fromisoformat(expiration)
+        expiration_day = self.get_day(day=expiration)
+        if expiration_day is not None and expiration_day.is_market_day():
+            end_dts = expiration_day.market_close
+        else:
+            end_dts = datetime.combine(date=expiration, time=time(hour=0, minute=0)) + timedelta(days=1)
+        return self.tradeable_seconds_until(end_dts=end_dts, eval_dts=eval_dts)
+
     def get_next_open_day(self, start_day: Union[date, datetime, MarketCalendarDay]) -> MarketCalendarDay:
         if isinstance(start_day, datetime):
             start_day = start_day.date()
@@ -527,6 +1007,3 @@ class MarketCalendar:
         day_list = [d for d in self.days if d.date > start_day and d.is_market_day()]
         day_list.sort()
         return day_list[0]
-
-
-